@@ -0,0 +1,83 @@
+"""Micro-benchmark of ramp compilation against the number of keyframes.
+
+Builds synthetic scenes with n_keys keyframes and 64 analog channels, and times
+the keyframe bake together with rendering every channel on a shared time base.
+With cached key order and position lookups the time per keyframe should stay
+roughly constant as n_keys grows.
+
+Usage:
+    python benchmarks/compile_scaling.py
+"""
+
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+# the repo root, after PYTHONPATH, so that rampage is found without
+# installing it
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rampage import ramps
+
+N_CHANNELS = 64
+JUMP_RESOLUTION = 4e-3
+RAMP_RESOLUTION = 0.5
+
+
+def make_scene(n_keys, n_channels=N_CHANNELS, seed=0):
+    """Returns (keyframes, channels) dicts of a synthetic scene."""
+    rng = random.Random(seed)
+    keyframes = {'key0000': {'comment': '', 'parent': None, 'time': 0.0}}
+    for i in range(1, n_keys):
+        # keys are children of one of the last few keys, so that the tree
+        # has both long chains and branches. Key i is at i ms.
+        parent_number = rng.randint(max(0, i - 4), i - 1)
+        parent = 'key{0:04d}'.format(parent_number)
+        keyframes['key{0:04d}'.format(i)] = {'comment': '', 'parent': parent,
+                                             'time': float(i - parent_number)}
+    key_names = sorted(keyframes)
+    channels = {}
+    for n in range(n_channels):
+        keys = {}
+        for kn in key_names:
+            if kn != key_names[0] and rng.random() > 0.25:
+                continue
+            ramp_type = rng.choice(['jump', 'jump', 'linear'])
+            keys[kn] = {'ramp_type': ramp_type,
+                        'ramp_data': {'value': rng.uniform(-5.0, 5.0)}}
+        channels['ch{0:02d}'.format(n)] = {'comment': '', 'id': 'ch', 'keys':
+                                           keys, 'type': 'analog',
+                                           'conversion': 'x'}
+    return keyframes, channels
+
+
+def compile_scene(keyframes, channels):
+    kfl = ramps.KeyFrameList(keyframes)
+    channel_list = [ramps.Channel(ch_name, ch_dct, kfl)
+                    for ch_name, ch_dct in channels.items()]
+    ramp_regions = np.zeros(len(keyframes) - 1)
+    for ch in channel_list:
+        ramp_regions += ch.get_ramp_regions()
+    for ch in channel_list:
+        ch.get_analog_ramp_data(ramp_regions, JUMP_RESOLUTION, RAMP_RESOLUTION)
+
+
+def main(key_counts=(125, 250, 500, 1000), repeats=3):
+    print('{0:>8} {1:>10} {2:>14}'.format('n_keys', 'time (s)',
+                                          'us/key/channel'))
+    for n_keys in key_counts:
+        keyframes, channels = make_scene(n_keys)
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.time()
+            compile_scene(keyframes, channels)
+            best = min(best, time.time() - start)
+        per_key = best/n_keys/N_CHANNELS*1e6
+        print('{0:>8d} {1:>10.3f} {2:>14.2f}'.format(n_keys, best, per_key))
+
+
+if __name__ == '__main__':
+    main()
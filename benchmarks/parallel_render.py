@@ -0,0 +1,98 @@
+"""Benchmark of rendering a shot with a pool of threads.
+
+Builds a synthetic scene which uses every analog output of Dev1 to Dev4 and
+every digital line, and times RampCompiler.make_ramps without a pool and with
+thread pools of increasing size. The speedup depends on the number of cores,
+but is small, since most of the rendering holds the interpreter lock, which is
+why the server renders without a pool by default.
+
+Usage:
+    python benchmarks/parallel_render.py [scene.json]
+"""
+
+import json
+import multiprocessing
+import multiprocessing.pool
+import os
+import random
+import sys
+import time
+
+# the repo root, after PYTHONPATH, so that rampage is found without
+# installing it
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rampage.compiler import (RampCompiler, analog_device_names,
+                              digital_channel_ids, get_analog_ids)
+
+
+def make_scene(n_keys=400, seed=0):
+    """Returns ramp data with n_keys keyframes, 1 ms apart."""
+    rng = random.Random(seed)
+    keyframes = {'key0000': {'comment': '', 'parent': None, 'time': 0.0}}
+    for i in range(1, n_keys):
+        keyframes['key{0:04d}'.format(i)] = {
+            'comment': '', 'parent': 'key{0:04d}'.format(i - 1), 'time': 1.0}
+    key_names = sorted(keyframes)
+
+    channels = {}
+    analog_ids = []
+    for dev_name in analog_device_names:
+        analog_ids.extend(get_analog_ids(dev_name))
+    for ch_id in analog_ids:
+        keys = {}
+        for kn in key_names:
+            if kn != key_names[0] and rng.random() > 0.3:
+                continue
+            ramp_type = rng.choice(['jump', 'linear', 'sine'])
+            ramp_data = {'value': rng.uniform(-5.0, 5.0)}
+            if ramp_type == 'sine':
+                ramp_data.update({'amp': 1.0, 'freq': 1.0, 'phase': 0.0})
+            keys[kn] = {'ramp_type': ramp_type, 'ramp_data': ramp_data}
+        channels[ch_id] = {'comment': '', 'id': ch_id, 'keys': keys,
+                           'type': 'analog', 'conversion': 'x'}
+    for ch_id in digital_channel_ids():
+        keys = {}
+        for kn in key_names:
+            if kn != key_names[0] and rng.random() > 0.3:
+                continue
+            keys[kn] = {'ramp_type': 'jump', 'ramp_data': {},
+                        'state': rng.random() > 0.5}
+        channels[ch_id] = {'comment': '', 'id': ch_id, 'keys': keys,
+                           'type': 'digital'}
+    properties = {'jump_resolution': 0.004, 'ramp_resolution': 0.02}
+    return {'keyframes': keyframes, 'channels': channels,
+            'properties': properties}
+
+
+def time_make_ramps(ramp_data, pool, repeats=3):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.time()
+        RampCompiler(ramp_data).make_ramps(pool)
+        best = min(best, time.time() - start)
+    return best
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            ramp_data = json.load(f)
+    else:
+        ramp_data = make_scene()
+
+    serial_time = time_make_ramps(ramp_data, None)
+    print('{0:>8} {1:>10} {2:>8}'.format('threads', 'time (s)', 'speedup'))
+    print('{0:>8} {1:>10.3f} {2:>8.2f}'.format('none', serial_time, 1.0))
+    n_threads = 2
+    while n_threads <= max(2, multiprocessing.cpu_count()):
+        pool = multiprocessing.pool.ThreadPool(n_threads)
+        pool_time = time_make_ramps(ramp_data, pool)
+        pool.close()
+        print('{0:>8d} {1:>10.3f} {2:>8.2f}'.format(n_threads, pool_time,
+                                                    serial_time/pool_time))
+        n_threads *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Benchmark of the peak memory of compiling a shot and preparing its upload.
+
+For each output format, compiles a synthetic scene in a fresh process and
+gets the data written to every analog card with daq.get_analog_task_data, as
+the upload does. Prints the increase of the peak resident memory of the
+process and RampCompiler.estimate_shot_size()['peak_bytes']. Uses the
+resource module, so it only runs on Unix.
+
+With --baseline REV, the same is measured with the rampage package of the
+git revision REV first, for a before and after comparison.
+
+Usage:
+    python benchmarks/shot_memory.py [--baseline REV] [scene.json]
+"""
+
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+
+# the repo root, after PYTHONPATH, so that rampage is found without
+# installing it
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['RAMPAGE_DAQ_BACKEND'] = 'simulated'
+
+from rampage.compiler import RampCompiler, output_formats
+from rampage.daq import daq
+
+from parallel_render import make_scene
+
+N_KEYS = 4000
+
+
+def get_peak_mb():
+    """Returns the peak resident memory of the process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak/2.0**20
+    return peak/2.0**10
+
+
+def measure(output_format, scene_file=None):
+    """Prints the peak memory of compiling and preparing the upload of a
+    shot, in this process."""
+    if scene_file is None:
+        ramp_data = make_scene(N_KEYS)
+    else:
+        with open(scene_file) as f:
+            ramp_data = json.load(f)
+    ramp_data['properties']['output_format'] = output_format
+    compiler = RampCompiler(ramp_data)
+    estimate = compiler.estimate_shot_size()
+    start_mb = get_peak_mb()
+    out = compiler.make_ramps()
+    task_data = [daq.get_analog_task_data(voltages)
+                 for voltages in out[2:-1:2]]
+    output_mb = sum(data.nbytes for _, data in task_data)/2.0**20
+    print('{0:>8} {1:>12.1f} {2:>12.1f} {3:>12.1f}'.format(
+        output_format, output_mb, get_peak_mb() - start_mb,
+        estimate['peak_bytes']/2.0**20))
+
+
+def measure_all(args, rampage_dir=None):
+    """Measures every output format in a fresh process, so that the peak is
+    not from an earlier shot. The rampage package is imported from
+    rampage_dir if it is given."""
+    env = dict(os.environ)
+    if rampage_dir is not None:
+        env['PYTHONPATH'] = os.pathsep.join(
+            [rampage_dir, env.get('PYTHONPATH', '')])
+    print('{0:>8} {1:>12} {2:>12} {3:>12}'.format(
+        'format', 'output (MB)', 'peak (MB)', 'estimate (MB)'))
+    for output_format in output_formats:
+        subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                               '--measure', output_format] + args, env=env)
+
+
+def export_revision(revision, temp_dir):
+    """Extracts the rampage package of the git revision into temp_dir."""
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    archive = subprocess.Popen(['git', 'archive', revision, 'rampage'],
+                               cwd=repo_dir, stdout=subprocess.PIPE)
+    subprocess.check_call(['tar', '-x', '-C', temp_dir], stdin=archive.stdout)
+    archive.stdout.close()
+    if archive.wait() != 0:
+        raise RuntimeError('git archive {0} failed'.format(revision))
+
+
+def main():
+    args = sys.argv[1:]
+    if args and args[0] == '--measure':
+        measure(*args[1:])
+        return
+    if args and args[0] == '--baseline':
+        revision, args = args[1], args[2:]
+        temp_dir = tempfile.mkdtemp()
+        try:
+            export_revision(revision, temp_dir)
+            print('baseline {0}'.format(revision))
+            measure_all(args, temp_dir)
+        finally:
+            shutil.rmtree(temp_dir)
+        print('working tree')
+    measure_all(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""Benchmark of setting up the DAQ tasks between shots.
+
+Uploads the same compiled shot repeatedly on the simulated DAQmx backend,
+once by creating every task again with daq.create_all_tasks as the server
+used to, and once with a daq.TaskManager which keeps the tasks configured
+and does not write buffers which are unchanged since the last shot. Prints
+the time per shot and the number of calls which create, configure and write
+to tasks per shot. The tasks are not run, so
+the times are the setup overhead in python; on hardware every call also costs
+a round trip to the driver.
+
+Usage:
+    python benchmarks/task_setup.py [scene.json]
+"""
+
+import json
+import os
+import sys
+import time
+
+# the repo root, after PYTHONPATH, so that rampage is found without
+# installing it
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ['RAMPAGE_DAQ_BACKEND'] = 'simulated'
+
+from rampage.cache import ShotCache
+from rampage.daq import daq, simulated
+
+from parallel_render import make_scene
+
+N_SHOTS = 20
+
+
+def recreate_tasks(out):
+    daq.reset_analog_sample_clock()
+    tasks = daq.create_all_tasks(*out)
+    for task in tasks:
+        task.ClearTask()
+
+
+def time_setup(setup, out, n_shots=N_SHOTS):
+    """Returns the time per shot and the calls per shot of setup(out)."""
+    # the first shot creates the tasks of a TaskManager
+    setup(out)
+    simulated.call_counts.clear()
+    start = time.time()
+    for _ in range(n_shots):
+        setup(out)
+    shot_time = (time.time() - start)/n_shots
+    calls = dict((name, float(count)/n_shots)
+                 for name, count in simulated.call_counts.items())
+    return shot_time, calls
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            ramp_data = json.load(f)
+    else:
+        ramp_data = make_scene()
+    simulated.record_writes = False
+    # the server takes shots from a ShotCache, whose arrays are read only
+    out = ShotCache(2**30).compile(ramp_data)
+    out = out[:-1] + ([],)
+
+    task_manager = daq.TaskManager()
+    results = [('create_all_tasks', time_setup(recreate_tasks, out)),
+               ('TaskManager', time_setup(lambda out:
+                                          task_manager.load_shot(*out), out))]
+    task_manager.close()
+
+    names = sorted(set(name for _, (_, calls) in results for name in calls))
+    print('{0:>32} {1:>16} {2:>16}'.format('', *[r[0] for r in results]))
+    print('{0:>32} {1:>16.4f} {2:>16.4f}'.format(
+        'time per shot (s)', *[r[1][0] for r in results]))
+    for name in names:
+        print('{0:>32} {1:>16.1f} {2:>16.1f}'.format(
+            name, *[r[1][1].get(name, 0.0) for r in results]))
+
+
+if __name__ == '__main__':
+    main()
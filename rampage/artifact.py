@@ -0,0 +1,170 @@
+"""Compiled shots stored in a single memory mapped file.
+
+save_shot writes the output of compiler.RampCompiler.make_ramps (digital
+words, trigger lines, device matrices and the hook schedule) to one file, and
+load_shot maps it back without copying: every array of the loaded shot is a
+read only view of a single np.memmap of the file. Pages are only read from
+disk when the samples are used, so a shot can be reloaded in milliseconds for
+replay or inspection, and shots compiled ahead do not have to fit in RAM.
+
+File layout
+-----------
+magic (8 bytes)           b'RAMPSHOT'
+header size (8 bytes)     little endian uint64
+header (header size)      JSON, see below, padded with spaces
+arrays                    raw data, each aligned to alignment bytes
+
+The header is a dict with the format version, the hook schedule and the
+layout of the items of the shot, in order. An item is
+    ['array', array_layout]
+    ['change_points', positions_layout, values_layout, n_samples]
+where array_layout is [offset, dtype, shape] and offset is from the start of
+the file. Hooks are stored by name, as in RampCompiler.make_hooks_list.
+
+Usage:
+    python -m rampage.artifact shot_file
+prints the content of shot_file.
+"""
+
+import json
+import struct
+import sys
+
+import numpy as np
+
+from rampage import ramps
+
+magic = b'RAMPSHOT'
+# 2: float64 device matrices have one row per sample
+format_version = 2
+# arrays start at multiples of alignment bytes, so that views of the memory
+# map are aligned for every dtype
+alignment = 64
+
+
+class ArtifactError(ValueError):
+
+    """Raised when a file is not a compiled shot."""
+
+    pass
+
+
+def _align(offset):
+    return -(-offset // alignment) * alignment
+
+
+def _hook_name(func):
+    # resolved hooks (see server.resolve_hooks) are methods of server.Hooks
+    return getattr(func, '__name__', func)
+
+
+def _hooks_by_name(hooks_list):
+    return [(hook_time, [(_hook_name(func), func_dict)
+                         for func, func_dict in hook_items])
+            for hook_time, hook_items in hooks_list]
+
+
+def save_shot(out, file_name):
+    """Writes out, the output of RampCompiler.make_ramps, to file_name.
+
+    The hooks of out can be names or functions resolved by
+    server.resolve_hooks. They are saved by name.
+    """
+    arrays = []
+    items = []
+    offset = [0]
+
+    def add_array(arr):
+        arr = np.ascontiguousarray(arr)
+        arrays.append((offset[0], arr))
+        array_layout = [offset[0], arr.dtype.str, list(arr.shape)]
+        offset[0] = _align(offset[0] + arr.nbytes)
+        return array_layout
+
+    for item in out[:-1]:
+        if isinstance(item, ramps.ChangePoints):
+            items.append(['change_points', add_array(item.positions),
+                          add_array(item.values), int(item.n_samples)])
+        else:
+            items.append(['array', add_array(item)])
+
+    header = json.dumps({'version': format_version, 'items': items,
+                         'hooks': _hooks_by_name(out[-1])})
+    data_start = _align(len(magic) + 8 + len(header))
+    header += ' '*(data_start - len(magic) - 8 - len(header))
+
+    with open(file_name, 'wb') as f:
+        f.write(magic)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header.encode('utf-8'))
+        for array_offset, arr in arrays:
+            f.seek(data_start + array_offset)
+            arr.tofile(f)
+
+
+def read_header(file_name):
+    """Returns the header of the shot in file_name and the offset of its
+    arrays from the start of the file."""
+    with open(file_name, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ArtifactError('{0} is not a compiled shot'.format(file_name))
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size).decode('utf-8'))
+    if header['version'] != format_version:
+        raise ArtifactError('{0} has format version {1}, expected '
+                            '{2}'.format(file_name, header['version'],
+                                         format_version))
+    return header, len(magic) + 8 + header_size
+
+
+def load_shot(file_name, mmap=True):
+    """Returns the compiled shot in file_name, the same tuple as
+    RampCompiler.make_ramps.
+
+    If mmap is True, the arrays are read only views of a memory map of the
+    file, else they are read into memory.
+    """
+    header, data_start = read_header(file_name)
+    if mmap:
+        raw = np.memmap(file_name, dtype=np.uint8, mode='r')
+    else:
+        raw = np.fromfile(file_name, dtype=np.uint8)
+
+    def get_array(array_layout):
+        array_offset, dtype, shape = array_layout
+        dtype = np.dtype(dtype)
+        start = data_start + array_offset
+        count = int(np.prod(shape))
+        if count == 0:
+            return np.zeros(shape, dtype=dtype)
+        return raw[start:start + count*dtype.itemsize].view(dtype).reshape(
+            shape)
+
+    out = []
+    for item in header['items']:
+        if item[0] == 'change_points':
+            _, positions, values, n_samples = item
+            out.append(ramps.ChangePoints(get_array(positions),
+                                          get_array(values), n_samples))
+        else:
+            out.append(get_array(item[1]))
+    hooks_list = [(hook_time, [tuple(hook) for hook in hook_items])
+                  for hook_time, hook_items in header['hooks']]
+    out.append(hooks_list)
+    return tuple(out)
+
+
+def main():
+    out = load_shot(sys.argv[1])
+    print('Digital words: {0} samples, {1} changes'.format(
+        len(out[0]), len(out[0].positions)))
+    for i in range(1, len(out) - 1, 2):
+        print('Trigger line: {0} samples, {1} changes'.format(
+            len(out[i]), len(out[i].positions)))
+        print('Device matrix: shape {0}, dtype {1}'.format(out[i + 1].shape,
+                                                           out[i + 1].dtype))
+    print('Hooks: {0}'.format(out[-1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""Cache of compiled shots, keyed by the content of the ramp description.
+
+When a ramp is queued many times, for example for repetitions of the same
+shot, it only needs to be compiled once. ShotCache stores the output of
+compiler.RampCompiler.make_ramps under a hash of the ramp description and
+evicts the least recently used shots when the total size of the stored arrays
+goes above a limit.
+"""
+
+import collections
+import hashlib
+import json
+import threading
+
+import numpy as np
+
+from rampage import ramps
+from rampage.compiler import RampCompiler, waveform_properties
+
+
+def canonical_ramp_data(ramp_data):
+    """Returns a copy of the top level of ramp_data without the entries that
+    do not change the compiled waveforms.
+
+    Keys starting with '__' (like '__version__' or '__message_id__') and
+    compiler.ignored_properties are removed.
+    """
+    canonical = dict((k, v) for k, v in ramp_data.items()
+                     if not k.startswith('__'))
+    if 'properties' in canonical:
+        canonical['properties'] = waveform_properties(
+            canonical['properties'])
+    return canonical
+
+
+def hash_ramp_data(ramp_data):
+    """Returns a hex digest which is the same for equivalent ramp data."""
+    ramp_json = json.dumps(canonical_ramp_data(ramp_data), sort_keys=True,
+                           separators=(',', ':'))
+    return hashlib.sha1(ramp_json.encode('utf-8')).hexdigest()
+
+
+def _freeze(item):
+    """Makes the arrays in item read only and returns their size in bytes.
+
+    Cached outputs are shared between shots, so they must not be modified.
+    """
+    if isinstance(item, np.ndarray):
+        item.setflags(write=False)
+        return item.nbytes
+    elif isinstance(item, ramps.ChangePoints):
+        item.positions.setflags(write=False)
+        item.values.setflags(write=False)
+        return item.nbytes
+    elif isinstance(item, (list, tuple)):
+        return sum(_freeze(elem) for elem in item)
+    else:
+        return 0
+
+
+class ShotCache(object):
+
+    """Least recently used cache of compiled shots.
+
+    max_bytes(int) - maximum total size of the arrays of cached shots. A shot
+        larger than max_bytes is compiled but not stored.
+
+    Usage
+    -----
+    shot_cache = ShotCache(512*2**20)
+    out = shot_cache.compile(ramp_data)
+
+    out is the same tuple as RampCompiler(ramp_data).make_ramps(). Its arrays
+    are read only.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # hash -> (out, n_bytes), ordered from least to most recently used
+        self._shots = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._shots)
+
+    def get(self, ramp_data, key=None):
+        """Returns the compiled shot of ramp_data, or None if not cached.
+
+        key is hash_ramp_data(ramp_data), which is computed if it is not
+        given. RampCompiler modifies ramp_data, so a shot compiled after get
+        must be put with the key of get, computed before compiling.
+        """
+        if key is None:
+            key = hash_ramp_data(ramp_data)
+        with self._lock:
+            if key not in self._shots:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry = self._shots.pop(key)
+            self._shots[key] = entry
+            return entry[0]
+
+    def put(self, ramp_data, out, key=None):
+        """Stores out as the compiled shot of ramp_data. key is as in get."""
+        if key is None:
+            key = hash_ramp_data(ramp_data)
+        n_bytes = _freeze(out)
+        with self._lock:
+            if key in self._shots:
+                self.total_bytes -= self._shots.pop(key)[1]
+            if n_bytes > self.max_bytes:
+                return
+            while self.total_bytes + n_bytes > self.max_bytes:
+                _, (_, old_bytes) = self._shots.popitem(last=False)
+                self.total_bytes -= old_bytes
+            self._shots[key] = (out, n_bytes)
+            self.total_bytes += n_bytes
+
+    def compile(self, ramp_data):
+        """Returns RampCompiler(ramp_data).make_ramps(), compiling only if the
+        shot is not in the cache."""
+        key = hash_ramp_data(ramp_data)
+        out = self.get(ramp_data, key)
+        if out is None:
+            out = RampCompiler(ramp_data).make_ramps()
+            self.put(ramp_data, out, key)
+        return out
+
+    def clear(self):
+        with self._lock:
+            self._shots.clear()
+            self.total_bytes = 0
+
+    def get_stats(self):
+        """Returns a dict with the hit and miss counts and the size of the
+        cache."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'n_shots': len(self._shots),
+                    'total_bytes': self.total_bytes,
+                    'max_bytes': self.max_bytes}
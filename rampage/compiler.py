@@ -0,0 +1,528 @@
+"""Compiles ramp descriptions into waveforms for the DAQ cards.
+
+A ramp description is parsed only once per shot. RampCompiler builds the
+keyframe graph, the sorted key list and an index of channels by hardware id,
+and all outputs (digital words, analog voltages for every device and the hook
+schedule) are generated from this shared state.
+
+Consecutive shots of a scan usually differ in a few values only. A compiler
+can be given the compiler of the previous shot, in which case only channels
+whose data or keyframe times changed are rendered again, and everything else
+is reused from the previous shot.
+"""
+
+import json
+
+import numpy as np
+
+from rampage import ramps
+from rampage.daq.settings import expt_settings
+
+
+analog_device_names = ['Dev1', 'Dev2', 'Dev3', 'Dev4']
+
+# output range (+-dac_range volts) of the analog outputs, and their resolution
+# if a device is not in ExptSettings.dac_bits
+default_dac_range = 10.0
+default_dac_bits = 16
+
+# formats of the compiled analog outputs. float64 are voltages, int16 are DAC
+# codes. Both have one row per sample and one column per channel, which is the
+# interleaved order written to the cards.
+output_formats = ('float64', 'int16')
+
+# samples converted to DAC codes at a time, so that the conversion does not
+# need a float temporary of the whole device
+code_block_samples = 2**16
+
+# properties which do not change the compiled waveforms
+ignored_properties = ('comment', 'log_ramp_file', 'wait_after_running',
+                      'run_details')
+
+
+def waveform_properties(properties):
+    """Returns the properties which change the compiled waveforms."""
+    return dict((k, v) for k, v in properties.items()
+                if k not in ignored_properties)
+
+
+def digital_channel_ids():
+    """Returns list of digital channels used in the experiment."""
+    line_fmt = 'Dev1/port0/line{0:02d}'
+    line_ids = [line_fmt.format(n) for n in range(5, 31)]
+    return line_ids
+
+
+def get_analog_ids(dev_name="Dev2"):
+    if dev_name == "Dev1":
+        n_channels = 4
+    else:
+        n_channels = 8
+    line_fmt = dev_name + "/ao{0:1d}"
+    line_ids = [line_fmt.format(n) for n in range(n_channels)]
+    return line_ids
+
+
+def estimate_shot_size(ramp_data):
+    """Returns RampCompiler(ramp_data).estimate_shot_size()."""
+    return RampCompiler(ramp_data).estimate_shot_size()
+
+
+def make_trigger_line(time_array, jump_resolution):
+    """Returns the sample clock of an analog device as ramps.ChangePoints.
+
+    The line is high for one sample at every time in time_array.
+    """
+    positions = np.unique(np.rint(time_array/jump_resolution).astype('int64'))
+    return make_trigger_line_from_ticks(positions)
+
+
+def make_trigger_line_from_ticks(positions):
+    """Returns the sample clock of an analog device as ramps.ChangePoints.
+
+    The line is high for one sample at every tick in positions, which must be
+    sorted and unique int64 ticks of jump_resolution.
+    """
+    n_samples = positions[-1] + 1
+    # high at every sample and low one sample later, unless there is another
+    # sample right there
+    n_pos = len(positions)
+    change_positions = np.concatenate(([0], positions + 1, positions))
+    values = np.concatenate(([0], np.zeros(n_pos), np.ones(n_pos)))
+    return ramps.ChangePoints.from_changes(change_positions, values,
+                                           n_samples)
+
+
+def select_codes(voltages, keep, calibration):
+    """Returns the DAC codes of the samples keep of voltages.
+
+    voltages have one row per sample and keep is an array of row indices, or
+    None for all rows. calibration are the keyword arguments of
+    ramps.voltages_to_codes. The rows are converted code_block_samples at a
+    time, straight into the int16 output.
+    """
+    n_samples = len(voltages) if keep is None else len(keep)
+    codes = np.empty((n_samples,) + voltages.shape[1:], dtype='int16')
+    for start in range(0, n_samples, code_block_samples):
+        stop = min(start + code_block_samples, n_samples)
+        if keep is None:
+            block = voltages[start:stop]
+        else:
+            block = voltages[keep[start:stop]]
+        codes[start:stop] = ramps.voltages_to_codes(block, **calibration)
+    return codes
+
+
+class RampCompiler(object):
+
+    """Generates all outputs of a ramp from a single parse of its data.
+
+    ramp_data(dict) - ramp description with "keyframes", "channels" and
+        "properties".
+    previous(RampCompiler) - compiler of a previous shot. Outputs of
+        channels which are the same in both shots are reused from it. If the
+        properties of the shots differ, nothing is reused.
+
+    Usage
+    -----
+    compiler = RampCompiler(ramp_data)
+    digital_words = compiler.make_digital_ramps()
+    trigger_line, voltages = compiler.make_analog_ramps("Dev2")
+
+    or, to get every output at once
+
+    RampCompiler(ramp_data).make_ramps()
+
+    and for the next shot of a scan
+
+    RampCompiler(next_ramp_data, previous=compiler).make_ramps()
+    """
+
+    def __init__(self, ramp_data, previous=None):
+        self.ramp_data = ramp_data
+        self.properties = ramp_data['properties']
+        self.jump_resolution = self.properties['jump_resolution']
+        self.ramp_resolution = self.properties['ramp_resolution']
+
+        self.key_frame_list = ramps.KeyFrameList(ramp_data['keyframes'])
+        self.sorted_key_list = self.key_frame_list.sorted_key_list()
+        # build the cached key positions before channels are rendered, which
+        # may happen in several threads
+        self.key_frame_list.get_key_positions()
+        # every time of the compiled waveforms is an int64 number of ticks of
+        # jump_resolution
+        self.key_ticks = self.key_frame_list.get_key_ticks(
+            self.jump_resolution)
+        self.channel_list = [ramps.Channel(ch_name, ch_dct,
+                                           self.key_frame_list)
+                             for ch_name, ch_dct in
+                             ramp_data['channels'].items()]
+
+        # if more than one channel has the same id, the first one wins
+        self.channels_by_id = {}
+        for ch in self.channel_list:
+            if ch.dct['id'] not in self.channels_by_id:
+                self.channels_by_id[ch.dct['id']] = ch
+
+        self.absolute_times = dict((key_name,
+                                    self.key_frame_list.get_absolute_time(
+                                        key_name))
+                                   for key_name in self.sorted_key_list)
+        self.end_time = self.absolute_times[self.sorted_key_list[-1]]
+        self.channel_fingerprints = dict((ch.ch_name, json.dumps(
+            ch.dct, sort_keys=True)) for ch in self.channel_list)
+
+        # rendered outputs, which the compiler of the next shot can reuse.
+        # digital_lines maps channel names to ramps.ChangePoints and
+        # analog_devices maps device names to tuples
+        # (grid, channel_names, sample_ticks, voltages, trigger_line,
+        #  output_voltages). sample_ticks and voltages are on the full grid,
+        # output_voltages may have fewer samples, see get_tolerances.
+        self.digital_lines = {}
+        self.analog_devices = {}
+        # maps device names to tuples (n_grid_samples, n_output_samples)
+        self.sample_counts = {}
+
+        # samples where no DAC code changes are dropped, unless the ramp sets
+        # "deduplicate_samples" to false
+        self.deduplicate_samples = self.properties.get('deduplicate_samples',
+                                                       True)
+        self.output_format = self.properties.get('output_format', 'float64')
+        if self.output_format not in output_formats:
+            raise ValueError('Unknown output_format {0}, should be one of '
+                             '{1}'.format(self.output_format, output_formats))
+
+        # only keep the outputs of previous, so that compilers of a long scan
+        # do not hold on to each other
+        self.changed_channels = None
+        self._previous_digital_lines = {}
+        self._previous_analog_devices = {}
+        if (previous is not None and
+                waveform_properties(previous.properties) ==
+                waveform_properties(self.properties)):
+            self.changed_channels = self._find_changed_channels(previous)
+            if previous.end_time == self.end_time:
+                self._previous_digital_lines = previous.digital_lines
+            self._previous_analog_devices = previous.analog_devices
+
+    def _find_changed_channels(self, previous):
+        """Returns the names of channels which have to be rendered again.
+
+        A channel is rendered again if its data changed, or if the absolute
+        time of any of its keyframes changed. The absolute time of a keyframe
+        changes with its own time or the time of any of its ancestors.
+        """
+        all_keys = set(self.absolute_times) | set(previous.absolute_times)
+        changed_keys = set(key_name for key_name in all_keys
+                           if self.absolute_times.get(key_name) !=
+                           previous.absolute_times.get(key_name))
+        changed_channels = set()
+        for ch in self.channel_list:
+            if (self.channel_fingerprints[ch.ch_name] !=
+                    previous.channel_fingerprints.get(ch.ch_name)):
+                changed_channels.add(ch.ch_name)
+            elif not changed_keys.isdisjoint(ch.dct['keys']):
+                changed_channels.add(ch.ch_name)
+        return changed_channels
+
+    def _is_reusable(self, ch):
+        return (self.changed_channels is not None and
+                ch.ch_name not in self.changed_channels)
+
+    def get_digital_channels(self):
+        """Returns digital channels sorted by line number."""
+        return [self.channels_by_id[ch_id] for ch_id in digital_channel_ids()
+                if ch_id in self.channels_by_id]
+
+    def get_analog_channels(self, dev_name="Dev2"):
+        """Returns analog channels of dev_name sorted by output number."""
+        return [self.channels_by_id[ch_id] for ch_id in get_analog_ids(dev_name)
+                if ch_id in self.channels_by_id]
+
+    def make_digital_ramps(self):
+        """Returns the words of the digital port as ramps.ChangePoints."""
+        # The channels used are Dev1/port0/line5:31
+        dig_channels = self.get_digital_channels()
+
+        parts = []
+        for line_number, dig_ch in zip(range(5, 31), dig_channels):
+            if (self._is_reusable(dig_ch) and
+                    dig_ch.ch_name in self._previous_digital_lines):
+                change_points = self._previous_digital_lines[dig_ch.ch_name]
+            else:
+                change_points = dig_ch.get_digital_change_points(
+                    self.jump_resolution)
+            self.digital_lines[dig_ch.ch_name] = change_points
+            parts.append((change_points, line_number))
+        return ramps.merge_change_points(parts)
+
+    def make_analog_ramps(self, dev_name="Dev2"):
+        return self.make_analog_devices([dev_name])[0]
+
+    def _plan_analog_device(self, dev_name):
+        """Returns a dict describing what has to be rendered for dev_name.
+
+        If the time grid and the channels of the device are the same as in
+        the previous shot, only the rows of changed channels are rendered
+        and the rest is reused.
+        """
+        an_channels = self.get_analog_channels(dev_name)
+        channel_names = [an_ch.ch_name for an_ch in an_channels]
+        ramp_regions = self.get_ramp_regions(an_channels)
+
+        # the time grid of the device depends on the ticks of all keyframes
+        # and on the resolutions of the regions where its channels ramp
+        grid = (tuple(self.key_ticks), ramp_regions)
+        plan = {'dev_name': dev_name, 'channels': an_channels,
+                'channel_names': channel_names, 'ramp_regions': ramp_regions,
+                'grid': grid, 'previous': None,
+                'tolerances': self.get_tolerances(an_channels)}
+        sample_ticks, kf_positions = ramps.make_sample_ticks(
+            self.key_ticks, ramp_regions, self.jump_resolution,
+            self.ramp_resolution)
+        plan['sample_ticks'] = sample_ticks
+        plan['kf_positions'] = kf_positions
+        plan['time_array'] = sample_ticks*self.jump_resolution
+        previous = self._previous_analog_devices.get(dev_name)
+        if (previous is not None and previous[0] == grid and
+                previous[1] == channel_names):
+            plan['previous'] = previous
+            plan['rows'] = [row for row, an_ch in enumerate(an_channels)
+                            if not self._is_reusable(an_ch)]
+        else:
+            plan['rows'] = range(len(an_channels))
+        return plan
+
+    def get_ramp_regions(self, an_channels):
+        """Returns, for every region between keyframes, the sorted tuple of
+        the resolutions of the channels in an_channels which ramp in it.
+
+        The device samples a region on the union of their grids, or only at
+        its start if the tuple is empty, see ramps.make_sample_ticks.
+        """
+        region_resolutions = [set() for _ in self.sorted_key_list[1:]]
+        for an_ch in an_channels:
+            resolutions = an_ch.get_ramp_resolutions(self.ramp_resolution)
+            for region, resolution in enumerate(resolutions):
+                if resolution:
+                    region_resolutions[region].add(resolution)
+        return tuple(tuple(sorted(resolutions))
+                     for resolutions in region_resolutions)
+
+    def estimate_shot_size(self):
+        """Returns the size of the compiled shot without rendering it.
+
+        Only the keyframes and the ramp regions are used, so this takes time
+        proportional to the number of keyframes and channels. Returns a dict
+        with
+            devices - maps device names to dicts with n_channels, n_samples
+                (samples on the grid of the device) and n_trigger_edges.
+                Tolerances and deduplication can only remove samples, so
+                these are upper bounds of the samples uploaded.
+            n_digital_samples - number of words of the digital port.
+            n_hooks - number of hooks.
+            sample_rate - rate of the digital sample clock in Hz, which is
+                also the highest rate of the analog outputs.
+            peak_bytes - estimate of the memory needed to compile and upload
+                the shot: the rendered voltages and sample ticks of every
+                device, its DAC codes, its output if samples are dropped and
+                the expanded digital words. The voltages are rendered in the
+                interleaved order of the cards, so they are written without
+                a copy.
+        """
+        n_digital_samples = int(self.key_ticks[-1]) + 1
+        devices = {}
+        peak_bytes = 4*n_digital_samples
+        if self.output_format == 'int16':
+            output_itemsize = 2
+        else:
+            output_itemsize = 8
+        for dev_name in analog_device_names:
+            an_channels = self.get_analog_channels(dev_name)
+            n_samples = 1
+            for region, resolutions in enumerate(
+                    self.get_ramp_regions(an_channels)):
+                if resolutions:
+                    n_samples += ramps.count_region_ticks(
+                        self.key_ticks[region], self.key_ticks[region + 1],
+                        resolutions, self.jump_resolution)
+                else:
+                    n_samples += 1
+            n_channels = len(an_channels)
+            devices[dev_name] = {'n_channels': n_channels,
+                                 'n_samples': n_samples,
+                                 'n_trigger_edges': n_samples}
+            # sample ticks and time array, then per channel: voltages, codes
+            # and the output with the samples which are kept
+            peak_bytes += n_samples*(16 + n_channels*(8 + 2 +
+                                                      output_itemsize))
+        n_hooks = sum(len(list(hook_items)) for _, hook_items
+                      in self.key_frame_list.get_hooks_list())
+        return {'devices': devices, 'n_digital_samples': n_digital_samples,
+                'n_hooks': n_hooks,
+                'sample_rate': 1e3/self.jump_resolution,
+                'peak_bytes': peak_bytes}
+
+    def get_dac_calibration(self, dev_name):
+        """Returns the keyword arguments of ramps.voltages_to_codes for
+        dev_name.
+
+        The resolution of each card is in ExptSettings.dac_bits. The
+        "dac_range" and "dac_bits" properties apply to all devices. The
+        "dac_calibration" property can override them for each device, e.g.
+        {"Dev2": {"dac_range": 10.0, "dac_bits": 12,
+                  "coefficients": [c0, c1, c2, c3]}}
+        """
+        dac_bits = expt_settings.dac_bits.get(dev_name, default_dac_bits)
+        calibration = {
+            'dac_range': self.properties.get('dac_range', default_dac_range),
+            'dac_bits': self.properties.get('dac_bits', dac_bits),
+            'coefficients': None}
+        dev_calibration = self.properties.get('dac_calibration', {})
+        calibration.update(dev_calibration.get(dev_name, {}))
+        return calibration
+
+    def get_tolerances(self, an_channels):
+        """Returns the tolerance in volts of every channel in an_channels, or
+        None if no channel may deviate from its exact waveform.
+
+        The tolerance of a channel is its "tolerance" entry, or the
+        "ramp_tolerance" property of the ramp if it has none.
+        """
+        default_tolerance = self.properties.get('ramp_tolerance', 0.0)
+        tolerances = [an_ch.dct.get('tolerance', default_tolerance)
+                      for an_ch in an_channels]
+        if not any(tolerances):
+            return None
+        return tolerances
+
+    def _render_analog_row(self, plan_row):
+        """Renders a channel into its column of the voltages of the device."""
+        plan, row = plan_row
+        plan['channels'][row].get_analog_voltages(
+            plan['time_array'], plan['kf_positions'],
+            out=plan['voltages'][:, row])
+
+    def _finish_analog_device(self, plan):
+        """Returns the trigger line and the output of the device."""
+        previous = plan['previous']
+        if previous is not None and not plan['rows']:
+            # nothing changed on this device
+            return previous[4], previous[5]
+        # the rows of the samples which are kept, None for all of them.
+        # voltages have one row per sample, so they are selected once at the
+        # end, which gives the interleaved output without another copy
+        sample_ticks, voltages = plan['sample_ticks'], plan['voltages']
+        keep = None
+        if plan['tolerances'] is not None:
+            keep = ramps.select_held_samples(voltages.T, plan['tolerances'])
+
+        codes = None
+        if self.output_format == 'int16' or self.deduplicate_samples:
+            codes = select_codes(voltages, keep,
+                                 self.get_dac_calibration(plan['dev_name']))
+        if self.deduplicate_samples and codes.size:
+            changed = ramps.select_changed_samples(codes.T)
+            if len(changed) < len(codes):
+                if self.output_format == 'int16':
+                    codes = codes[changed]
+                keep = changed if keep is None else keep[changed]
+
+        if keep is not None:
+            sample_ticks = sample_ticks[keep]
+        if self.output_format == 'int16':
+            output = codes
+        elif keep is None:
+            output = voltages
+        else:
+            output = voltages[keep]
+        if (previous is not None and plan['tolerances'] is None and
+                not self.deduplicate_samples):
+            # same grid as before, so the same trigger line
+            return previous[4], output
+        return make_trigger_line_from_ticks(sample_ticks), output
+
+    def make_analog_devices(self, dev_names, pool=None):
+        """Returns a list of (trigger_line, voltages) for every device in
+        dev_names.
+
+        pool is an optional pool of workers, like a
+        multiprocessing.pool.ThreadPool, which renders the channel rows and
+        trigger lines of all devices in parallel.
+
+        If any channel of a device has a tolerance (see get_tolerances), the
+        device only gets the samples which are needed to stay within the
+        tolerances, see ramps.select_held_samples. Then samples where no DAC
+        code changes are dropped, see ramps.select_changed_samples. For
+        float64 output, the codes are computed with get_dac_calibration and
+        not the calibration of the card, so this only keeps the output to
+        within one LSB. The number of samples before and after is stored in
+        sample_counts.
+        """
+        map_func = map if pool is None else pool.map
+        plans = [self._plan_analog_device(dev_name) for dev_name in dev_names]
+        # the channels are rendered straight into the interleaved buffer of
+        # their device, see _render_analog_row
+        for plan in plans:
+            if plan['previous'] is not None:
+                voltage_array = plan['previous'][3]
+                if plan['rows']:
+                    # the previous voltages may be shared, never modify them
+                    voltage_array = voltage_array.copy()
+            else:
+                voltage_array = np.empty((len(plan['sample_ticks']),
+                                          len(plan['channels'])))
+            plan['voltages'] = voltage_array
+        plan_rows = [(plan, row) for plan in plans for row in plan['rows']]
+        map_func(self._render_analog_row, plan_rows)
+
+        out = map_func(self._finish_analog_device, plans)
+        for plan, (trigger_line, voltages) in zip(plans, out):
+            self.analog_devices[plan['dev_name']] = (
+                plan['grid'], plan['channel_names'], plan['sample_ticks'],
+                plan['voltages'], trigger_line, voltages)
+            self.sample_counts[plan['dev_name']] = (len(plan['sample_ticks']),
+                                                    len(voltages))
+        return out
+
+    def make_hooks_list(self):
+        """Returns the hook schedule of the ramp.
+
+        Each element is a tuple (time, hooks), where time is in seconds and
+        hooks is a list of (hook_name, hook_dict) tuples. Refer to
+        server.Hooks for details.
+        """
+        hooks_list = []
+        for abs_time, hook_items in self.key_frame_list.get_hooks_list():
+            # ramps have time in ms, convert to s
+            hooks_list.append((abs_time*1e-3, list(hook_items)))
+        return hooks_list
+
+    def make_ramps(self, pool=None):
+        """Returns the digital words, trigger lines and voltages of all analog
+        devices and the hook schedule.
+
+        The digital words and trigger lines are ramps.ChangePoints, the
+        voltages are arrays with one row per sample and one column per
+        channel, the interleaved order written to the cards. If the
+        "output_format" property is "int16", the voltages are DAC codes
+        instead, see get_dac_calibration.
+
+        pool is an optional multiprocessing.pool.ThreadPool. The digital port,
+        the rows of every analog device and the trigger lines are then
+        rendered in parallel. They only read the keyframes and channels, and
+        most of their time is spent in numpy, which releases the GIL.
+        """
+        if pool is None:
+            digital_words = self.make_digital_ramps()
+        else:
+            digital_result = pool.apply_async(self.make_digital_ramps)
+        analog_out = self.make_analog_devices(analog_device_names, pool)
+        if pool is not None:
+            digital_words = digital_result.get()
+
+        out = [digital_words]
+        for trigger_line, voltages in analog_out:
+            out.extend((trigger_line, voltages))
+        out.append(self.make_hooks_list())
+        return tuple(out)
@@ -0,0 +1,426 @@
+"""Safe, compiled conversion expressions for analog channels.
+
+A conversion maps the value of an analog channel, x, to the voltage that is
+sent to the DAQ card. It can also depend on the time t (in ms). Conversions
+are written as expressions, for example
+
+    5.1913-x*0.12931
+    sqrt(x)*2.0 + 0.1*t/1000.0
+    interp(x, [0.0, 1.0, 2.0], [0.0, 0.45, 1.2])
+
+Expressions are parsed once into an abstract syntax tree, which is checked
+against a whitelist of nodes, names and functions, and then compiled to a
+vectorized callable. Compiled conversions are cached by expression string.
+
+interp(x, xp, fp) is a calibration lookup table: the measured curve xp -> fp is
+linearly interpolated with np.interp. xp and fp must be lists of numbers of the
+same length and xp must be monotonic (increasing or decreasing).
+
+The same expressions describe the shape of "expr" ramps, see
+compile_ramp_expression. If numexpr is installed, ramp expressions which only
+use functions numexpr knows are evaluated by numexpr, in blocks and with
+several threads, without temporary arrays for every operation. Otherwise they
+are evaluated by numpy, with a temporary array for every operation.
+"""
+
+import ast
+import operator
+
+import numpy as np
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+
+class ConversionError(ValueError):
+
+    """Raised when a conversion expression is not valid."""
+
+    pass
+
+
+# names of the variables of a conversion
+variable_names = ('x', 't')
+
+# names of the variables of a ramp expression: the time t, the start and end
+# times of the segment t0, t1 and the values at its start and end v0, v1
+ramp_variable_names = ('t', 't0', 't1', 'v0', 'v1')
+
+constants = {'pi': np.pi, 'e': np.e}
+
+functions = {
+    'abs': np.abs,
+    'sqrt': np.sqrt,
+    'exp': np.exp,
+    'log': np.log,
+    'log10': np.log10,
+    'sin': np.sin,
+    'cos': np.cos,
+    'tan': np.tan,
+    'arcsin': np.arcsin,
+    'arccos': np.arccos,
+    'arctan': np.arctan,
+    'sinh': np.sinh,
+    'cosh': np.cosh,
+    'tanh': np.tanh,
+    'minimum': np.minimum,
+    'maximum': np.maximum,
+    'clip': np.clip,
+    'interp': np.interp,
+}
+
+# modules whose functions can also be called as module.function, like np.sqrt
+module_names = ('np', 'numpy')
+
+# functions which numexpr evaluates like numpy
+numexpr_functions = ('abs', 'sqrt', 'exp', 'log', 'log10', 'sin', 'cos', 'tan',
+                     'arcsin', 'arccos', 'arctan', 'sinh', 'cosh', 'tanh')
+
+_binary_operators = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Pow, ast.Mod)
+_unary_operators = (ast.UAdd, ast.USub)
+
+# largest magnitude of a constant exponent. Python folds powers of number
+# literals when it compiles an expression, so 9**9**9 would never finish.
+max_power_exponent = 100
+
+_operator_functions = {ast.Add: operator.add, ast.Sub: operator.sub,
+                       ast.Mult: operator.mul, ast.Div: operator.truediv,
+                       ast.Pow: operator.pow, ast.Mod: operator.mod,
+                       ast.UAdd: operator.pos, ast.USub: operator.neg}
+
+_conversion_cache = {}
+_ramp_expression_cache = {}
+
+
+def _is_number(node):
+    if isinstance(node, ast.Num):
+        return True
+    # negative numbers in calibration tables
+    return (isinstance(node, ast.UnaryOp) and
+            isinstance(node.op, _unary_operators) and
+            isinstance(node.operand, ast.Num))
+
+
+def _number_value(node):
+    if isinstance(node, ast.Num):
+        return float(node.n)
+    value = float(node.operand.n)
+    if isinstance(node.op, ast.USub):
+        value = -value
+    return value
+
+
+def _constant_value(node):
+    """Returns the float value of a node made only of numbers and
+    operators, or None if it uses a name or cannot be evaluated."""
+    try:
+        if isinstance(node, ast.Num):
+            try:
+                return float(node.n)
+            except OverflowError:
+                # an integer literal with hundreds of digits
+                return float('inf')
+        if isinstance(node, ast.UnaryOp):
+            operand = _constant_value(node.operand)
+            if operand is None:
+                return None
+            return _operator_functions[type(node.op)](operand)
+        if isinstance(node, ast.BinOp):
+            left = _constant_value(node.left)
+            right = _constant_value(node.right)
+            if left is None or right is None:
+                return None
+            return _operator_functions[type(node.op)](left, right)
+    except (TypeError, ValueError, ZeroDivisionError, OverflowError):
+        pass
+    return None
+
+
+def _function_name(node):
+    """Returns the whitelisted function name called by an ast.Call node."""
+    func = node.func
+    if isinstance(func, ast.Name):
+        name = func.id
+    elif (isinstance(func, ast.Attribute) and
+          isinstance(func.value, ast.Name) and
+          func.value.id in module_names):
+        name = func.attr
+    else:
+        raise ConversionError('Only functions can be called in conversions')
+    if name not in functions:
+        raise ConversionError('Unknown function {0}'.format(name))
+    if (node.keywords or getattr(node, 'starargs', None) is not None or
+            getattr(node, 'kwargs', None) is not None):
+        raise ConversionError('Keyword and star arguments are not allowed')
+    return name
+
+
+def _make_table(node, expr):
+    """Returns a float array from a list node of a calibration table."""
+    if not isinstance(node, (ast.List, ast.Tuple)):
+        raise ConversionError('Calibration tables of interp must be lists of '
+                              'numbers in {0}'.format(expr))
+    if not all(_is_number(elt) for elt in node.elts):
+        raise ConversionError('Calibration tables of interp must be lists of '
+                              'numbers in {0}'.format(expr))
+    return np.array([_number_value(elt) for elt in node.elts])
+
+
+class _Compiler(ast.NodeTransformer):
+
+    """Checks an expression tree against the whitelist.
+
+    names are the variables the expression can use. Calibration tables are
+    replaced by names of float arrays, which are stored in self.tables, so
+    that they are only built once. The names of the variables and functions
+    used by the expression are collected in self.used_names and
+    self.used_functions.
+    """
+
+    def __init__(self, expr, names=variable_names):
+        self.expr = expr
+        self.names = names
+        self.tables = {}
+        self.used_names = set()
+        self.used_functions = set()
+
+    def generic_visit(self, node):
+        raise ConversionError('{0} is not allowed in conversion '
+                              '{1}'.format(type(node).__name__, self.expr))
+
+    def visit_Expression(self, node):
+        node.body = self.visit(node.body)
+        return node
+
+    def visit_Num(self, node):
+        return node
+
+    def visit_Name(self, node):
+        if node.id not in self.names and node.id not in constants:
+            raise ConversionError('Unknown name {0} in conversion '
+                                  '{1}'.format(node.id, self.expr))
+        self.used_names.add(node.id)
+        return node
+
+    def visit_BinOp(self, node):
+        if not isinstance(node.op, _binary_operators):
+            raise ConversionError('Operator {0} is not allowed in conversion '
+                                  '{1}'.format(type(node.op).__name__,
+                                               self.expr))
+        node.left = self.visit(node.left)
+        node.right = self.visit(node.right)
+        if isinstance(node.op, ast.Pow):
+            self._check_power(node)
+        return node
+
+    def _check_power(self, node):
+        exponent = _constant_value(node.right)
+        if exponent is None:
+            return
+        if abs(exponent) > max_power_exponent:
+            raise ConversionError('Exponent {0} is larger than {1} in '
+                                  'conversion {2}'.format(
+                                      exponent, max_power_exponent,
+                                      self.expr))
+        base = _constant_value(node.left)
+        if base is None:
+            return
+        try:
+            too_large = np.isinf(base**exponent)
+        except OverflowError:
+            too_large = True
+        except (ValueError, ZeroDivisionError):
+            # left to fail when the expression is evaluated, like 0.0**-1
+            too_large = False
+        if too_large:
+            raise ConversionError('Power {0}**{1} is too large in conversion '
+                                  '{2}'.format(base, exponent, self.expr))
+
+    def visit_UnaryOp(self, node):
+        if not isinstance(node.op, _unary_operators):
+            raise ConversionError('Operator {0} is not allowed in conversion '
+                                  '{1}'.format(type(node.op).__name__,
+                                               self.expr))
+        node.operand = self.visit(node.operand)
+        return node
+
+    def visit_Call(self, node):
+        name = _function_name(node)
+        self.used_functions.add(name)
+        # call the function by its plain name, np.sqrt -> sqrt
+        node.func = ast.copy_location(ast.Name(id=name, ctx=ast.Load()),
+                                      node.func)
+        if name == 'interp':
+            node.args = self._visit_interp_args(node.args)
+        else:
+            node.args = [self.visit(arg) for arg in node.args]
+        return node
+
+    def _visit_interp_args(self, args):
+        if len(args) != 3:
+            raise ConversionError('interp takes 3 arguments, interp(x, xp, '
+                                  'fp), in conversion {0}'.format(self.expr))
+        xp = _make_table(args[1], self.expr)
+        fp = _make_table(args[2], self.expr)
+        if len(xp) != len(fp) or len(xp) < 2:
+            raise ConversionError('Calibration tables of interp must have the '
+                                  'same length of at least 2 in conversion '
+                                  '{0}'.format(self.expr))
+        diff = np.diff(xp)
+        if np.all(diff < 0.0):
+            # np.interp needs increasing xp
+            xp, fp = xp[::-1], fp[::-1]
+        elif not np.all(diff > 0.0):
+            raise ConversionError('Calibration table {0} of interp is not '
+                                  'monotonic in conversion '
+                                  '{1}'.format(list(xp), self.expr))
+        table_names = []
+        for table in (xp, fp):
+            table_name = '_table{0}'.format(len(self.tables))
+            self.tables[table_name] = table
+            table_names.append(ast.copy_location(
+                ast.Name(id=table_name, ctx=ast.Load()), args[1]))
+        return [self.visit(args[0])] + table_names
+
+
+def _compile(expr, names=variable_names):
+    """Checks expr and returns the compiled code, the namespace to evaluate
+    it in and the _Compiler which checked it."""
+    try:
+        tree = ast.parse(expr.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ConversionError('Could not parse conversion {0}: '
+                              '{1}'.format(expr, e))
+    compiler = _Compiler(expr, names)
+    tree = ast.fix_missing_locations(compiler.visit(tree))
+    code = compile(tree, '<conversion>', 'eval')
+
+    namespace = {'__builtins__': {}}
+    namespace.update(constants)
+    namespace.update(functions)
+    namespace.update(compiler.tables)
+    return code, namespace, compiler
+
+
+def _can_use_numexpr(expr, compiler):
+    """Returns True if numexpr is installed and can evaluate expr, which
+    was checked by compiler."""
+    return (numexpr is not None and
+            compiler.used_functions.issubset(numexpr_functions) and
+            'np.' not in expr and 'numpy.' not in expr)
+
+
+def compile_conversion(expr):
+    """Returns a function f(x, t, out=None) that evaluates the conversion
+    expr.
+
+    x and t can be numbers or numpy arrays. If out is given, the result is
+    stored in it, broadcast to its shape, and out is returned. out can be x.
+    Raises ConversionError if expr is not a valid conversion. The compiled
+    function is cached by expr.
+    """
+    try:
+        return _conversion_cache[expr]
+    except KeyError:
+        pass
+
+    code, namespace, compiler = _compile(expr)
+    use_numexpr = _can_use_numexpr(expr, compiler)
+    uses_x = 'x' in compiler.used_names
+
+    def conversion(x, t, out=None):
+        local_vars = {'x': x, 't': t}
+        if out is None:
+            return eval(code, namespace, local_vars)
+        if use_numexpr and uses_x and np.shape(x) == out.shape:
+            # numexpr writes directly into out, in blocks
+            numexpr.evaluate(expr, local_dict=local_vars,
+                             global_dict=constants, out=out,
+                             casting='unsafe')
+        else:
+            out[...] = eval(code, namespace, local_vars)
+        return out
+
+    _conversion_cache[expr] = conversion
+    return conversion
+
+
+def check_conversion(expr):
+    """Returns None if expr is a valid conversion, or the error string."""
+    try:
+        compile_conversion(expr)
+    except ConversionError as e:
+        return str(e)
+    return None
+
+
+def convert(expr, x, t, out=None):
+    """Evaluates the conversion expr and returns an array shaped like x.
+
+    If out is given, the result is stored in it and out is returned. With
+    out=x, x is converted in place, and the identity conversion 'x' does
+    nothing.
+    """
+    if out is not None:
+        if expr.strip() == 'x':
+            if out is not x:
+                out[...] = x
+            return out
+        return compile_conversion(expr)(x, t, out)
+    out = compile_conversion(expr)(x, t)
+    if np.shape(out) != np.shape(x):
+        # conversions that do not depend on x, like '0.0'
+        out = out + np.zeros_like(x, dtype=float)
+    return out
+
+
+def compile_ramp_expression(expr, parameter_names=()):
+    """Returns a function f(variables, out) that evaluates the ramp
+    expression expr into the float array out.
+
+    expr can use the names in ramp_variable_names and parameter_names.
+    variables is a dict with a value for each of them, where t is an array
+    with the shape of out and the others are numbers. Raises ConversionError
+    if expr is not valid. The compiled function is cached by expr and
+    parameter_names.
+    """
+    parameter_names = tuple(sorted(parameter_names))
+    key = (expr, parameter_names)
+    try:
+        return _ramp_expression_cache[key]
+    except KeyError:
+        pass
+
+    code, namespace, compiler = _compile(expr, ramp_variable_names +
+                                         parameter_names)
+    use_numexpr = _can_use_numexpr(expr, compiler)
+    # numexpr writes directly into out when the result is an array
+    numexpr_out = 't' in compiler.used_names
+
+    def ramp_expression(variables, out):
+        if use_numexpr:
+            if numexpr_out:
+                numexpr.evaluate(expr, local_dict=variables,
+                                 global_dict=constants, out=out,
+                                 casting='unsafe')
+            else:
+                out[...] = numexpr.evaluate(expr, local_dict=variables,
+                                            global_dict=constants)
+        else:
+            out[...] = eval(code, namespace, variables)
+        return out
+
+    _ramp_expression_cache[key] = ramp_expression
+    return ramp_expression
+
+
+def check_ramp_expression(expr, parameter_names=()):
+    """Returns None if expr is a valid ramp expression, or the error
+    string."""
+    try:
+        compile_ramp_expression(expr, parameter_names)
+    except ConversionError as e:
+        return str(e)
+    return None
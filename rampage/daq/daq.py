@@ -1,28 +1,24 @@
-import PyDAQmx as pydaq
+import collections
 import ctypes
 import numpy as np
 import logging
+import multiprocessing.pool
+import os
+import threading
+import time
 
+from rampage import ramps
+from rampage.daq.settings import expt_settings
 
-class ExptSettings(object):
-    external_clock_line = "/Dev1/PFI8"
-    max_expected_rate = 500000  # Hz
-    dev2_clock_line = "/Dev1/PFI3"
-    dev3_clock_line = "/Dev1/PFI4"
-    dev4_clock_line = "/Dev1/PFI6"
-    dev1_clock_line = "/Dev1/PFI5"
-    dev2_clock_out = 31
-    dev2_clock_out_name = "Dev1/port0/line31"
-    dev3_clock_out = 27
-    dev3_clock_out_name = "Dev1/port0/line27"
-    dev4_clock_out = 7
-    dev4_clock_out_name = "Dev1/port0/line7"
-    dev1_clock_out = 12
-    dev1_clock_out_name = "Dev1/port0/line12"
-    callback_resolution = 10e-3  # (ms)
-    ext_clock_frequency = 250e3  # (Hz)
+# set RAMPAGE_DAQ_BACKEND=simulated to run without NI hardware
+if os.environ.get('RAMPAGE_DAQ_BACKEND') == 'simulated':
+    from rampage.daq import simulated as pydaq
+else:
+    import PyDAQmx as pydaq
 
-expt_settings = ExptSettings()
+
+# lines of the digital task of a shot, including the clock out lines
+digital_task_lines = "Dev1/port0/line5:31"
 
 
 def print_device_info(dev_name):
@@ -102,6 +98,113 @@ def set_digital_line_state(line_name, state):
     # create_digital_output_task(line_name, dig_data)
 
 
+class ChunkedWriter(object):
+    """Writes the samples of a running task in chunks.
+
+    Arguments
+    ---------
+
+    chunks (iterator) - yields tuples (n_samples, data), where data is what
+        the write function of the task takes for n_samples samples.
+
+    n_samples (int) - total number of samples per channel of the task.
+
+    buffer_samples (int) - size of the output buffer of the task, in samples
+        per channel. At most this many samples are written ahead of the
+        samples already generated.
+
+    Usage
+    -----
+    The task calls writer.configure(task) before it starts, and
+    writer.refill(task) from its EveryNCallback. task.WriteSamples(n, data)
+    writes a chunk.
+    """
+
+    def __init__(self, chunks, n_samples, buffer_samples):
+        self.chunks = iter(chunks)
+        self.n_samples = n_samples
+        self.buffer_samples = buffer_samples
+        self.n_written = 0
+        self.next_chunk = None
+        self.underrun = False
+
+    def configure(self, task):
+        task.CfgOutputBuffer(self.buffer_samples)
+        task.SetWriteRegenMode(pydaq.DAQmx_Val_DoNotAllowRegen)
+        self.write_available(task, 0)
+
+    def refill(self, task):
+        """Writes as many chunks as there is space for in the buffer."""
+        generated = pydaq.uInt64()
+        task.GetWriteTotalSampPerChanGenerated(ctypes.byref(generated))
+        n_generated = generated.value
+        if n_generated >= self.n_written and self.n_written < self.n_samples:
+            if not self.underrun:
+                logging.error('Output buffer underrun after {0} of {1} '
+                              'samples'.format(n_generated, self.n_samples))
+            self.underrun = True
+        self.write_available(task, n_generated)
+
+    def is_complete(self):
+        """Returns True if every sample of the task was written."""
+        return self.n_written >= self.n_samples
+
+    def write_available(self, task, n_generated):
+        while True:
+            if self.next_chunk is None:
+                self.next_chunk = next(self.chunks, None)
+                if self.next_chunk is None:
+                    return
+            n_chunk, data = self.next_chunk
+            if self.n_written + n_chunk - n_generated > self.buffer_samples:
+                return
+            task.WriteSamples(n_chunk, data)
+            self.n_written += n_chunk
+            self.next_chunk = None
+
+
+def get_stream_chunk_samples(n_samples, multiple_of=1):
+    """Returns the chunk size to stream a task of n_samples samples, or None
+    if the task should not be streamed.
+
+    The chunk size is rounded up to a multiple of multiple_of, which should be
+    the number of samples between EveryNCallbacks of the task.
+    """
+    chunk_samples = expt_settings.stream_chunk_samples
+    if chunk_samples is None:
+        return None
+    if n_samples <= expt_settings.stream_buffer_samples:
+        return None
+    return -(-chunk_samples // multiple_of) * multiple_of
+
+
+def is_read_only(data):
+    """Returns True if the samples of data, an array or ramps.ChangePoints,
+    cannot be modified, like the outputs stored in a cache.ShotCache."""
+    if isinstance(data, ramps.ChangePoints):
+        return not (data.positions.flags.writeable or
+                    data.values.flags.writeable)
+    return not data.flags.writeable
+
+
+def same_change_points(cp, other):
+    """Returns True if the ramps.ChangePoints cp and other expand to the same
+    samples. Compares the change points, not the expanded samples."""
+    if cp is other:
+        return True
+    if cp is None or other is None:
+        return False
+    return (cp.n_samples == other.n_samples and
+            np.array_equal(cp.positions, other.positions) and
+            np.array_equal(cp.values, other.values))
+
+
+def iter_digital_chunks(digital_data, chunk_samples):
+    """Yields (n_samples, samples) of digital_data in chunks."""
+    for chunk in digital_data.iter_chunks(chunk_samples):
+        yield len(chunk), chunk
+
+
 class DigitalOutputTask(pydaq.Task):
     """A digital output task.
 
@@ -113,8 +216,9 @@ class DigitalOutputTask(pydaq.Task):
         see http://zone.ni.com/reference/en-XX/help/370466W-01/mxcncpts/physchannames/
         for details of naming lines.
 
-    digital_data (numpy.array of uint32) -
-        The length of the array is the number of samples
+    digital_data (numpy.array of uint32 or ramps.ChangePoints) -
+        The length of the array is the number of samples. ChangePoints are
+        expanded to one element per sample only when the task is configured.
 
     name_for_lines(str) - optional name to refer to the lines specified.
 
@@ -132,6 +236,8 @@ class DigitalOutputTask(pydaq.Task):
 
     DigitalOutputTask(...).StartAndWait()
 
+    A stopped task can output other data without being created again:
+    set digital_data, call WriteData() and start the task again.
     """
 
     def __init__(self, lines, digital_data, name_for_lines=None,
@@ -142,22 +248,72 @@ class DigitalOutputTask(pydaq.Task):
         self.lines = lines
         self.name_for_lines = name_for_lines
         self.ext_clock_line = ext_clock_line
+        # samples between calls of EveryNCallback, None if they are not
+        # registered. Only then can the task be streamed.
+        self.n_wait = None
+        self.writer = None
+        # sample count the timing of the task is configured for
+        self.n_samples = None
+        self.streamed = False
+        # samples in the buffer, see TaskManager
+        self.loaded_data = None
 
         if auto_configure:
             self.ConfigureTask()
 
     def ConfigureTask(self):
-        n_written = pydaq.int32()
-        n_dig_samples = len(self.digital_data)
+        self.CreateChannels()
+        self.WriteData()
+
+    def CreateChannels(self):
         self.CreateDOChan(self.lines, self.name_for_lines,
                           pydaq.DAQmx_Val_ChanForAllLines)
-        self.CfgSampClkTiming(self.ext_clock_line,
-                              expt_settings.max_expected_rate,
-                              pydaq.DAQmx_Val_Rising,
-                              pydaq.DAQmx_Val_FiniteSamps, n_dig_samples)
-        self.WriteDigitalU32(n_dig_samples, False, -1,
+
+    def WriteData(self):
+        """Writes digital_data to the stopped task, or its first chunks if it
+        is streamed. The timing and the buffer are only configured again if
+        the number of samples or the streaming changed."""
+        digital_data = self.digital_data
+        n_dig_samples = len(digital_data)
+        reused = self.n_samples is not None
+        resized = n_dig_samples != self.n_samples
+        if resized:
+            self.CfgSampClkTiming(self.ext_clock_line,
+                                  expt_settings.max_expected_rate,
+                                  pydaq.DAQmx_Val_Rising,
+                                  pydaq.DAQmx_Val_FiniteSamps, n_dig_samples)
+            self.n_samples = n_dig_samples
+        chunk_samples = None
+        if (self.n_wait is not None and
+                isinstance(digital_data, ramps.ChangePoints)):
+            chunk_samples = get_stream_chunk_samples(n_dig_samples,
+                                                     self.n_wait)
+        if chunk_samples is not None:
+            # expanded chunk by chunk while the task runs
+            buffer_samples = max(expt_settings.stream_buffer_samples,
+                                 2*chunk_samples)
+            self.writer = ChunkedWriter(
+                iter_digital_chunks(digital_data, chunk_samples),
+                n_dig_samples, buffer_samples)
+            self.writer.configure(self)
+            self.streamed = True
+        else:
+            self.writer = None
+            if reused and (resized or self.streamed):
+                # the buffer of the last shot does not fit
+                if self.streamed:
+                    self.SetWriteRegenMode(pydaq.DAQmx_Val_AllowRegen)
+                self.CfgOutputBuffer(n_dig_samples)
+            self.streamed = False
+            if isinstance(digital_data, ramps.ChangePoints):
+                digital_data = digital_data.expand()
+            self.WriteSamples(n_dig_samples, digital_data)
+
+    def WriteSamples(self, n_samples, digital_data):
+        n_written = pydaq.int32()
+        self.WriteDigitalU32(n_samples, False, -1,
                              pydaq.DAQmx_Val_GroupByChannel,
-                             self.digital_data, ctypes.byref(n_written),
+                             digital_data, ctypes.byref(n_written),
                              None)
         # print('Digital n_written', n_written.value)
 
@@ -173,6 +329,13 @@ class DigitalOutputTask(pydaq.Task):
         self.IsTaskDone(ctypes.byref(done))
         return done.value
 
+    def Unreserve(self):
+        """Releases the lines of the stopped task, so that another task can
+        use them. This also releases the buffer of the task, so the data
+        must be written again before the task is started."""
+        self.TaskControl(pydaq.DAQmx_Val_Task_Unreserve)
+        self.loaded_data = None
+
 
 class DigitalOutputTaskWithCallbacks(DigitalOutputTask):
     """A digital output task.
@@ -185,7 +348,7 @@ class DigitalOutputTaskWithCallbacks(DigitalOutputTask):
         see http://zone.ni.com/reference/en-XX/help/370466W-01/mxcncpts/physchannames/
         for details of naming lines.
 
-    digital_data (numpy.array of uint32) -
+    digital_data (numpy.array of uint32 or ramps.ChangePoints) -
         The length of the array is the number of samples
 
     name_for_lines(str) - optional name to refer to the lines specified.
@@ -204,6 +367,8 @@ class DigitalOutputTaskWithCallbacks(DigitalOutputTask):
 
     DigitalOutputTask(...).StartAndWait()
 
+    A stopped task is loaded with the next shot with
+    dig_chn.LoadShot(digital_data, callback_function_list).
     """
 
     def __init__(self, lines, digital_data, callback_function_list=None,
@@ -216,18 +381,26 @@ class DigitalOutputTaskWithCallbacks(DigitalOutputTask):
         n_wait = int(expt_settings.ext_clock_frequency *
                      expt_settings.callback_resolution)
         self.n_wait = n_wait
+        # set by DoneCallback, so that the server can wait for it
+        self.done_event = threading.Event()
+        self.SetShot(digital_data, callback_function_list)
+
+        # DAQmx only registers the events of a task with channels, and a
+        # streamed task writes its first chunks when the data is written
+        self.CreateChannels()
+        self.RegisterCallbacks()
+        self.WriteData()
+
+    def SetShot(self, digital_data, callback_function_list):
+        """Resets the state of the callbacks for a new shot."""
         self.n_callbacks = 0
         # pad the digital data. For callbacks to work, the total number of
         # samples to write should be a multiple of the number of samples to wait
         # before a callback. Hence we append the last value of the digital data
         # to itlsef until the length is a multiple
-        digital_data = self.padDigitalData(digital_data, n_wait)
-        self.digital_data = digital_data
-
-        self.ConfigureTask()
-        self.RegisterCallbacks()
-
+        self.digital_data = self.padDigitalData(digital_data, self.n_wait)
         self.is_task_done = False
+        self.done_event.clear()
 
         # configure callbacks
         if callback_function_list is None:
@@ -246,6 +419,10 @@ class DigitalOutputTaskWithCallbacks(DigitalOutputTask):
 
             self.callback_function_list = callback_function_list
 
+    def LoadShot(self, digital_data, callback_function_list=None):
+        """Writes the next shot to the stopped task."""
+        self.SetShot(digital_data, callback_function_list)
+        self.WriteData()
 
     def RegisterCallbacks(self):
         self.AutoRegisterEveryNSamplesEvent(pydaq.DAQmx_Val_Transferred_From_Buffer,
@@ -260,6 +437,9 @@ class DigitalOutputTaskWithCallbacks(DigitalOutputTask):
         l0 = len(dig_data)
         if l0 % n == 0:
             return dig_data  # no need of padding
+        elif isinstance(dig_data, ramps.ChangePoints):
+            # the last value holds until the end anyway
+            return dig_data.resized(l0 + n - (l0 % n))
         else:
             ladd = n - (l0 % n)
             dig_data_add = np.zeros(ladd, dtype="uint32")
@@ -269,6 +449,8 @@ class DigitalOutputTaskWithCallbacks(DigitalOutputTask):
     def EveryNCallback(self):
         """Called by PyDAQmx whenever a callback event occurs."""
         # print('ncall ', self.n_callbacks)
+        if self.writer is not None:
+            self.writer.refill(self)
         if self.do_callbacks:
             if self.n_callbacks >= self.callback_step:
                 # print('n_callbacks', self.n_callbacks)
@@ -294,9 +476,18 @@ class DigitalOutputTaskWithCallbacks(DigitalOutputTask):
     def DoneCallback(self, status):
         """Called whenever the task is done."""
         logging.info('Done Callback called')
+        if status != 0:
+            logging.error('Digital task stopped with error {0}'.format(status))
+        if self.writer is not None and not self.writer.is_complete():
+            self.writer.underrun = True
         self.is_task_done = True
+        self.done_event.set()
         return 0  # The function should return an integer
 
+    def expected_duration(self):
+        """Returns the time the task takes to output its samples, in s."""
+        return len(self.digital_data)/expt_settings.ext_clock_frequency
+
 
 class ContinuousAnalogOutputTask(pydaq.Task):
     def __init__(self, analog_lines, analog_data, n_samples, sample_rate,
@@ -334,11 +525,13 @@ class FiniteAnalogOutputTask(pydaq.Task):
         see http://zone.ni.com/reference/en-XX/help/370466W-01/mxcncpts/physchannames/
         for details of naming lines.
 
-    analog_data (numpy.array of float64) -
+    analog_data (numpy.array of float64 or int16) -
         The length of the array is n_samples * n_channels
         The data should be formatted in a certain way. For example, if you have
         two channels A and B, and 5 samples, the ordering of the data is -
         A0, B0, A1, B1,..., A4, B4.
+        float64 data are voltages. int16 data are DAC codes, which are
+        written to the card as they are, see ramps.voltages_to_codes.
 
     name_for_lines(str) - optional name to refer to the lines specified.
 
@@ -350,8 +543,10 @@ class FiniteAnalogOutputTask(pydaq.Task):
                  name_for_channel=None,
                  clock_line=expt_settings.dev2_clock_line):
         pydaq.Task.__init__(self)
-
-        n_written = pydaq.int32()
+        self.clock_line = clock_line
+        self.n_samples = n_samples
+        # samples in the buffer, see TaskManager
+        self.loaded_data = None
 
         self.CreateAOVoltageChan(analog_lines, None, -10.0, 10.0,
                                  pydaq.DAQmx_Val_Volts, None)
@@ -359,49 +554,396 @@ class FiniteAnalogOutputTask(pydaq.Task):
                               pydaq.DAQmx_Val_Rising,
                               pydaq.DAQmx_Val_FiniteSamps,
                               n_samples)
-        self.WriteAnalogF64(n_samples, False, -1,
-                            pydaq.DAQmx_Val_GroupByScanNumber, analog_data,
-                            ctypes.byref(n_written), None)
+        if analog_data is not None:
+            self.WriteSamples(n_samples, analog_data)
+
+    def SetSampleCount(self, n_samples):
+        """Configures the timing of the stopped task for n_samples samples, if
+        it is configured for another count. Returns True if it was."""
+        if n_samples == self.n_samples:
+            return False
+        self.CfgSampClkTiming(self.clock_line, expt_settings.max_expected_rate,
+                              pydaq.DAQmx_Val_Rising,
+                              pydaq.DAQmx_Val_FiniteSamps,
+                              n_samples)
+        self.n_samples = n_samples
+        return True
+
+    def LoadVoltages(self, voltages):
+        """Writes the output of compiler.RampCompiler for the device to the
+        stopped task, see get_analog_task_data."""
+        n_samples, analog_data = get_analog_task_data(voltages)
+        if self.SetSampleCount(n_samples):
+            self.CfgOutputBuffer(n_samples)
+        self.WriteSamples(n_samples, analog_data)
+
+    def WriteSamples(self, n_samples, analog_data):
+        n_written = pydaq.int32()
+        if analog_data.dtype == np.int16:
+            self.WriteBinaryI16(n_samples, False, -1,
+                                pydaq.DAQmx_Val_GroupByScanNumber,
+                                analog_data, ctypes.byref(n_written), None)
+        else:
+            self.WriteAnalogF64(n_samples, False, -1,
+                                pydaq.DAQmx_Val_GroupByScanNumber, analog_data,
+                                ctypes.byref(n_written), None)
         # print('Analog n_written', n_written.value)
 
 
+def create_analog_task(analog_lines, voltages, clock_line):
+    """Returns a FiniteAnalogOutputTask with the output of
+    compiler.RampCompiler for an analog device written to it."""
+    n_samples, analog_data = get_analog_task_data(voltages)
+    return FiniteAnalogOutputTask(analog_lines, analog_data, n_samples,
+                                  clock_line=clock_line)
+
+
+def get_ao_scaling_coefficients(analog_line):
+    """Returns the calibration polynomial of an analog output.
+
+    The coefficients c0, c1, c2... convert volts to DAC codes,
+    code = c0 + c1*V + c2*V**2 + ... Put them in the "dac_calibration"
+    property of a ramp to compile DAC codes which are the same as the
+    hardware would compute, see compiler.RampCompiler.get_dac_calibration.
+
+    Usage:
+    get_ao_scaling_coefficients("Dev2/ao0")
+    """
+    task = pydaq.Task()
+    try:
+        task.CreateAOVoltageChan(analog_line, None, -10.0, 10.0,
+                                 pydaq.DAQmx_Val_Volts, None)
+        coefficients = (pydaq.float64*4)()
+        task.GetAODevScalingCoeff(analog_line, coefficients, len(coefficients))
+    finally:
+        task.ClearTask()
+    return list(coefficients)
+
+
+def get_analog_task_data(voltages):
+    """Returns the number of samples and the data to write for the output
+    of compiler.RampCompiler for an analog device.
+
+    The compiler renders the voltages or DAC codes of a device with one row
+    per sample, so they are already interleaved and are written without a
+    copy.
+    """
+    return voltages.shape[0], voltages.ravel()
+
+
 def create_all_tasks(digital_data, dev1_trigger_line, dev1_voltages,
                      dev2_trigger_line, dev2_voltages,
                      dev3_trigger_line, dev3_voltages,
                      dev4_trigger_line, dev4_voltages, callback_list):
 
 
-    # create Dev1 Analog Task
-    _, n_dev1_samples = dev1_voltages.shape
-    dev1_task = FiniteAnalogOutputTask("Dev1/ao0:3", dev1_voltages.T.flatten(),
-                                       n_dev1_samples,
-                                       clock_line=expt_settings.dev1_clock_line)
+    analog_tasks = [create_analog_task(lines, voltages, clock_line)
+                    for (lines, clock_line), voltages in
+                    zip(get_analog_task_lines(),
+                        [dev1_voltages, dev2_voltages, dev3_voltages,
+                         dev4_voltages])]
+
+    digital_data = merge_digital_data(digital_data, dev1_trigger_line,
+                                      dev2_trigger_line, dev3_trigger_line,
+                                      dev4_trigger_line)
+    digital_task = DigitalOutputTaskWithCallbacks(digital_task_lines,
+                                                  digital_data, callback_list)
 
-    # create Dev2 Task
-    _, n_dev2_samples = dev2_voltages.shape
-    dev2_task = FiniteAnalogOutputTask("Dev2/ao0:7", dev2_voltages.T.flatten(),
-                                       n_dev2_samples,
-                                       clock_line=expt_settings.dev2_clock_line)
+    return tuple(analog_tasks) + (digital_task,)
 
-    _, n_dev3_samples = dev3_voltages.shape
-    dev3_task = FiniteAnalogOutputTask("Dev3/ao0:7", dev3_voltages.T.flatten(),
-                                       n_dev3_samples,
-                                       clock_line=expt_settings.dev3_clock_line)
 
-    _, n_dev4_samples = dev4_voltages.shape
-    dev4_task = FiniteAnalogOutputTask("Dev4/ao0:5", dev4_voltages.T.flatten(),
-                                       n_dev4_samples,
-                                       clock_line=expt_settings.dev4_clock_line)
+def get_analog_task_lines():
+    """Returns a list of (analog_lines, clock_line) of the analog task of
+    Dev1 to Dev4."""
+    return [("Dev1/ao0:3", expt_settings.dev1_clock_line),
+            ("Dev2/ao0:7", expt_settings.dev2_clock_line),
+            ("Dev3/ao0:7", expt_settings.dev3_clock_line),
+            ("Dev4/ao0:5", expt_settings.dev4_clock_line)]
 
-    digital_data += dev1_trigger_line*(2**expt_settings.dev1_clock_out)
-    digital_data += dev2_trigger_line*(2**expt_settings.dev2_clock_out)
-    digital_data += dev3_trigger_line*(2**expt_settings.dev3_clock_out)
-    digital_data += dev4_trigger_line*(2**expt_settings.dev4_clock_out)
 
-    digital_task = DigitalOutputTaskWithCallbacks("Dev1/port0/line5:31",
-                                                  digital_data, callback_list)
+def merge_digital_data(digital_data, dev1_trigger_line, dev2_trigger_line,
+                       dev3_trigger_line, dev4_trigger_line):
+    """Returns the words of the digital task, with the trigger lines of the
+    analog devices on their clock out lines."""
+    # digital_data and the trigger lines are ramps.ChangePoints. They are
+    # expanded to one word per sample when the digital task is configured.
+    return ramps.merge_change_points(
+        [(digital_data, 0),
+         (dev1_trigger_line, expt_settings.dev1_clock_out),
+         (dev2_trigger_line, expt_settings.dev2_clock_out),
+         (dev3_trigger_line, expt_settings.dev3_clock_out),
+         (dev4_trigger_line, expt_settings.dev4_clock_out)])
+
+
+class ClockResetTask(DigitalOutputTask):
+    """Sets the clock out lines of the analog devices, like
+    reset_analog_sample_clock, with a single task which is kept to be run
+    before every shot.
+
+    Usage
+    -----
+    clock_reset_task = ClockResetTask()
+    clock_reset_task.Reset()
+    """
+
+    def __init__(self, state=False):
+        self.state = bool(state)
+        DigitalOutputTask.__init__(self, ','.join(self.get_lines()),
+                                   self.get_data(self.state))
+        self.Unreserve()
+
+    def get_lines(self):
+        return [expt_settings.dev1_clock_out_name,
+                expt_settings.dev2_clock_out_name,
+                expt_settings.dev3_clock_out_name,
+                expt_settings.dev4_clock_out_name]
+
+    def get_data(self, state):
+        bits = sum(2**int(line_name.split('line')[-1])
+                   for line_name in self.get_lines())
+        # 2 samples, the minimum for a buffered write
+        return np.ones(2, dtype="uint32")*bool(state)*bits
+
+    def Reset(self, state=False):
+        """Sets the clock lines to state and releases them."""
+        self.state = bool(state)
+        self.digital_data = self.get_data(self.state)
+        # the buffer was released with the lines
+        self.WriteData()
+        self.StartTask()
+        self.WaitUntilTaskDone(pydaq.DAQmx_Val_WaitInfinitely)
+        self.StopTask()
+        self.Unreserve()
+
+
+class TaskManager(object):
+    """Keeps the tasks of the analog devices and the digital task configured
+    between shots.
+
+    Creating the tasks of a shot with create_all_tasks creates channels,
+    configures the timing and registers the callbacks every time. The task
+    manager only stops the tasks of the last shot, reconfigures the timing of
+    the tasks whose number of samples changed and rewrites their buffers.
+    The tasks are only created for the first shot. The clock lines are reset
+    with a single ClockResetTask which is also kept.
+
+    In scans, most devices usually output the same samples as in the last
+    shot. The buffer of a task which is not streamed is only written if its
+    samples changed, otherwise the task is just restarted and regenerates its
+    buffer. No sample is compared for this: all buffers are kept if load_shot
+    gets the shot_hash of the last shot, see cache.hash_ramp_data. Otherwise
+    an analog buffer is kept if its voltages are the read only array of the
+    last shot, which the compiler returns for devices without changed
+    channels, see compiler.RampCompiler, and the digital buffer is kept if
+    the change points of its words did not change. The digital task is
+    unreserved after every shot, so that the clock lines can be reset, which
+    releases its buffer, so in practice it is always written. A streamed
+    digital task empties its buffer while it runs, so it is always written
+    too. The words of the digital task are only merged again if the digital
+    lines or a trigger line are not the change points of the last shot.
+
+    The cards are independent, so the tasks of each card are loaded on a
+    thread of their own, and all of them are started once every card is
+    loaded. The digital task, which clocks the analog tasks, is started last.
+
+    upload_threads(int) - number of cards loaded at the same time. With 1,
+        the cards are loaded one after another.
+
+    Usage
+    -----
+    task_manager = TaskManager()
+    tasks = task_manager.load_shot(*RampCompiler(ramp_data).make_ramps(),
+                                   shot_hash=hash_ramp_data(ramp_data))
+    task_manager.start()
+    ...
+    task_manager.close()
+
+    tasks is the same tuple as create_all_tasks returns. After load_shot,
+    task_manager.upload_times has the time it took to load each task.
+    """
 
-    return dev1_task, dev2_task, dev3_task, dev4_task, digital_task
+    def __init__(self, upload_threads=1):
+        self.analog_tasks = [None]*len(get_analog_task_lines())
+        self.digital_task = None
+        self.clock_reset_task = None
+        # tasks created and reused by the last call of load_shot, and writes
+        # skipped because the buffer of a task was unchanged
+        self.n_created = 0
+        self.n_reused = 0
+        self.n_skipped = 0
+        # task name -> seconds it took to load it in the last call of
+        # load_shot, see get_task_names
+        self.upload_times = {}
+        # shot_hash of the shot in the buffers, None if it is not known
+        self.last_shot_hash = None
+        # (parts, words) of the digital task of the last shot, see
+        # get_digital_words
+        self.last_digital_words = ((), None)
+        if upload_threads > 1:
+            self.upload_pool = multiprocessing.pool.ThreadPool(upload_threads)
+        else:
+            self.upload_pool = None
+
+    def get_tasks(self):
+        return tuple(self.analog_tasks) + (self.digital_task,)
+
+    def get_task_names(self):
+        """Returns the names of the tasks of get_tasks."""
+        return ([lines.split('/')[0] for lines, _ in get_analog_task_lines()] +
+                ['Digital'])
+
+    def load_shot(self, digital_data, dev1_trigger_line, dev1_voltages,
+                  dev2_trigger_line, dev2_voltages,
+                  dev3_trigger_line, dev3_voltages,
+                  dev4_trigger_line, dev4_voltages, callback_list,
+                  shot_hash=None):
+        """Stops the last shot, resets the clock lines and writes the shot to
+        the tasks. Returns the tasks, see create_all_tasks.
+
+        shot_hash - cache.hash_ramp_data of the shot, if it is known. No
+            buffer is written if it is the shot_hash of the last shot.
+        """
+        same_shot = (shot_hash is not None and
+                     shot_hash == self.last_shot_hash)
+        # the buffers are not known to hold a shot until all of them are
+        # loaded
+        self.last_shot_hash = None
+        self.stop()
+        if self.clock_reset_task is None:
+            self.clock_reset_task = ClockResetTask()
+        self.clock_reset_task.Reset()
+
+        all_voltages = [dev1_voltages, dev2_voltages, dev3_voltages,
+                        dev4_voltages]
+        # functions which load a task and return whether it was 'created',
+        # 'reused' or 'skipped', grouped by card
+        card_loads = collections.OrderedDict()
+        for i, (lines, clock_line) in enumerate(get_analog_task_lines()):
+            card_loads.setdefault(lines.split('/')[0], []).append(
+                (self.get_task_names()[i],
+                 lambda i=i, lines=lines, clock_line=clock_line:
+                 self.load_analog_task(i, lines, all_voltages[i],
+                                       clock_line, same_shot)))
+
+        def load_digital():
+            merged_data = self.get_digital_words(
+                digital_data, dev1_trigger_line, dev2_trigger_line,
+                dev3_trigger_line, dev4_trigger_line)
+            return self.load_digital_task(merged_data, callback_list,
+                                          same_shot)
+        card_loads.setdefault(digital_task_lines.split('/')[0], []).append(
+            ('Digital', load_digital))
+
+        if self.upload_pool is None:
+            results = map(load_card, card_loads.values())
+        else:
+            results = self.upload_pool.map(load_card, card_loads.values())
+        results = [result for card_results in results
+                   for result in card_results]
+        self.upload_times = dict((name, upload_time)
+                                 for name, upload_time, _ in results)
+        statuses = [status for _, _, status in results]
+        self.n_created = statuses.count('created')
+        self.n_reused = len(statuses) - self.n_created
+        self.n_skipped = statuses.count('skipped')
+        self.last_shot_hash = shot_hash
+        return self.get_tasks()
+
+    def get_digital_words(self, *parts):
+        """Returns merge_digital_data(*parts), without merging them again if
+        they are the read only change points of the last shot."""
+        last_parts, last_words = self.last_digital_words
+        if (len(parts) == len(last_parts) and
+                all(part is last_part and is_read_only(part)
+                    for part, last_part in zip(parts, last_parts))):
+            return last_words
+        words = merge_digital_data(*parts)
+        self.last_digital_words = (parts, words)
+        return words
+
+    def load_digital_task(self, digital_data, callback_list,
+                          same_shot=False):
+        """Loads the digital task with digital_data, creating it if it does
+        not exist. Its buffer is kept if same_shot is True."""
+        task = self.digital_task
+        if task is None:
+            task = DigitalOutputTaskWithCallbacks(
+                digital_task_lines, digital_data, callback_list)
+            self.digital_task = task
+            status = 'created'
+        elif task.loaded_data is not None and (
+                same_shot or same_change_points(digital_data,
+                                                task.loaded_data)):
+            task.SetShot(digital_data, callback_list)
+            status = 'skipped'
+        else:
+            task.LoadShot(digital_data, callback_list)
+            status = 'reused'
+        task.loaded_data = None if task.streamed else digital_data
+        return status
+
+    def load_analog_task(self, index, lines, voltages, clock_line,
+                         same_shot=False):
+        """Loads the task of analog device index with voltages, creating it
+        if it does not exist. Its buffer is kept if same_shot is True."""
+        task = self.analog_tasks[index]
+        if task is None:
+            task = create_analog_task(lines, voltages, clock_line)
+            status = 'created'
+        elif same_shot or (voltages is task.loaded_data and
+                           is_read_only(voltages)):
+            status = 'skipped'
+        else:
+            task.LoadVoltages(voltages)
+            status = 'reused'
+        task.loaded_data = voltages
+        self.analog_tasks[index] = task
+        return status
+
+    def start(self):
+        """Starts the analog tasks, which wait for their clock, in order, and
+        then the digital task."""
+        for task in self.analog_tasks:
+            task.StartTask()
+        self.digital_task.StartTask()
+
+    def stop(self):
+        """Stops the tasks and releases the lines of the digital task, so that
+        the clock lines can be reset."""
+        for task in self.get_tasks():
+            if task is not None:
+                task.StopTask()
+        if self.digital_task is not None:
+            self.digital_task.Unreserve()
+
+    def clear(self):
+        """Clears all tasks."""
+        for task in self.get_tasks() + (self.clock_reset_task,):
+            if task is not None:
+                task.ClearTask()
+        self.analog_tasks = [None]*len(self.analog_tasks)
+        self.digital_task = None
+        self.clock_reset_task = None
+        self.last_shot_hash = None
+        self.last_digital_words = ((), None)
+
+    def close(self):
+        """Clears all tasks and stops the upload threads."""
+        self.clear()
+        if self.upload_pool is not None:
+            self.upload_pool.close()
+            self.upload_pool = None
+
+
+def load_card(loads):
+    """Calls the functions of loads, a list of (task_name, load_function),
+    and returns a list of (task_name, seconds, result)."""
+    results = []
+    for task_name, load in loads:
+        start_time = time.time()
+        status = load()
+        results.append((task_name, time.time() - start_time, status))
+    return results
 
 
 def p24_pulse_train(n_samples=100):
@@ -0,0 +1,36 @@
+"""Settings of the DAQ cards of the experiment.
+
+These are kept apart from daq.py, which needs the NI-DAQmx driver, so that
+the compiler and the server can read them on any computer.
+"""
+
+
+class ExptSettings(object):
+    external_clock_line = "/Dev1/PFI8"
+    max_expected_rate = 500000  # Hz
+    dev2_clock_line = "/Dev1/PFI3"
+    dev3_clock_line = "/Dev1/PFI4"
+    dev4_clock_line = "/Dev1/PFI6"
+    dev1_clock_line = "/Dev1/PFI5"
+    dev2_clock_out = 31
+    dev2_clock_out_name = "Dev1/port0/line31"
+    dev3_clock_out = 27
+    dev3_clock_out_name = "Dev1/port0/line27"
+    dev4_clock_out = 7
+    dev4_clock_out_name = "Dev1/port0/line7"
+    dev1_clock_out = 12
+    dev1_clock_out_name = "Dev1/port0/line12"
+    callback_resolution = 10e-3  # (ms)
+    ext_clock_frequency = 250e3  # (Hz)
+    # The digital task is streamed if it has more samples than
+    # stream_buffer_samples: only stream_buffer_samples are written before the
+    # start, and the rest is expanded and written in chunks of
+    # stream_chunk_samples while the task runs. None writes every sample
+    # before the start.
+    stream_chunk_samples = None
+    stream_buffer_samples = 4*250000
+    # resolution of the analog outputs of each card. Dev1 is a PCI 6229,
+    # Dev2 and Dev3 are PCI 6713. Dev4 is taken to be a PCI 6713 too.
+    dac_bits = {'Dev1': 16, 'Dev2': 12, 'Dev3': 12, 'Dev4': 12}
+
+expt_settings = ExptSettings()
@@ -0,0 +1,330 @@
+"""A simulated stand-in for PyDAQmx, to run the DAQ code without NI hardware.
+
+rampage.daq.daq uses this module instead of PyDAQmx when the environment
+variable RAMPAGE_DAQ_BACKEND is set to "simulated".
+
+Only the parts of PyDAQmx used by rampage are provided. A simulated task
+generates samples in a thread at the rate given to CfgSampClkTiming, scaled by
+the module level speed_up. It calls EveryNCallback every N samples transferred
+from the buffer and DoneCallback when it is done, like DAQmx does. If the
+samples written run out before the task is done, the task stops with the
+underrun error of DAQmx, error_underrun.
+
+Every written sample is kept in Task.written_data when record_writes is True,
+so that tests can compare what a task would have output with the compiled
+shot. Like DAQmx, a stopped task can be started again: it restarts from the
+first sample, and the first write after StopTask replaces the samples in the
+buffer. Unreserving a task releases its buffer, so it must be written again
+before it is started.
+
+call_counts counts the calls which create, configure and write to tasks, by
+function name ('Task' for a new task), to benchmark the setup of tasks between
+shots.
+
+Usage:
+    import os
+    os.environ['RAMPAGE_DAQ_BACKEND'] = 'simulated'
+    from rampage.daq import daq
+"""
+
+import collections
+import ctypes
+import threading
+import time
+
+import numpy as np
+
+from rampage.daq.settings import expt_settings
+
+int32 = ctypes.c_int32
+uInt32 = ctypes.c_uint32
+uInt64 = ctypes.c_uint64
+bool32 = ctypes.c_uint32
+float64 = ctypes.c_double
+
+DAQmx_Val_Volts = 10348
+DAQmx_Val_Rising = 10280
+DAQmx_Val_FiniteSamps = 10178
+DAQmx_Val_ContSamps = 10123
+DAQmx_Val_GroupByChannel = 0
+DAQmx_Val_GroupByScanNumber = 1
+DAQmx_Val_ChanForAllLines = 1
+DAQmx_Val_WaitInfinitely = -1.0
+DAQmx_Val_Transferred_From_Buffer = 2
+DAQmx_Val_AllowRegen = 10097
+DAQmx_Val_DoNotAllowRegen = 10158
+DAQmx_Val_Task_Unreserve = 5
+
+DAQmx_Dev_ProductType = 0x0631
+DAQmx_Dev_SerialNum = 0x0632
+DAQmx_Dev_AO_PhysicalChans = 0x231E
+DAQmx_Dev_CI_PhysicalChans = 0x2324
+DAQmx_Dev_CO_PhysicalChans = 0x2325
+DAQmx_Dev_DO_Lines = 0x2326
+
+# DAQmx error when a task has no samples left to output
+error_underrun = -200290
+
+# how much faster than real time the simulated tasks run
+speed_up = 1.0
+# keep a copy of every written sample in Task.written_data
+record_writes = True
+# devices reported by DAQmxGetSysDevNames
+device_names = ['Dev1', 'Dev2', 'Dev3', 'Dev4']
+# number of calls of the functions which create, configure and write to tasks
+call_counts = collections.Counter()
+
+
+class DAQError(Exception):
+
+    """Raised like PyDAQmx.DAQError when a call fails."""
+
+    def __init__(self, error, mess, fname):
+        Exception.__init__(self, '{0} in {1}: {2}'.format(error, fname,
+                                                          mess))
+        self.error = error
+        self.mess = mess
+        self.fname = fname
+
+
+def _set_ref(ref, value):
+    """Sets the value of a ctypes.byref() argument."""
+    if ref is not None:
+        ref._obj.value = value
+
+
+def DAQmxGetSysDevNames(data, buffer_size):
+    data.value = ', '.join(device_names)
+    return 0
+
+
+def DAQmxGetDeviceAttribute(device, attribute, value):
+    value.value = 'Simulated'
+    return 0
+
+
+class Task(object):
+
+    """Simulated PyDAQmx.Task."""
+
+    def __init__(self):
+        call_counts['Task'] += 1
+        self.channels = []
+        self.rate = None
+        self.n_samples = 0
+        self.finite = True
+        self.buffer_samples = None
+        self.allow_regen = True
+        self.written_data = []
+        self.n_written = 0
+        self.n_generated = 0
+        self.every_n_samples = None
+        self.register_done = False
+        self.error = 0
+        self.running = False
+        # the next write replaces the samples in the buffer
+        self.rewrite = False
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    # configuration
+
+    def CreateDOChan(self, lines, name_to_assign_to_lines, line_grouping):
+        call_counts['CreateDOChan'] += 1
+        self.channels.append(lines)
+        return 0
+
+    def CreateAOVoltageChan(self, physical_channel, name_to_assign_to_channel,
+                            min_val, max_val, units, custom_scale_name):
+        call_counts['CreateAOVoltageChan'] += 1
+        self.channels.append(physical_channel)
+        return 0
+
+    def CfgSampClkTiming(self, source, rate, active_edge, sample_mode,
+                         samps_per_chan):
+        call_counts['CfgSampClkTiming'] += 1
+        self.rate = float(rate)
+        self.finite = sample_mode == DAQmx_Val_FiniteSamps
+        self.n_samples = int(samps_per_chan)
+        return 0
+
+    def CfgDigEdgeStartTrig(self, trigger_source, trigger_edge):
+        call_counts['CfgDigEdgeStartTrig'] += 1
+        return 0
+
+    def CfgOutputBuffer(self, num_samps_per_chan):
+        call_counts['CfgOutputBuffer'] += 1
+        self.buffer_samples = int(num_samps_per_chan)
+        return 0
+
+    def SetWriteRegenMode(self, mode):
+        call_counts['SetWriteRegenMode'] += 1
+        self.allow_regen = mode == DAQmx_Val_AllowRegen
+        return 0
+
+    def AutoRegisterEveryNSamplesEvent(self, every_n_samples_event_type,
+                                       n_samples, options):
+        call_counts['AutoRegisterEveryNSamplesEvent'] += 1
+        self._check_channels('AutoRegisterEveryNSamplesEvent')
+        self.every_n_samples = int(n_samples)
+        return 0
+
+    def AutoRegisterDoneEvent(self, options):
+        call_counts['AutoRegisterDoneEvent'] += 1
+        self._check_channels('AutoRegisterDoneEvent')
+        self.register_done = True
+        return 0
+
+    def _check_channels(self, fname):
+        # like DAQmx, events can only be registered once there is a channel
+        if not self.channels:
+            raise DAQError(-200478, 'Task contains no channels', fname)
+
+    def GetAODevScalingCoeff(self, channel, data, array_size):
+        # an ideal DAC with a range of +-10 V
+        dac_bits = expt_settings.dac_bits.get(channel.split('/')[0], 16)
+        data[0] = 0.0
+        data[1] = 2**(dac_bits - 1)/10.0
+        return 0
+
+    # writing
+
+    def _write(self, num_samps_per_chan, data, samps_per_chan_written):
+        num_samps_per_chan = int(num_samps_per_chan)
+        with self.lock:
+            if self.rewrite:
+                self.rewrite = False
+                self.written_data = []
+                self.n_written = 0
+            if self.buffer_samples is not None:
+                space = (self.buffer_samples -
+                         (self.n_written - self.n_generated))
+                if num_samps_per_chan > space:
+                    raise DAQError(-200292, 'Not enough space in the buffer',
+                                   'Write')
+            if record_writes:
+                self.written_data.append(np.array(data, copy=True))
+            self.n_written += num_samps_per_chan
+        _set_ref(samps_per_chan_written, num_samps_per_chan)
+        return 0
+
+    def WriteDigitalU32(self, num_samps_per_chan, auto_start, timeout,
+                        data_layout, write_array, samps_per_chan_written,
+                        reserved):
+        call_counts['WriteDigitalU32'] += 1
+        return self._write(num_samps_per_chan, write_array,
+                           samps_per_chan_written)
+
+    def WriteAnalogF64(self, num_samps_per_chan, auto_start, timeout,
+                       data_layout, write_array, samps_per_chan_written,
+                       reserved):
+        call_counts['WriteAnalogF64'] += 1
+        return self._write(num_samps_per_chan, write_array,
+                           samps_per_chan_written)
+
+    def WriteBinaryI16(self, num_samps_per_chan, auto_start, timeout,
+                       data_layout, write_array, samps_per_chan_written,
+                       reserved):
+        call_counts['WriteBinaryI16'] += 1
+        return self._write(num_samps_per_chan, write_array,
+                           samps_per_chan_written)
+
+    def GetWriteTotalSampPerChanGenerated(self, data):
+        with self.lock:
+            _set_ref(data, self.n_generated)
+        return 0
+
+    # running
+
+    def StartTask(self):
+        call_counts['StartTask'] += 1
+        if self.n_written == 0:
+            raise DAQError(-200462, 'Generation cannot be started because '
+                           'the output buffer is empty', 'StartTask')
+        self.done.clear()
+        self.error = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._generate)
+        self.thread.daemon = True
+        self.thread.start()
+        return 0
+
+    def _generate(self):
+        step = self.every_n_samples or max(1, self.n_samples//100)
+        rate = (self.rate or 1e6)*speed_up
+        while self.running and self.n_generated < self.n_samples:
+            time.sleep(step/rate)
+            with self.lock:
+                available = self.n_written - self.n_generated
+                if self.allow_regen and self.buffer_samples is None:
+                    # everything was written before the start
+                    available = self.n_samples - self.n_generated
+                if available <= 0:
+                    self.error = error_underrun
+                    break
+                n_new = min(step, available, self.n_samples - self.n_generated)
+                previous_generated = self.n_generated
+                self.n_generated += n_new
+            if self.every_n_samples is not None:
+                n_events = (self.n_generated//self.every_n_samples -
+                            previous_generated//self.every_n_samples)
+                for _ in range(n_events):
+                    self.EveryNCallback()
+        self.running = False
+        if self.register_done:
+            self.DoneCallback(self.error)
+        self.done.set()
+
+    def EveryNCallback(self):
+        return 0
+
+    def DoneCallback(self, status):
+        return 0
+
+    def IsTaskDone(self, is_task_done):
+        _set_ref(is_task_done, self.done.is_set())
+        return 0
+
+    def WaitUntilTaskDone(self, time_to_wait):
+        if self.thread is not None:
+            if time_to_wait < 0:
+                self.done.wait()
+            else:
+                self.done.wait(time_to_wait)
+        if self.error:
+            raise DAQError(self.error, 'Underrun of the output buffer',
+                           'WaitUntilTaskDone')
+        return 0
+
+    def StopTask(self):
+        self.running = False
+        if (self.thread is not None and
+                self.thread is not threading.current_thread()):
+            self.thread.join()
+        with self.lock:
+            # a restarted task outputs its buffer from the start
+            self.n_generated = 0
+            self.rewrite = True
+        return 0
+
+    def TaskControl(self, action):
+        call_counts['TaskControl'] += 1
+        if action == DAQmx_Val_Task_Unreserve:
+            # the buffer is released with the lines
+            with self.lock:
+                self.written_data = []
+                self.n_written = 0
+                self.n_generated = 0
+                self.rewrite = False
+        return 0
+
+    def ClearTask(self):
+        call_counts['ClearTask'] += 1
+        return self.StopTask()
+
+    def get_written_samples(self):
+        """Returns all samples written to the task as a single array."""
+        if not self.written_data:
+            return np.zeros(0)
+        return np.concatenate([np.ravel(d) for d in self.written_data])
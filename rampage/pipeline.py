@@ -0,0 +1,191 @@
+"""Compiles queued shots ahead of time in a worker process.
+
+While a shot is running on the DAQ cards, the next shots in the queue are
+compiled by a separate process, so that compilation does not compete with the
+server for the interpreter and the next shot is ready to upload as soon as the
+running one is done.
+
+Python 2 has no multiprocessing.shared_memory, so the worker saves a compiled
+shot to a file in a temporary directory with artifact.save_shot, and only
+sends the name of the file through the result queue. The server maps the file
+with artifact.load_shot, which avoids pickling the waveforms through a pipe
+and keeps shots compiled ahead out of RAM until they are uploaded.
+"""
+
+import collections
+import multiprocessing
+import multiprocessing.pool
+import os
+import Queue
+import shutil
+import tempfile
+import time
+import traceback
+
+from rampage.artifact import load_shot, save_shot
+from rampage.compiler import RampCompiler
+
+
+def _remove_file(file_name):
+    """Removes file_name and returns True if it does not exist anymore."""
+    try:
+        os.remove(file_name)
+    except OSError:
+        return not os.path.exists(file_name)
+    return True
+
+
+def compile_worker(jobs, results, result_dir, render_threads=1):
+    """Compiles shots from jobs until it gets None.
+
+    Every job is a tuple (job_id, ramp_data). For every job, a tuple
+    (job_id, file_name, info, error) is put in results, where file_name is
+    the shot saved with artifact.save_shot and info is a dict with the
+    compile time and RampCompiler.sample_counts. If compilation fails,
+    file_name and info are None and error is the traceback. If
+    render_threads is more than 1, every shot is rendered by a pool of
+    render_threads threads.
+    """
+    if render_threads > 1:
+        pool = multiprocessing.pool.ThreadPool(render_threads)
+    else:
+        pool = None
+    previous = None
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        job_id, ramp_data = job
+        start_time = time.time()
+        try:
+            # consecutive shots of a scan share most of their channels
+            previous = RampCompiler(ramp_data, previous=previous)
+            out = previous.make_ramps(pool)
+            file_name = os.path.join(result_dir,
+                                     'shot{0:06d}.bin'.format(job_id))
+            save_shot(out, file_name)
+        except Exception:
+            previous = None
+            results.put((job_id, None, None, traceback.format_exc()))
+        else:
+            info = {'compile_time': time.time() - start_time,
+                    'sample_counts': previous.sample_counts}
+            results.put((job_id, file_name, info, None))
+
+
+class LookAheadCompiler(object):
+
+    """Compiles shots in a worker process and returns them in order.
+
+    render_threads(int) - number of threads the worker renders a shot with.
+
+    Usage
+    -----
+    look_ahead = LookAheadCompiler()
+    look_ahead.submit(ramp_data_1)
+    look_ahead.submit(ramp_data_2, out=already_compiled_out)
+    shot = look_ahead.get_next(timeout=0.05)
+
+    shot is None if the oldest submitted shot is not ready yet, otherwise it
+    is a tuple (ramp_data, out, info, error). out is the same tuple as
+    RampCompiler(ramp_data).make_ramps(), or None if the worker failed, in
+    which case error is the traceback from the worker. info is a dict with
+    the compile time and the sample counts of the analog devices, or None if
+    the shot was submitted already compiled. The arrays of out are read only
+    memory maps of a file in a temporary directory.
+    """
+
+    def __init__(self, render_threads=1):
+        self.result_dir = tempfile.mkdtemp(prefix='rampage_shots_')
+        self.jobs = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.process = multiprocessing.Process(
+            target=compile_worker,
+            args=(self.jobs, self.results, self.result_dir, render_threads))
+        self.process.daemon = True
+        self.process.start()
+        self.next_job_id = 0
+        # each element is a list [job_id, ramp_data, out, info, error], in the
+        # order the shots were submitted
+        self.pending = collections.deque()
+        # files which could not be removed while they were mapped
+        self.stale_files = []
+
+    def __len__(self):
+        return len(self.pending)
+
+    def submit(self, ramp_data, out=None):
+        """Queues ramp_data for compilation. If out is given, the shot is
+        already compiled and is only kept in order with the others."""
+        job_id = self.next_job_id
+        self.next_job_id += 1
+        self.pending.append([job_id, ramp_data, out, None, None])
+        if out is None:
+            self.jobs.put((job_id, ramp_data))
+
+    def _handle_result(self, result):
+        job_id, file_name, info, error = result
+        for entry in self.pending:
+            if entry[0] == job_id:
+                break
+        else:
+            # the shot was cleared while it was being compiled
+            if file_name is not None:
+                _remove_file(file_name)
+            return
+        if error is None:
+            entry[2] = load_shot(file_name)
+            entry[3] = info
+            # the mapped pages stay valid after the file is unlinked, except
+            # on Windows, where the file is removed once it is unmapped
+            self.stale_files.append(file_name)
+            self._remove_stale_files()
+        else:
+            entry[4] = error
+
+    def _remove_stale_files(self):
+        self.stale_files = [file_name for file_name in self.stale_files
+                            if not _remove_file(file_name)]
+
+    def _is_ready(self, entry):
+        return entry[2] is not None or entry[4] is not None
+
+    def get_next(self, timeout=0.0):
+        """Returns the oldest submitted shot if it is compiled, else None.
+
+        Waits up to timeout seconds for it.
+        """
+        deadline = time.time() + timeout
+        while True:
+            try:
+                self._handle_result(self.results.get(False))
+                continue
+            except Queue.Empty:
+                pass
+            if self.pending and self._is_ready(self.pending[0]):
+                _, ramp_data, out, info, error = self.pending.popleft()
+                return ramp_data, out, info, error
+            remaining = deadline - time.time()
+            if remaining <= 0.0 or not self.pending:
+                return None
+            try:
+                self._handle_result(self.results.get(True, remaining))
+            except Queue.Empty:
+                return None
+
+    def clear(self):
+        """Discards all submitted shots."""
+        while True:
+            try:
+                self.jobs.get(False)
+            except Queue.Empty:
+                break
+        self.pending.clear()
+
+    def close(self):
+        self.clear()
+        self.jobs.put(None)
+        self.process.join(1.0)
+        if self.process.is_alive():
+            self.process.terminate()
+        shutil.rmtree(self.result_dir, ignore_errors=True)
@@ -473,7 +473,14 @@ class RampQueuer(QRampQueuer, Ui_RampQueuer):
         for ramp in self.ramps_to_queue:
             self.textServerMesg.append('Queueing')
             reply = self.get_client().queue_ramp(ramp)
-            self.textServerMesg.append(str(reply))
+            # the server rejects shots above its size limits
+            for warning in reply.get('warnings', []):
+                self.textServerMesg.append('Warning: ' + warning)
+            if reply.get('status') == 'error':
+                self.textServerMesg.append('Rejected: ' +
+                                           '; '.join(reply['errors']))
+            else:
+                self.textServerMesg.append(str(reply))
 
         self.ramps_to_queue = []
         self.listToQueue.clear()
@@ -1,8 +1,12 @@
 """Provides classes to build arbitrary waveforms."""
 
+import fractions
+import itertools
 import json
 import numpy as np
 
+from rampage import conversion
+
 
 class KeyFrameList(object):
 
@@ -39,18 +43,31 @@ class KeyFrameList(object):
 
         # check all parent keys are actually valid
         for key in self.dct:
-            kf = self.dct[key]
-            parent_name = kf['parent']
-            if parent_name is not None:
-                if parent_name not in self.dct:
-                    error_string = ('KeyFrame "' + key + '" has a parent "' +
-                                    parent_name +
-                                    '"" which is not a known KeyFrame')
-                    raise KeyError(error_string)
+            self._check_parent(key, self.dct[key]['parent'])
         self.is_baked = False
+        self._sorted_keys = None
+        self._key_positions = None
+        self._key_ticks = {}
         # find absolute times for all the keys
         self.bake()
 
+    def _check_parent(self, key, parent_name):
+        if parent_name is not None:
+            if parent_name not in self.dct:
+                error_string = ('KeyFrame "' + key + '" has a parent "' +
+                                parent_name +
+                                '"" which is not a known KeyFrame')
+                raise KeyError(error_string)
+
+    def _build_child_index(self):
+        """Maps every key (and None, for keys without a parent) to the list of
+        its children."""
+        self.child_index = {None: []}
+        for key in self.dct:
+            self.child_index[key] = []
+        for key in self.dct:
+            self.child_index[self.dct[key]['parent']].append(key)
+
     def bake(self):
         """Find absolute times for all keys.
 
@@ -58,8 +75,15 @@ class KeyFrameList(object):
         __abs_time__.
         """
         self.unbake()
-        for key in self.dct:
-            self.get_absolute_time(key)
+        self._build_child_index()
+        n_baked = self._bake_subtree(None)
+        if n_baked != len(self.dct):
+            # keys which were not reached from the root are in a cycle
+            cycle_keys = [k for k in self.dct
+                          if '__abs_time__' not in self.dct[k]]
+            error_string = ('KeyFrames "' + '", "'.join(sorted(cycle_keys)) +
+                            '" have parents which form a cycle')
+            raise ValueError(error_string)
         self.is_baked = True
 
     def unbake(self):
@@ -68,6 +92,42 @@ class KeyFrameList(object):
             # pop __abs_time__ if it exists
             self.dct[key].pop('__abs_time__', None)
         self.is_baked = False
+        self._invalidate_order()
+
+    def _invalidate_order(self):
+        """Forget the sorted key order. Call whenever times or names change."""
+        self._sorted_keys = None
+        self._key_positions = None
+        self._key_ticks = {}
+
+    def _bake_subtree(self, key):
+        """Find absolute times of key and all its descendants.
+
+        key=None bakes all keys. Returns the number of keys baked.
+        """
+        if key is None:
+            stack = [(k, 0.0) for k in self.child_index[None]]
+        else:
+            parent_name = self.dct[key]['parent']
+            if parent_name is None:
+                parent_time = 0.0
+            else:
+                parent_time = self.dct[parent_name]['__abs_time__']
+            stack = [(key, parent_time)]
+        self._invalidate_order()
+        n_baked = 0
+        while stack:
+            key_name, parent_time = stack.pop()
+            kf = self.dct[key_name]
+            if kf['parent'] is None:
+                abs_time = kf['time']
+            else:
+                abs_time = kf['time'] + parent_time
+            kf['__abs_time__'] = abs_time
+            n_baked += 1
+            for child in self.child_index[key_name]:
+                stack.append((child, abs_time))
+        return n_baked
 
     def get_absolute_time(self, key):
         """Returns the absolute time position of the key.
@@ -80,30 +140,98 @@ class KeyFrameList(object):
             # if absolute time is already calculated, return that
             return keyframe['__abs_time__']
         except KeyError:
-            # if not, calculate by adding relative time to parent's time
-            if keyframe['parent'] is None:
-                keyframe['__abs_time__'] = keyframe['time']
+            pass
+        # walk up the parents until a key with a known time is found, then
+        # add relative times on the way back down
+        chain = []
+        visited = set()
+        key_name = key
+        parent_time = 0.0
+        while key_name is not None:
+            kf = self.dct[key_name]
+            if '__abs_time__' in kf:
+                parent_time = kf['__abs_time__']
+                break
+            if key_name in visited:
+                error_string = ('KeyFrame "' + key_name + '" is its own '
+                                'ancestor')
+                raise ValueError(error_string)
+            visited.add(key_name)
+            chain.append(kf)
+            key_name = kf['parent']
+        for kf in reversed(chain):
+            if kf['parent'] is None:
+                kf['__abs_time__'] = kf['time']
             else:
-                parent_time = self.get_absolute_time(keyframe['parent'])
-                abs_time = keyframe['time'] + parent_time
-                keyframe['__abs_time__'] = abs_time
-            return keyframe['__abs_time__']
+                kf['__abs_time__'] = kf['time'] + parent_time
+            parent_time = kf['__abs_time__']
+        return keyframe['__abs_time__']
 
     def sorted_key_list(self):
-        """Returns list of keys sorted according to their absolute time."""
+        """Returns list of keys sorted according to their absolute time.
+
+        The list is cached until a time changes and is shared between
+        callers, so it should not be modified.
+        """
         if not self.is_baked:
             self.bake()
-        key_value_tuple = sorted(self.dct.items(),
-                                 key=lambda x: x[1]['__abs_time__'])
-        skl = [k[0] for k in key_value_tuple]
-        return skl
+        if self._sorted_keys is None:
+            key_value_tuple = sorted(self.dct.items(),
+                                     key=lambda x: x[1]['__abs_time__'])
+            self._sorted_keys = [k[0] for k in key_value_tuple]
+        return self._sorted_keys
+
+    def get_key_positions(self):
+        """Returns a dict which maps each key to its index in
+        sorted_key_list()."""
+        if self._key_positions is None:
+            skl = self.sorted_key_list()
+            self._key_positions = dict(zip(skl, range(len(skl))))
+        return self._key_positions
+
+    def get_key_ticks(self, tick):
+        """Returns the absolute times of sorted_key_list() as int64 numbers
+        of tick (in ms), rounded to the nearest tick.
+
+        Compiled waveforms are sampled every tick (the jump_resolution), so
+        every position and region computation is done on these integers. The
+        array is cached until a time changes and should not be modified.
+        """
+        try:
+            return self._key_ticks[tick]
+        except KeyError:
+            pass
+        abs_times = np.array([self.dct[key]['__abs_time__']
+                              for key in self.sorted_key_list()])
+        key_ticks = np.rint(abs_times/tick).astype('int64')
+        key_ticks.setflags(write=False)
+        self._key_ticks[tick] = key_ticks
+        return key_ticks
+
+    def get_key_position(self, key_name):
+        """Returns the index of key_name in sorted_key_list()."""
+        return self.get_key_positions()[key_name]
+
+    def get_descendants(self, key_name):
+        """Returns list of all keys whose time depends on key_name."""
+        descendants = []
+        stack = list(self.child_index[key_name])
+        while stack:
+            key = stack.pop()
+            descendants.append(key)
+            stack.extend(self.child_index[key])
+        return descendants
 
     def set_time(self, key_name, new_time):
-        """Sets the time of key."""
-        self.unbake()
+        """Sets the time of key.
+
+        Only the absolute times of key_name and its descendants are updated.
+        """
+        if not self.is_baked:
+            self.bake()
         kf = self.dct[key_name]
         kf['time'] = new_time
-        self.bake()
+        self._bake_subtree(key_name)
 
     def set_comment(self, key_name, new_comment):
         """Sets the comment of key."""
@@ -112,39 +240,70 @@ class KeyFrameList(object):
 
     def set_parent(self, key_name, new_parent):
         """Sets the parent of the key."""
-        self.unbake()
+        if not self.is_baked:
+            self.bake()
+        self._check_parent(key_name, new_parent)
+        if new_parent is not None and self.is_ancestor(new_parent, key_name):
+            error_string = ('KeyFrame "' + key_name + '" cannot have its '
+                            'descendant "' + new_parent + '" as a parent')
+            raise ValueError(error_string)
         kf = self.dct[key_name]
+        self.child_index[kf['parent']].remove(key_name)
         kf['parent'] = new_parent
-        self.bake()
+        self.child_index[new_parent].append(key_name)
+        self._bake_subtree(key_name)
 
     def set_name(self, old_name, new_name):
         if old_name != new_name:
-            self.unbake()
+            if not self.is_baked:
+                self.bake()
+            self._check_new_name(new_name)
             self.dct[new_name] = self.dct[old_name]
             self.dct.pop(old_name)
-            for key in self.dct:
-                if self.dct[key]['parent'] == old_name:
-                    self.dct[key]['parent'] = new_name
-            self.bake()
+            children = self.child_index.pop(old_name)
+            for key in children:
+                self.dct[key]['parent'] = new_name
+            self.child_index[new_name] = children
+            siblings = self.child_index[self.dct[new_name]['parent']]
+            siblings[siblings.index(old_name)] = new_name
+            self._invalidate_order()
+
+    def _check_new_name(self, key_name):
+        if key_name in self.dct:
+            error_string = 'KeyFrame "' + key_name + '" already exists'
+            raise KeyError(error_string)
 
     def add_keyframe(self, new_key_name, new_key_dict):
-        self.unbake()
+        if not self.is_baked:
+            self.bake()
+        self._check_new_name(new_key_name)
         self.dct[new_key_name] = new_key_dict
-        self.bake()
+        try:
+            self._check_parent(new_key_name, new_key_dict['parent'])
+        except KeyError:
+            self.dct.pop(new_key_name)
+            raise
+        self.child_index[new_key_name] = []
+        self.child_index[new_key_dict['parent']].append(new_key_name)
+        self._bake_subtree(new_key_name)
 
     def del_keyframe(self, key_name):
-        self.unbake()
+        if not self.is_baked:
+            self.bake()
         kf = self.dct[key_name]
         parent_key = kf['parent']
 
         # find children of this keyframe
-        child_keys = [k for k in self.dct if self.dct[k]['parent'] == key_name]
+        child_keys = self.child_index.pop(key_name)
+        self.child_index[parent_key].remove(key_name)
+        # remove the key_name
+        self.dct.pop(key_name)
+        self._invalidate_order()
         # set the parent of child keys to the parent of the deleted key_name
         for ck in child_keys:
             self.dct[ck]['parent'] = parent_key
-        # remove the key_name
-        self.dct.pop(key_name)
-        self.bake()
+            self.child_index[parent_key].append(ck)
+            self._bake_subtree(ck)
 
     def is_ancestor(self, child_key_name, ancestor_key_name):
         """Returns True if ancestor lies in the ancestry tree of child."""
@@ -153,15 +312,18 @@ class KeyFrameList(object):
         if ancestor_key_name is None:
             return True
 
-        one_up_parent = self.dct[child_key_name]['parent']
-        if child_key_name == ancestor_key_name:
-            # debatable semantics, but a person lies in his/her own
-            # ancestry tree
-            return True
-        elif one_up_parent is None:
-            return False
-        else:
-            return self.is_ancestor(one_up_parent, ancestor_key_name)
+        key_name = child_key_name
+        # debatable semantics, but a person lies in his/her own
+        # ancestry tree
+        for _ in range(len(self.dct) + 1):
+            if key_name == ancestor_key_name:
+                return True
+            elif key_name is None:
+                return False
+            key_name = self.dct[key_name]['parent']
+        error_string = ('KeyFrame "' + child_key_name + '" has parents '
+                        'which form a cycle')
+        raise ValueError(error_string)
 
     def add_hook(self, key_name, hook_name, hook_dict):
         """Add hook to the keyframe key_name."""
@@ -247,6 +409,10 @@ class Channel(object):
     interpolation between keyframes. The "keys" dict has all the keys for which
     the ramp value is defined. At each keyframe, ramp_data has all the channel
     information between that key and the next key.
+
+    The time between samples of a ramp (in ms) is the "resolution" entry of
+    its ramp_data, or the "ramp_resolution" entry of the channel if it has
+    none, or else the ramp_resolution property of the whole ramp.
     """
 
     def __init__(self, ch_name, dct=None, key_frame_list=None):
@@ -270,9 +436,9 @@ class Channel(object):
     def del_unused_keyframes(self):
         """Scans through list of keyframes in the channel and removes those
         which are not in self.key_frame_list."""
-        skl = self.key_frame_list.sorted_key_list()
+        key_positions = self.key_frame_list.get_key_positions()
         unused_keys = [k for k in self.dct['keys']
-                       if k not in skl]
+                       if k not in key_positions]
         for k in unused_keys:
             del self.dct['keys'][k]
 
@@ -286,106 +452,126 @@ class Channel(object):
         time. Each element in the list is a tuple. The first element is the
         key_name and the second is the channel data at that keyframe."""
 
-        skl = self.key_frame_list.sorted_key_list()
-        # each element in used_key_frames is a tuple (key_name, key_dict)
-        used_key_frames = []
-        for kf in skl:
-            if kf in self.dct['keys']:
-                used_key_frames.append((kf, self.dct['keys'][kf]))
-        return used_key_frames
+        return [(kf, self.dct['keys'][kf])
+                for kf in self.get_used_key_frame_list()]
 
     def get_used_key_frame_list(self):
         """Returns a list of the keyframes used by this channel, sorted with
         time."""
-        skl = self.key_frame_list.sorted_key_list()
-        # each element in used_key_frames is a tuple (key_name, key_dict)
-        used_key_frames = []
-        for kf in skl:
-            if kf in self.dct['keys']:
-                used_key_frames.append(kf)
+        key_positions = self.key_frame_list.get_key_positions()
+        used_key_frames = [kf for kf in self.dct['keys']
+                           if kf in key_positions]
+        used_key_frames.sort(key=key_positions.__getitem__)
         return used_key_frames
 
     def get_ramp_regions(self):
         """Returns a numpy array where each element corresponds to whether to
         ramp in that region or jump."""
-        skl = self.key_frame_list.sorted_key_list()
-        ramp_or_jump = np.zeros(len(skl) - 1)
+        key_positions = self.key_frame_list.get_key_positions()
+        ramp_or_jump = np.zeros(len(key_positions) - 1)
         used_key_frames = self.get_used_key_frame_list()
-        for region_number, start_key in enumerate(skl[:-1]):
-            if start_key in used_key_frames:
-                key_data = self.dct['keys'][start_key]
-                ramp_type = key_data['ramp_type']
-                if ramp_type != "jump":
-                    # this means that a ramp starts in this region. Figure
-                    # out where it ends
-                    curr_key_num = used_key_frames.index(start_key)
-                    end_key_number = curr_key_num + 1
-                    # figure out if the current key was the last key
-                    if end_key_number < len(used_key_frames):
-                        # if it wasnt, then find the end region
-                        end_key_name = used_key_frames[end_key_number]
-                        end_region_index = skl.index(end_key_name)
-                        ramp_or_jump[region_number:end_region_index] = 1
+        # a ramp starts at every used key which is not a jump, and ends at the
+        # next used key. The last key has no region after it.
+        for start_key, end_key in zip(used_key_frames[:-1],
+                                      used_key_frames[1:]):
+            ramp_type = self.dct['keys'][start_key]['ramp_type']
+            if ramp_type != "jump":
+                region_number = key_positions[start_key]
+                end_region_index = key_positions[end_key]
+                ramp_or_jump[region_number:end_region_index] = 1
         return ramp_or_jump
 
+    def get_ramp_resolutions(self, default_resolution):
+        """Returns a numpy array with the time between samples in each region
+        between keyframes, or 0 where the channel jumps.
+
+        default_resolution is used for ramps which neither they nor the
+        channel set a resolution for.
+        """
+        key_positions = self.key_frame_list.get_key_positions()
+        resolutions = np.zeros(len(key_positions) - 1)
+        channel_resolution = self.dct.get('ramp_resolution',
+                                          default_resolution)
+        used_key_frames = self.get_used_key_frame_list()
+        for start_key, end_key in zip(used_key_frames[:-1],
+                                      used_key_frames[1:]):
+            key_dict = self.dct['keys'][start_key]
+            if key_dict['ramp_type'] != "jump":
+                resolution = key_dict['ramp_data'].get('resolution',
+                                                       channel_resolution)
+                if resolution <= 0.0:
+                    raise ValueError('Channel {0} has resolution {1} at '
+                                     'keyframe {2}, it should be positive'
+                                     .format(self.ch_name, resolution,
+                                             start_key))
+                region_number = key_positions[start_key]
+                end_region_index = key_positions[end_key]
+                resolutions[region_number:end_region_index] = resolution
+        return resolutions
+
     def get_analog_ramp_data(self, ramp_regions, jump_resolution,
                              ramp_resolution):
-        skl = self.key_frame_list.sorted_key_list()
+        """Returns the time array and the voltages of the channel.
+
+        ramp_regions has an element for every region between keyframes, which
+        is 0 (or empty) if the device only needs a sample at the start of the
+        region. Otherwise the region is sampled every ramp_resolution, or,
+        if the element is a tuple of resolutions, on the union of their
+        grids, see make_sample_ticks.
+        """
+        key_ticks = self.key_frame_list.get_key_ticks(jump_resolution)
+        sample_ticks, kf_positions = make_sample_ticks(
+            key_ticks, ramp_regions, jump_resolution, ramp_resolution)
+        time_array = sample_ticks*jump_resolution
+        return time_array, self.get_analog_voltages(time_array, kf_positions)
+
+    def get_analog_voltages(self, time_array, kf_positions, out=None):
+        """Returns the voltages of the channel at the times in time_array.
+
+        kf_positions is the index in time_array of the first sample of every
+        region between keyframes, and of the sample at the last keyframe, see
+        make_sample_ticks. If out is given, the voltages are stored in it and
+        it is returned. out can be a strided view, like the column of a
+        channel in the buffer of a device. The segments are evaluated and
+        converted in place in out, without a temporary of the whole channel.
+        """
+        key_positions = self.key_frame_list.get_key_positions()
         used_key_frame_list = self.get_used_key_frame_list()
-        all_kf_times = np.array([self.key_frame_list.get_absolute_time(kf)
-                                 for kf in skl])
-        time_array_list = []
-        n_points = 0
-        kf_positions = []
-        for region_number, ramp_or_jump in enumerate(ramp_regions):
-            kf_positions.append(n_points)
-            if ramp_or_jump == 0:
-                time_array_list.append(np.array([all_kf_times[region_number]]))
-                n_points += 1
-            else:
-                start_time = all_kf_times[region_number]
-                end_time = all_kf_times[region_number + 1]
-                # find number of time steps
-                n_time_steps = round((end_time-start_time)/ramp_resolution)
-                time_array = start_time + np.arange(n_time_steps)*ramp_resolution
-                # time_array = np.arange(start_time, end_time, ramp_resolution)
-                time_array_list.append(time_array)
-                n_points += len(time_array)
-        time_array_list.append([all_kf_times[-1]])
-        time_array = np.concatenate(time_array_list)
-        kf_positions.append(n_points)
-        n_points += 1
-
-        voltages = np.zeros(n_points, dtype=float)
+        n_points = len(time_array)
+
+        if out is None:
+            voltages = np.zeros(n_points, dtype=float)
+        else:
+            voltages = out
 
         start_voltage = self.dct['keys'][used_key_frame_list[0]]['ramp_data']['value']
         end_voltage = self.dct['keys'][used_key_frame_list[-1]]['ramp_data']['value']
 
-        start_index = skl.index(used_key_frame_list[0])
-        end_index = skl.index(used_key_frame_list[-1])
+        start_index = key_positions[used_key_frame_list[0]]
+        end_index = key_positions[used_key_frame_list[-1]]
 
         voltages[0:kf_positions[start_index]] = start_voltage
         voltages[kf_positions[end_index]:] = end_voltage
 
-        for i, ukf in enumerate(used_key_frame_list[:-1]):
-            start_pos = kf_positions[skl.index(ukf)]
-            end_pos = kf_positions[skl.index(used_key_frame_list[i+1])]
-            time_subarray = time_array[start_pos:end_pos]
-            start_time = time_subarray[0]
-            end_time = time_array[end_pos]
-
-            value_final = self.dct['keys'][used_key_frame_list[i+1]]['ramp_data']['value']
-            ramp_type = self.dct['keys'][used_key_frame_list[i]]['ramp_type']
-            ramp_data = self.dct['keys'][used_key_frame_list[i]]['ramp_data']
-
-            parms_tuple = (ramp_data, start_time, end_time, value_final,
-                           time_subarray)
-
-            ramp_function = analog_ramp_functions[ramp_type]
-            voltage_sub = ramp_function(*parms_tuple)
-            voltages[start_pos:end_pos] = voltage_sub
-
-        return time_array, self.convert_voltage(voltages, time_array)
+        segments = []
+        for ukf, next_ukf in zip(used_key_frame_list[:-1],
+                                 used_key_frame_list[1:]):
+            start_pos = kf_positions[key_positions[ukf]]
+            end_pos = kf_positions[key_positions[next_ukf]]
+            value_final = self.dct['keys'][next_ukf]['ramp_data']['value']
+            segments.append((start_pos, end_pos, self.dct['keys'][ukf],
+                             value_final))
+        evaluate_analog_segments(segments, time_array, voltages)
+
+        return self.convert_voltage(voltages, time_array, out=voltages)
+
+    def get_used_key_ticks(self, tick):
+        """Returns the ticks of get_used_key_frame_list(), see
+        KeyFrameList.get_key_ticks."""
+        key_ticks = self.key_frame_list.get_key_ticks(tick)
+        key_positions = self.key_frame_list.get_key_positions()
+        return key_ticks[[key_positions[kf]
+                          for kf in self.get_used_key_frame_list()]]
 
     def generate_ramp(self, time_div=4e-3):
         """Returns the generated ramp and a time array.
@@ -394,37 +580,29 @@ class Channel(object):
 
         time_div - time resolution of the ramp.
         """
-        if self.dct['type'] == 'analog':
-            is_analog = True
-        else:
-            is_analog = False
-        skl = self.key_frame_list.sorted_key_list()
+        if self.dct['type'] != 'analog':
+            num_points, runs = self.get_digital_runs(time_div)
+            time = np.arange(num_points) * time_div
+            voltage = np.zeros(time.shape, dtype='uint32')
+            for start_index, end_index, state in runs:
+                voltage[start_index:end_index] = state
+            return time, voltage
+
         # each element in used_key_frames is a tuple (key_name, key_dict)
         used_key_frames = self.get_used_key_frames()
-        max_time = self.key_frame_list.get_absolute_time(skl[-1]) + time_div
-
-        num_points = int(round(max_time/time_div))
+        num_points = int(self.key_frame_list.get_key_ticks(time_div)[-1]) + 1
         time = np.arange(num_points) * time_div
         # time = np.arange(0.0, max_time, time_div)
-        if is_analog:
-            voltage = np.zeros(time.shape, dtype=float)
-        else:
-            voltage = np.zeros(time.shape, dtype='uint32')
+        voltage = np.zeros(time.shape, dtype=float)
         kf_times = np.array([self.key_frame_list.get_absolute_time(ukf[0])
                              for ukf in used_key_frames])
-        kf_positions = kf_times/time_div
-
-        if is_analog:
-            # set the start and the end part of the ramp
-            start_voltage = used_key_frames[0][1]['ramp_data']['value']
-            end_voltage = used_key_frames[-1][1]['ramp_data']['value']
-            voltage[0:kf_positions[0]] = start_voltage
-            voltage[kf_positions[-1]:] = end_voltage
-        else:
-            start_voltage = int(used_key_frames[0][1]['state'])
-            end_voltage = int(used_key_frames[-1][1]['state'])
-            voltage[0:kf_positions[0]] = start_voltage
-            voltage[kf_positions[-1]:] = end_voltage
+        kf_positions = self.get_used_key_ticks(time_div)
+
+        # set the start and the end part of the ramp
+        start_voltage = used_key_frames[0][1]['ramp_data']['value']
+        end_voltage = used_key_frames[-1][1]['ramp_data']['value']
+        voltage[0:kf_positions[0]] = start_voltage
+        voltage[kf_positions[-1]:] = end_voltage
 
         for i in range(len(kf_times)-1):
             start_time = kf_times[i]
@@ -434,36 +612,456 @@ class Channel(object):
             time_subarray = time[start_index:end_index]
             ramp_type = used_key_frames[i][1]['ramp_type']
             ramp_data = used_key_frames[i][1]['ramp_data']
-            if is_analog:
-                value_final = used_key_frames[i+1][1]['ramp_data']['value']
-            else:
-                state = used_key_frames[i][1]['state']
+            value_final = used_key_frames[i+1][1]['ramp_data']['value']
 
-            if is_analog:
-                parms_tuple = (ramp_data, start_time, end_time, value_final,
-                               time_subarray)
-            else:
-                parms_tuple = (ramp_data, start_time, end_time, state,
-                               time_subarray)
+            parms_tuple = (ramp_data, start_time, end_time, value_final,
+                           time_subarray)
 
-            if is_analog:
-                ramp_function = analog_ramp_functions[ramp_type]
-            else:
-                ramp_function = digital_ramp_functions[ramp_type]
+            ramp_function = analog_ramp_functions[ramp_type]
             voltage_sub = ramp_function(*parms_tuple)
             voltage[start_index:end_index] = voltage_sub
 
         # finally use the conversion and return the voltage
         return time, self.convert_voltage(voltage, time)
 
-    def convert_voltage(self, voltage, time):
+    def get_digital_runs(self, time_div=4e-3):
+        """Returns the number of samples and the runs of a digital channel.
+
+        This describes the same ramp as generate_ramp, but without an element
+        for every time_div. Each run is a tuple (start, end, state) which
+        covers samples start:end. For keyframes where the channel just holds
+        its state, state is 0 or 1, and consecutive runs with the same state
+        are merged, so the line only has a run boundary where it toggles. For
+        other ramp types, like pulsetrain, state is a uint32 array with one
+        element per sample of the run.
+        """
+        # each element in used_key_frames is a tuple (key_name, key_dict)
+        used_key_frames = self.get_used_key_frames()
+        num_points = int(self.key_frame_list.get_key_ticks(time_div)[-1]) + 1
+
+        kf_times = [self.key_frame_list.get_absolute_time(ukf[0])
+                    for ukf in used_key_frames]
+        kf_positions = [min(int(kt), num_points)
+                        for kt in self.get_used_key_ticks(time_div)]
+
+        runs = [(0, kf_positions[0], int(used_key_frames[0][1]['state']))]
+        for i in range(len(kf_times)-1):
+            start_index = kf_positions[i]
+            end_index = kf_positions[i+1]
+            key_dict = used_key_frames[i][1]
+            if key_dict['ramp_type'] == 'jump':
+                state = int(key_dict['state'])
+            else:
+                time_subarray = np.arange(start_index, end_index) * time_div
+                ramp_function = digital_ramp_functions[key_dict['ramp_type']]
+                state = ramp_function(key_dict['ramp_data'], kf_times[i],
+                                      kf_times[i+1], key_dict['state'],
+                                      time_subarray).astype('uint32')
+            runs.append((start_index, end_index, state))
+        runs.append((kf_positions[-1], num_points,
+                     int(used_key_frames[-1][1]['state'])))
+
+        merged_runs = []
+        for run in runs:
+            if run[1] <= run[0]:
+                continue
+            if (merged_runs and not isinstance(run[2], np.ndarray) and
+                    not isinstance(merged_runs[-1][2], np.ndarray) and
+                    merged_runs[-1][2] == run[2] and
+                    merged_runs[-1][1] == run[0]):
+                merged_runs[-1] = (merged_runs[-1][0], run[1], run[2])
+            else:
+                merged_runs.append(run)
+        return num_points, merged_runs
+
+    def get_digital_change_points(self, time_div=4e-3):
+        """Returns the digital ramp as ChangePoints with states 0 or 1."""
+        num_points, runs = self.get_digital_runs(time_div)
+        return ChangePoints.from_runs(runs, num_points)
+
+    def convert_voltage(self, voltage, time, out=None):
         if self.dct['type'] == 'analog':
-            conversion_str = self.dct['conversion']
-            return eval(conversion_str, {'x': voltage, 't':time})
+            return conversion.convert(self.dct['conversion'], voltage, time,
+                                      out=out)
         else:
             return voltage
 
 
+class ChangePoints(object):
+
+    """Compact form of a piecewise constant waveform of integers.
+
+    Digital lines usually change state only at a few keyframes, so instead
+    of one element per sample, the waveform is stored as the positions where
+    its value changes and the values from there on.
+
+    positions(numpy.array of int64) - sorted sample indices at which the value
+        changes. positions[0] is always 0.
+    values(numpy.array of uint32) - value from each position up to the next.
+    n_samples(int) - total number of samples in the waveform.
+
+    Use expand() to get the usual dense array with one element per sample.
+    """
+
+    def __init__(self, positions, values, n_samples):
+        self.positions = np.asarray(positions, dtype='int64')
+        self.values = np.asarray(values, dtype='uint32')
+        self.n_samples = int(n_samples)
+
+    def __len__(self):
+        return self.n_samples
+
+    @property
+    def nbytes(self):
+        return self.positions.nbytes + self.values.nbytes
+
+    @classmethod
+    def from_runs(cls, runs, n_samples):
+        """Creates ChangePoints from runs as returned by
+        Channel.get_digital_runs. Samples not covered by a run are 0."""
+        positions = [np.zeros(1, dtype='int64')]
+        values = [np.zeros(1, dtype='uint32')]
+        for start, end, state in runs:
+            if isinstance(state, np.ndarray):
+                state = state[:end-start]
+                changes = np.flatnonzero(state[1:] != state[:-1]) + 1
+                positions.append(start + np.concatenate(([0], changes)))
+                values.append(state[np.concatenate(([0], changes))])
+            else:
+                positions.append(np.array([start], dtype='int64'))
+                values.append(np.array([state], dtype='uint32'))
+            # value after the run, in case the next run does not start here
+            positions.append(np.array([end], dtype='int64'))
+            values.append(np.zeros(1, dtype='uint32'))
+        return cls.from_changes(np.concatenate(positions),
+                                np.concatenate(values), n_samples)
+
+    @classmethod
+    def from_changes(cls, positions, values, n_samples):
+        """Creates ChangePoints from unsorted positions and values.
+
+        If a position is given more than once, the last value given for it
+        wins. Positions where the value does not change are dropped.
+        """
+        positions = np.asarray(positions, dtype='int64')
+        values = np.asarray(values, dtype='uint32')
+        order = np.argsort(positions, kind='mergesort')
+        positions = positions[order]
+        values = values[order]
+        inside = positions < n_samples
+        positions = positions[inside]
+        values = values[inside]
+        last = np.append(positions[1:] != positions[:-1], True)
+        positions = positions[last]
+        values = values[last]
+        changed = np.append(True, values[1:] != values[:-1])
+        return cls(positions[changed], values[changed], n_samples)
+
+    def value_at(self, sample_positions):
+        """Returns the value at each of sample_positions."""
+        index = np.searchsorted(self.positions, sample_positions,
+                                side='right') - 1
+        return self.values[index]
+
+    def expand(self, out=None):
+        """Returns the dense uint32 array with one element per sample.
+
+        If out is given, the samples are written into it instead of a new
+        array. out must have at least n_samples elements.
+        """
+        if out is None:
+            out = np.empty(self.n_samples, dtype='uint32')
+        out = out[:self.n_samples]
+        # put the change in value at each position and integrate. uint32
+        # arithmetic wraps around, so this works for decreasing values too.
+        out.fill(0)
+        steps = np.diff(self.values)
+        out[self.positions[0]] = self.values[0]
+        out[self.positions[1:]] = steps
+        np.cumsum(out, out=out, dtype='uint32')
+        return out
+
+    def expand_range(self, start, stop, out=None):
+        """Returns the dense uint32 array of samples start to stop.
+
+        If out is given, the samples are written into it instead of a new
+        array.
+        """
+        n_out = max(stop - start, 0)
+        if out is None:
+            out = np.empty(n_out, dtype='uint32')
+        out = out[:n_out]
+        if n_out == 0:
+            return out
+        # first is the change point in effect at start, last is the first
+        # change point at or after stop
+        first = np.searchsorted(self.positions, start, side='right') - 1
+        last = np.searchsorted(self.positions, stop, side='left')
+        out.fill(0)
+        if first >= 0:
+            values = self.values[first:last]
+        else:
+            # samples before the first change point are 0
+            values = np.concatenate(([0], self.values[:last])).astype(
+                'uint32')
+        out[0] = values[0]
+        out[self.positions[first + 1:last] - start] = np.diff(values)
+        np.cumsum(out, out=out, dtype='uint32')
+        return out
+
+    def iter_chunks(self, chunk_size):
+        """Yields the dense samples in arrays of chunk_size samples. The last
+        array may be shorter."""
+        for start in range(0, self.n_samples, chunk_size):
+            yield self.expand_range(start, min(start + chunk_size,
+                                               self.n_samples))
+
+    def resized(self, n_samples):
+        """Returns a copy with n_samples samples. Extra samples hold the last
+        value."""
+        keep = self.positions < n_samples
+        return ChangePoints(self.positions[keep], self.values[keep],
+                            n_samples)
+
+    def get_step_data(self, time_div=4e-3):
+        """Returns time and value arrays which draw the waveform as steps."""
+        edges = np.append(self.positions, self.n_samples) * time_div
+        time = np.repeat(edges, 2)[1:-1]
+        values = np.repeat(self.values, 2)
+        return time, values
+
+
+def merge_change_points(parts):
+    """Combines the lines in parts into a single waveform of words.
+
+    parts is a list of tuples (change_points, bit_shift). The word at each
+    sample is the OR of the values of all parts shifted left by bit_shift.
+    The result has as many samples as the longest part.
+    """
+    n_samples = max(cp.n_samples for cp, _ in parts)
+    positions = np.unique(np.concatenate([cp.positions for cp, _ in parts]))
+    words = np.zeros(len(positions), dtype='uint32')
+    for cp, bit_shift in parts:
+        words |= cp.value_at(positions) << np.uint32(bit_shift)
+    return ChangePoints.from_changes(positions, words, n_samples)
+
+
+def select_held_samples(voltages, tolerances, max_step=16):
+    """Returns the indices of the samples of voltages to keep, so that the
+    output stays within tolerances of voltages.
+
+    voltages is an array with one row per channel and one column per sample.
+    A DAQ card holds the last sample until its next clock edge, so when a
+    sample is dropped the output holds the value of the last kept sample. A
+    sample is kept as soon as any channel differs from its value at the last
+    kept sample by more than its element of tolerances. The first and last
+    samples are always kept.
+    """
+    n_samples = voltages.shape[1]
+    tolerances = np.asarray(tolerances, dtype=float).reshape(-1, 1)
+
+    def is_outside(start, offset):
+        return (np.abs(voltages[:, start + offset] - voltages[:, start]) >
+                tolerances).any(axis=0)
+
+    # next_kept[i] is the first sample after i which is outside the band of
+    # sample i, if it is at most max_step samples away, else 0. This is done
+    # for all samples at once, one step at a time, so that the walk below
+    # only searches where samples are far apart. When a step resolves few
+    # samples, the samples are far apart and searching is cheaper.
+    next_kept = np.zeros(n_samples, dtype='int64')
+    unresolved = np.arange(n_samples - 1)
+    step = 0
+    for step in range(1, max_step + 1):
+        unresolved = unresolved[unresolved + step < n_samples]
+        outside = is_outside(unresolved, step)
+        next_kept[unresolved[outside]] = unresolved[outside] + step
+        n_unresolved = len(unresolved)
+        unresolved = unresolved[~outside]
+        if n_unresolved - len(unresolved) < n_unresolved/32:
+            break
+    next_kept = next_kept.tolist()
+
+    keep = [0]
+    last = 0
+    while True:
+        found = next_kept[last]
+        start = last + step + 1
+        window = 64
+        while not found and start < n_samples:
+            # look for the first sample outside the band in windows that grow
+            # while nothing is found
+            stop = min(start + window, n_samples)
+            outside = np.flatnonzero(is_outside(np.array([last]),
+                                                np.arange(start - last,
+                                                          stop - last)))
+            if len(outside):
+                found = start + outside[0]
+            start = stop
+            window *= 2
+        if not found:
+            break
+        keep.append(found)
+        last = found
+    if keep[-1] != n_samples - 1:
+        keep.append(n_samples - 1)
+    return np.array(keep)
+
+
+def voltages_to_codes(voltages, dac_range=10.0, dac_bits=16,
+                      coefficients=None):
+    """Returns the DAC codes of voltages as an int16 array of the same shape.
+
+    dac_range(float) - the output range is -dac_range to dac_range volts.
+    dac_bits(int) - resolution of the DAC, at most 16.
+    coefficients(list) - optional calibration of the card, c0, c1, c2...
+        such that code = c0 + c1*V + c2*V**2 + ... This is the AO device
+        scaling of NI-DAQmx, see daq.get_ao_scaling_coefficients. Without a
+        calibration, code = V*2**(dac_bits-1)/dac_range.
+
+    Codes are rounded to the nearest integer and clipped to the range of the
+    DAC.
+    """
+    if coefficients is None:
+        codes = voltages * (2**(dac_bits - 1)/float(dac_range))
+    else:
+        codes = np.polyval(list(reversed(coefficients)), voltages)
+    codes = np.rint(codes, out=codes)
+    np.clip(codes, -2**(dac_bits - 1), 2**(dac_bits - 1) - 1, out=codes)
+    return codes.astype('int16')
+
+
+def select_changed_samples(codes):
+    """Returns the indices of the samples where the DAC code of any channel
+    changes from the previous sample.
+
+    codes is an array of DAC codes (see voltages_to_codes) with one row per
+    channel and one column per sample. A DAQ card holds the last sample until
+    its next clock edge, so dropping the other samples does not change the
+    output if the card is written these codes. If it is written voltages, it
+    converts them with its own calibration, and a dropped sample can differ
+    from the held one by one LSB, so dropping is only lossless to within one
+    LSB. The first and last samples are always kept.
+    """
+    n_samples = codes.shape[1]
+    changed = (codes[:, 1:] != codes[:, :-1]).any(axis=0)
+    keep = np.flatnonzero(changed) + 1
+    if n_samples == 1:
+        return np.array([0])
+    if len(keep) == 0 or keep[-1] != n_samples - 1:
+        keep = np.append(keep, n_samples - 1)
+    return np.concatenate(([0], keep))
+
+
+def _tick_step(resolution, tick):
+    """Returns resolution/tick, and the same as an int if it is a whole
+    number of ticks, else None."""
+    step = resolution/tick
+    int_step = int(round(step))
+    if int_step >= 1 and abs(step - int_step) < 1e-6:
+        return step, int_step
+    return step, None
+
+
+def region_ticks(start_tick, end_tick, resolutions, tick):
+    """Returns the sample ticks of a ramp region from start_tick up to, but
+    not including, end_tick.
+
+    Ticks are int64 multiples of tick (the jump_resolution, in ms). Every
+    resolution (in ms) in resolutions gives a grid start + k*resolution.
+    With several resolutions, the region is sampled on the union of their
+    grids. Samples which fall on the same tick are merged, since they would
+    be on the same sample of the trigger line.
+    """
+    grids = []
+    exact = True
+    for resolution in resolutions:
+        step, int_step = _tick_step(resolution, tick)
+        # find number of time steps
+        n_time_steps = int(round((end_tick - start_tick)/step))
+        if int_step is not None:
+            grids.append(np.arange(n_time_steps, dtype='int64')*int_step)
+        else:
+            # a resolution which is not a whole number of ticks
+            exact = False
+            grids.append(np.rint(np.arange(n_time_steps)*step).astype('int64'))
+    if len(grids) == 1 and exact:
+        offsets = grids[0]
+    else:
+        offsets = np.unique(np.concatenate(grids))
+        if not exact:
+            # resolutions below a tick can round up to the next region
+            offsets = offsets[offsets < end_tick - start_tick]
+    offsets += start_tick
+    return offsets
+
+
+def count_region_ticks(start_tick, end_tick, resolutions, tick):
+    """Returns len(region_ticks(start_tick, end_tick, resolutions, tick))
+    without building the ticks.
+
+    The count is exact when every resolution is a whole number of ticks,
+    else it is an upper bound.
+    """
+    span = int(end_tick - start_tick)
+    grids = []
+    for resolution in resolutions:
+        step, int_step = _tick_step(resolution, tick)
+        grids.append((int_step, int(round(span/step))))
+    if len(grids) == 1 and grids[0][0] is not None:
+        return grids[0][1]
+    if any(int_step is None for int_step, _ in grids) or len(grids) > 8:
+        return min(span, sum(n for _, n in grids))
+    # inclusion-exclusion: the ticks shared by a subset of grids are the
+    # multiples of the lcm of their steps, below the end of the shortest
+    count = 0
+    for n_grids in range(1, len(grids) + 1):
+        for subset in itertools.combinations(grids, n_grids):
+            lcm = 1
+            for int_step, _ in subset:
+                lcm = lcm*int_step//fractions.gcd(lcm, int_step)
+            limit = min(int_step*n for int_step, n in subset)
+            n_common = -(-limit // lcm)
+            if n_grids % 2:
+                count += n_common
+            else:
+                count -= n_common
+    return count
+
+
+def make_sample_ticks(key_ticks, ramp_regions, tick, ramp_resolution):
+    """Returns the ticks of the samples of an analog device and the index of
+    the first sample of every keyframe region in them.
+
+    key_ticks(numpy.array of int64) - ticks of the sorted keyframes, see
+        KeyFrameList.get_key_ticks.
+    ramp_regions - for every region between keyframes, 0 or an empty tuple
+        if the device only needs a sample at its start, else a tuple of the
+        resolutions its channels ramp with (or any other non zero number to
+        ramp with ramp_resolution).
+    tick(float) - the jump_resolution in ms.
+
+    The last sample is at the last keyframe. The index returned for the last
+    keyframe is that sample.
+    """
+    parts = []
+    for region_number, ramp_or_jump in enumerate(ramp_regions):
+        if not np.any(ramp_or_jump):
+            parts.append(key_ticks[region_number:region_number + 1])
+        else:
+            if isinstance(ramp_or_jump, tuple):
+                resolutions = ramp_or_jump
+            else:
+                resolutions = (ramp_resolution,)
+            parts.append(region_ticks(key_ticks[region_number],
+                                      key_ticks[region_number + 1],
+                                      resolutions, tick))
+    parts.append(key_ticks[-1:])
+    kf_positions = np.zeros(len(parts), dtype='int64')
+    np.cumsum([len(part) for part in parts[:-1]], out=kf_positions[1:])
+    return np.concatenate(parts).astype('int64'), kf_positions
+
+
 # Analog Ramp functions
 
 
@@ -538,6 +1136,32 @@ def analog_cubic_ramp(ramp_data, start_time, end_time, value_final,
     return analog_jump_ramp(ramp_data, start_time, end_time, value_final,
                             time_subarray)
 
+
+def get_expr_parameters(ramp_data):
+    """Returns a dict with the named parameters of an expr ramp, every
+    number in ramp_data which is not a ramp variable."""
+    return dict((k, v) for k, v in ramp_data.items()
+                if k not in conversion.ramp_variable_names and
+                isinstance(v, (int, long, float)) and
+                not isinstance(v, bool))
+
+
+def analog_expr_ramp(ramp_data, start_time, end_time, value_final,
+                     time_subarray, out=None):
+    """Evaluates the formula ramp_data["expr"] of t, t0, t1, v0, v1 and the
+    named parameters in ramp_data, see conversion.compile_ramp_expression.
+
+    The result is written to out if it is given.
+    """
+    variables = get_expr_parameters(ramp_data)
+    ramp_expression = conversion.compile_ramp_expression(ramp_data["expr"],
+                                                         variables.keys())
+    variables.update({'t': time_subarray, 't0': start_time, 't1': end_time,
+                      'v0': ramp_data["value"], 'v1': value_final})
+    if out is None:
+        out = np.empty(time_subarray.shape, dtype=float)
+    return ramp_expression(variables, out)
+
 # Digital ramp functions start here
 
 
@@ -555,6 +1179,142 @@ def digital_pulsetrain_ramp(ramp_data, start_time, end_time, state,
     return train
 
 
+# Vectorized analog ramp functions
+#
+# These evaluate every segment of one ramp type in a single pass. p is a dict
+# of per-segment arrays with the ramp data, "start_time", "end_time" and
+# "next_value" (the value at the next keyframe). seg holds the segment number
+# of each sample, t the time of each sample and the result is written to out.
+
+
+def analog_linear_segments(p, seg, t, out):
+    np.subtract(t, p['start_time'][seg], out=out)
+    out /= (p['end_time'] - p['start_time'])[seg]
+    value_initial = 1.0 - out
+    value_initial *= p['value'][seg]
+    out *= p['next_value'][seg]
+    out += value_initial
+
+
+def analog_linear2_segments(p, seg, t, out):
+    p = dict(p, next_value=p['value_final'])
+    analog_linear_segments(p, seg, t, out)
+
+
+def analog_quadratic_segments(p, seg, t, out):
+    delta_t = p['end_time'] - p['start_time']
+    delta_v = p['next_value'] - p['value']
+    curvature = (delta_v - p['slope']*delta_t)/delta_t**2
+    _quadratic_segments(p['value'], p['slope'], curvature, p, seg, t, out)
+
+
+def analog_quadratic2_segments(p, seg, t, out):
+    delta_t = p['end_time'] - p['start_time']
+    delta_v = p['next_value'] - p['value']
+    slope = (delta_v - p['curvature']*delta_t**2)/delta_t
+    _quadratic_segments(p['value'], slope, p['curvature'], p, seg, t, out)
+
+
+def _quadratic_segments(value_initial, slope, curvature, p, seg, t, out):
+    tmt0 = np.subtract(t, p['start_time'][seg])
+    np.multiply(tmt0, slope[seg], out=out)
+    out += value_initial[seg]
+    np.square(tmt0, out=tmt0)
+    tmt0 *= curvature[seg]
+    out += tmt0
+
+
+def analog_exp_segments(p, seg, t, out):
+    # segments with tau == 0 are handed over to jump by
+    # evaluate_analog_segments
+    tau = p['tau']
+    delta_t = p['end_time'] - p['start_time']
+    delta_v = p['next_value'] - p['value']
+    b = delta_v/(np.exp(delta_t/tau) - 1.0)
+    a = p['value'] - b
+    np.subtract(t, p['start_time'][seg], out=out)
+    out /= tau[seg]
+    np.exp(out, out=out)
+    out *= b[seg]
+    out += a[seg]
+
+
+def analog_sine_segments(p, seg, t, out):
+    omega = 2.0*np.pi*p['freq']
+    np.subtract(t, p['start_time'][seg], out=out)
+    out *= omega[seg]
+    out += p['phase'][seg]
+    np.sin(out, out=out)
+    out *= p['amp'][seg]
+    out += p['value'][seg]
+
+
+def analog_jump_segments(p, seg, t, out):
+    np.take(p['value'], seg, out=out)
+
+
+def evaluate_analog_segments(segments, time_array, voltages):
+    """Evaluates analog ramp segments and writes them into voltages.
+
+    segments - list of tuples (start_pos, end_pos, key_dict, next_value).
+        key_dict is the channel data at the keyframe where the segment starts
+        and next_value is the value at the keyframe where it ends. The
+        segment covers time_array[start_pos:end_pos].
+    time_array - time of every sample.
+    voltages - array of the same length as time_array, modified in place.
+
+    Segments are grouped by ramp type and each ramp type is evaluated over
+    all of its segments at once. Ramp types without a vectorized function are
+    evaluated one segment at a time with analog_ramp_functions.
+    """
+    grouped = {}
+    for segment in segments:
+        start_pos, end_pos, key_dict, next_value = segment
+        if end_pos <= start_pos:
+            continue
+        ramp_type = key_dict['ramp_type']
+        if ramp_type == 'exp' and key_dict['ramp_data']['tau'] == 0:
+            ramp_type = 'jump'
+        if ramp_type == 'expr':
+            # evaluated straight into voltages
+            analog_expr_ramp(key_dict['ramp_data'], time_array[start_pos],
+                             time_array[end_pos], next_value,
+                             time_array[start_pos:end_pos],
+                             out=voltages[start_pos:end_pos])
+            continue
+        if ramp_type not in analog_ramp_vector_functions:
+            ramp_function = analog_ramp_functions[ramp_type]
+            voltages[start_pos:end_pos] = ramp_function(
+                key_dict['ramp_data'], time_array[start_pos],
+                time_array[end_pos], next_value,
+                time_array[start_pos:end_pos])
+            continue
+        grouped.setdefault(ramp_type, []).append(segment)
+
+    for ramp_type, type_segments in grouped.items():
+        starts = np.array([sg[0] for sg in type_segments], dtype=int)
+        ends = np.array([sg[1] for sg in type_segments], dtype=int)
+        lengths = ends - starts
+        # segment number and position of every sample of this ramp type
+        seg = np.repeat(np.arange(len(type_segments)), lengths)
+        sample_index = np.arange(len(seg))
+        sample_index += np.repeat(starts - np.cumsum(lengths) + lengths,
+                                  lengths)
+
+        p = {'start_time': time_array[starts],
+             'end_time': time_array[ends],
+             'next_value': np.array([sg[3] for sg in type_segments],
+                                    dtype=float)}
+        for parm_name in analog_ramp_types[ramp_type]:
+            p[parm_name] = np.array([sg[2]['ramp_data'][parm_name]
+                                     for sg in type_segments], dtype=float)
+
+        out = np.empty(len(seg), dtype=float)
+        analog_ramp_vector_functions[ramp_type](p, seg,
+                                                time_array[sample_index], out)
+        voltages[sample_index] = out
+
+
 analog_ramp_types = {"jump": ["value"],
                      "quadratic": ["value", "slope"],
                      "linear": ["value"],
@@ -562,7 +1322,11 @@ analog_ramp_types = {"jump": ["value"],
                      "cubic": ["value", "slope_left", "slope_right"],
                      "sine": ["value", "amp", "freq", "phase"],
                      "quadratic2": ["value", "curvature"],
-                     "exp": ["value", "tau"]}
+                     "exp": ["value", "tau"],
+                     "expr": ["value", "a", "b", "c"]}
+
+# ramp_data entries which are not numbers, with the values of new segments
+ramp_type_defaults = {"expr": {"expr": "v0 + (v1 - v0)*(t - t0)/(t1 - t0)"}}
 
 digital_ramp_types = {"jump": [],
                       "pulsetrain": ["freq", "phase", "duty_cycle"]}
@@ -574,7 +1338,18 @@ analog_ramp_functions = {"jump": analog_jump_ramp,
                          "cubic": analog_cubic_ramp,
                          "sine": analog_sine_ramp,
                          "quadratic2": analog_quadratic2_ramp,
-                         "exp": analog_exp_ramp}
+                         "exp": analog_exp_ramp,
+                         "expr": analog_expr_ramp}
+
+# cubic is not implemented yet and jumps, like analog_cubic_ramp
+analog_ramp_vector_functions = {"jump": analog_jump_segments,
+                                "linear": analog_linear_segments,
+                                "linear2": analog_linear2_segments,
+                                "quadratic": analog_quadratic_segments,
+                                "cubic": analog_jump_segments,
+                                "sine": analog_sine_segments,
+                                "quadratic2": analog_quadratic2_segments,
+                                "exp": analog_exp_segments}
 
 digital_ramp_functions = {"jump": digital_jump_ramp,
                           "pulsetrain": digital_pulsetrain_ramp}
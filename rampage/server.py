@@ -1,8 +1,9 @@
 """This module handles running the ramps on the experiment."""
+import copy
+import ctypes
 import inspect
 import json
 import os
-import numpy as np
 import threading
 import Queue
 import datetime
@@ -11,9 +12,18 @@ import stat
 import time
 import logging
 import logging.handlers
+import multiprocessing.pool
 import zmq
 
-from rampage import ramps
+from rampage.artifact import save_shot
+from rampage.cache import ShotCache, hash_ramp_data
+from rampage.compiler import (RampCompiler, analog_device_names,
+                              digital_channel_ids, estimate_shot_size,
+                              get_analog_ids)
+from rampage.conversion import check_conversion, check_ramp_expression
+from rampage.daq.settings import expt_settings
+from rampage.ramps import get_expr_parameters
+from rampage.pipeline import LookAheadCompiler
 from rampage.zmq_server import RequestProcessor, ClientForServer
 #from rampage.widgets.DictEditor import DropDownSelection
 
@@ -68,6 +78,33 @@ if __name__ == '__main__':
                                      'tcp://192.168.0.116:5561')
 
 main_package_dir = os.path.dirname(__file__)
+default_shot_cache_mb = 512
+default_look_ahead = 0
+# threads which render a shot, see RampCompiler.make_ramps. Rendering holds
+# the interpreter lock for most of its time: 2 threads were only 1.06 times
+# faster on a multi core machine, and 0.78 times as fast on a single core.
+default_render_threads = 1
+# number of cards a shot is uploaded to at the same time, see daq.TaskManager
+default_upload_threads = 4
+# save the compiled shot next to the json log of every shot, see artifact.py
+default_log_compiled_shots = 0
+# limits of the shots accepted by queue_ramp, see check_shot_size. The sample
+# rate is the rate the digital task is configured for.
+default_shot_limits = {
+    'max_sample_rate': float(expt_settings.max_expected_rate),
+    'max_analog_samples': float(16*2**20),
+    'max_digital_samples': float(2**28),
+    'max_shot_mb': 2048.0}
+# fraction of a limit above which queue_ramp warns
+shot_limit_warning = 0.8
+# states DaqThread goes through for every shot, see DaqThread.run
+daq_states = ('idle', 'compiling', 'uploading', 'running', 'settling',
+              'logging')
+# longest time DaqThread blocks on an event before checking stoprequest, in s
+event_wait_time = 0.1
+# time after the expected end of a shot after which DaqThread polls the
+# digital task, in case its DoneCallback was lost, in s
+done_grace_time = 1.0
 
 
 class Hooks(object):
@@ -401,77 +438,257 @@ class DaqThread(threading.Thread):
         self.abort = threading.Event()
 
         self.digital_task = None
+        # created when the first shot is uploaded
+        self.task_manager = None
 
-        self.task_running = False
         self.ramp_generated = False
-        self.waiting_after_running = False
         self.current_data = None
+        # cache.hash_ramp_data of current_data, see daq.TaskManager.load_shot
+        self.ramp_hash = None
+        self.wait_time_after_running = 0.0
 
         self.prev_data_list = []
 
+        # one of daq_states and the monotonic_time() it was entered at
+        self.state = 'idle'
+        self.state_start_time = monotonic_time()
+        self.state_lock = threading.Lock()
+
         self.main_log_dir = get_log_dir()
+        self.log_compiled_shots = get_log_compiled_shots()
+        # compiled output of the shot running on the cards
+        self.running_out = None
+        self.shot_cache = ShotCache(get_shot_cache_size())
+        # compiler of the last shot which was not in the cache. The next shot
+        # only renders channels which changed since then.
+        self.last_compiler = None
+
+        # number of threads which render the devices and channels of a shot
+        self.render_threads = get_render_threads()
+        if self.render_threads > 1:
+            self.render_pool = multiprocessing.pool.ThreadPool(
+                self.render_threads)
+        else:
+            self.render_pool = None
+
+        # number of queued shots which are compiled ahead in a worker process
+        # while the current shot is running. 0 compiles in this thread.
+        self.look_ahead_depth = get_look_ahead_depth()
+        if self.look_ahead_depth > 0:
+            self.look_ahead = LookAheadCompiler(self.render_threads)
+        else:
+            self.look_ahead = None
+        self.clear_request = threading.Event()
 
     def run(self):
-        # As long as we weren't asked to stop, try to take new tasks from the
-        # queue. The tasks are taken with a blocking 'get', so no CPU
-        # cycles are wasted while waiting.
-        # Also, 'get' is given a timeout, so stoprequest is always checked,
-        # even if there's nothing in the queue.
+        # Every shot goes through the states of daq_states. Each state blocks
+        # on an event with a timeout of at most event_wait_time: the queue
+        # while idle, the DoneCallback of the digital task while running and
+        # the stop request while settling, so no CPU cycles are wasted while
+        # waiting and stoprequest is always checked.
         while not self.stoprequest.isSet():
-            self.running.wait()
+            if not self.running.wait(event_wait_time):
+                # paused, no shot is compiled or run
+                self.set_state('idle')
+                continue
+            if self.clear_request.isSet():
+                self.clear_request.clear()
+                if self.look_ahead is not None:
+                    self.look_ahead.clear()
             if not self.ramp_generated:
-                try:
-                    self.current_data = self.data_q.get(True, 0.05)
-                    self.prev_data_list.append(self.current_data)
-                    logging.info('New task received')
-                except Queue.Empty:
-                    pass
+                if self.look_ahead is not None and len(self.look_ahead) > 0:
+                    self.set_state('compiling')
                 else:
-                    # there is data in the queue, which means there is a task
-                    # pending to be done
-                    logging.info('Making ramps')
-                    start_making_time = datetime.datetime.now()
-                    self.ramp_out = make_ramps(self.current_data)
-                    end_making_time = datetime.datetime.now()
-                    dt = end_making_time - start_making_time
-                    logging.info('Took {0} to make ramps'.format(dt))
-                    self.ramp_generated = True
-
-            if self.task_running:
-                # check if task is done
-                if self.digital_task.is_task_done:
-                    self.task_running = False
-                    self.task_end_time = datetime.datetime.now()
-                    self.waiting_after_running = True
-                    self.log_ramps()
-
-                    logging.info('Task done')
-                    dt = self.task_end_time - self.task_start_time
-                    logging.info('Task running length {0}'.format(dt))
-
-            elif self.waiting_after_running:
-                delta_t = datetime.datetime.now() - self.task_end_time
-                time_elapsed_after_task_end = delta_t.total_seconds()*1000
-                if time_elapsed_after_task_end > self.wait_time_after_running:
-                    logging.info('Waiting time is : ' + str(self.wait_time_after_running))
-                    logging.info('Waited for {0} ms'.format(time_elapsed_after_task_end))
-                    self.waiting_after_running = False
-
-            elif self.ramp_generated:
-                properties = self.prev_data_list[0]['properties']
-                if 'wait_after_running' in properties:
-                    self.wait_time_after_running = properties['wait_after_running']
-                else:
-                    self.wait_time_after_running = 0.0
-                self.clear_tasks()
-                # if not, and if we have a generated ramp, upload it and run
-
-                self.upload_and_start_tasks()
-
-                logging.info('Task started at {0}'.format(self.task_start_time))
+                    self.set_state('idle')
+                self.prepare_next_shot(event_wait_time)
+                continue
+
+            self.set_state('uploading')
+            self.start_next_shot()
+            self.set_state('running')
+            if not self.wait_for_task():
+                break
+            self.set_state('settling')
+            self.settle()
+            self.set_state('logging')
+            self.log_ramps()
+            logging.info('Task done')
+            self.log_underruns()
+            dt = self.task_end_time - self.task_start_time
+            logging.info('Task running length {0}'.format(dt))
+
+        if self.look_ahead is not None:
+            self.look_ahead.close()
+        self.clear_tasks()
+
+    def set_state(self, state):
+        """Enters state, one of daq_states."""
+        with self.state_lock:
+            if state != self.state:
+                self.state = state
+                self.state_start_time = monotonic_time()
+
+    def get_state(self):
+        """Returns a dict with the current state and the time spent in it, in
+        seconds."""
+        with self.state_lock:
+            return {'state': self.state,
+                    'time_in_state': monotonic_time() - self.state_start_time}
+
+    def prepare_next_shot(self, timeout):
+        """Takes the next shot from the queue and compiles it, waiting up to
+        timeout seconds for one, unless a shot is already waiting to be
+        uploaded. Returns True if a shot is ready to be uploaded."""
+        if self.ramp_generated:
+            if self.look_ahead is not None:
+                self.fill_look_ahead()
+            return True
+        shot = self.take_next_shot(timeout)
+        if shot is None:
+            return False
+        self.current_data, self.ramp_out, self.ramp_hash = shot
+        self.prev_data_list.append(self.current_data)
+        logging.info('Shot cache: {hits} hits, {misses} misses, '
+                     '{n_shots} shots, {total_bytes} bytes'
+                     .format(**self.shot_cache.get_stats()))
+        digital_words = self.ramp_out[0]
+        logging.info('Digital words: {0} samples, {1} changes'
+                     .format(len(digital_words), len(digital_words.positions)))
+        self.ramp_generated = True
+        return True
+
+    def start_next_shot(self):
+        """Uploads the prepared shot to the cards and starts it."""
+        properties = self.prev_data_list[0]['properties']
+        self.wait_time_after_running = properties.get('wait_after_running',
+                                                      0.0)
+        self.upload_and_start_tasks()
+        logging.info('Task started at {0}'.format(self.task_start_time))
+        self.ramp_generated = False
 
-                self.task_running = True
-                self.ramp_generated = False
+    def wait_for_task(self):
+        """Waits for the DoneCallback of the digital task, preparing the next
+        shot meanwhile. Returns False if the thread was asked to stop first.
+
+        If the task is still not done done_grace_time seconds after its
+        expected duration, it is polled, in case the callback was lost.
+        """
+        task = self.digital_task
+        poll_time = (self.state_start_time + task.expected_duration() +
+                     done_grace_time)
+        while not task.done_event.is_set():
+            if self.stoprequest.isSet():
+                return False
+            self.prepare_next_shot(0.0)
+            task.done_event.wait(event_wait_time)
+            if monotonic_time() > poll_time and task.isDone():
+                logging.warning('Digital task is done but DoneCallback was '
+                                'not called')
+                break
+        self.task_end_time = datetime.datetime.now()
+        self.task_end_monotonic = monotonic_time()
+        return True
+
+    def settle(self):
+        """Waits until wait_after_running ms after the end of the task,
+        preparing the next shot meanwhile."""
+        settle_end = (self.task_end_monotonic +
+                      self.wait_time_after_running/1000.0)
+        while not self.stoprequest.isSet():
+            remaining = settle_end - monotonic_time()
+            if remaining <= 0.0:
+                break
+            self.prepare_next_shot(0.0)
+            self.stoprequest.wait(min(remaining, event_wait_time))
+        logging.info('Waiting time is : ' + str(self.wait_time_after_running))
+        logging.info('Waited for {0} ms'.format(
+            (monotonic_time() - self.task_end_monotonic)*1000))
+
+    def take_next_shot(self, timeout=0.05):
+        """Returns a tuple (ramp_data, ramp_out, ramp_hash) of the next shot
+        in the queue, or None if there is no shot ready after timeout
+        seconds. ramp_hash is cache.hash_ramp_data of ramp_data before it was
+        compiled."""
+        if self.look_ahead is None:
+            try:
+                data = self.data_q.get(True, timeout)
+            except Queue.Empty:
+                return None
+            if self.state == 'idle':
+                self.set_state('compiling')
+            logging.info('New task received')
+            logging.info('Making ramps')
+            start_making_time = datetime.datetime.now()
+            ramp_hash = hash_ramp_data(data)
+            ramp_out = self.make_ramps(data, ramp_hash)
+            end_making_time = datetime.datetime.now()
+            dt = end_making_time - start_making_time
+            logging.info('Took {0} to make ramps'.format(dt))
+            return data, ramp_out, ramp_hash
+
+        if len(self.look_ahead) == 0:
+            try:
+                data = self.data_q.get(True, timeout)
+            except Queue.Empty:
+                return None
+            self.look_ahead.submit(data, self.shot_cache.get(data))
+            if self.state == 'idle':
+                self.set_state('compiling')
+        self.fill_look_ahead()
+        shot = self.look_ahead.get_next(timeout)
+        if shot is None:
+            return None
+        data, out, info, error = shot
+        logging.info('New task received')
+        # the worker compiled a copy, so data is not modified yet
+        ramp_hash = hash_ramp_data(data)
+        if out is None:
+            logging.error('Look ahead compilation failed\n' + error)
+            # compile here, so that errors show up as without look ahead
+            return data, self.make_ramps(data, ramp_hash), ramp_hash
+        # out is mapped from a file, which must not be kept alive by the
+        # cache, so only shots compiled by make_ramps are cached
+        if info is not None:
+            logging.info('Took {0} s to make ramps ahead'.format(
+                info['compile_time']))
+            log_sample_counts(info['sample_counts'])
+        return data, out[:-1] + (resolve_hooks(out[-1]),), ramp_hash
+
+    def fill_look_ahead(self):
+        """Sends queued shots to the look ahead compiler until
+        look_ahead_depth shots are pending. Shots in the cache are not
+        compiled again."""
+        while len(self.look_ahead) < self.look_ahead_depth:
+            try:
+                data = self.data_q.get(False)
+            except Queue.Empty:
+                return
+            self.look_ahead.submit(data, self.shot_cache.get(data))
+
+    def make_ramps(self, data, ramp_hash=None):
+        """Returns the compiled shot of data with hooks resolved.
+
+        Takes the shot from the cache if possible, otherwise compiles it
+        reusing the unchanged channels of the last compiled shot. ramp_hash
+        is cache.hash_ramp_data(data), computed here if it is not given.
+        Compiling modifies data, so the shot is stored under the hash from
+        before.
+        """
+        if ramp_hash is None:
+            ramp_hash = hash_ramp_data(data)
+        out = self.shot_cache.get(data, ramp_hash)
+        if out is None:
+            self.last_compiler = RampCompiler(data,
+                                              previous=self.last_compiler)
+            out = self.last_compiler.make_ramps(self.render_pool)
+            self.shot_cache.put(data, out, ramp_hash)
+            log_sample_counts(self.last_compiler.sample_counts)
+            changed_channels = self.last_compiler.changed_channels
+            if changed_channels is not None:
+                logging.info('Rendered {0} of {1} channels'.format(
+                    len(changed_channels),
+                    len(self.last_compiler.channel_list)))
+        return out[:-1] + (resolve_hooks(out[-1]),)
 
     def log_ramps(self):
         log_data = self.prev_data_list.pop(0)
@@ -494,34 +711,55 @@ class DaqThread(threading.Thread):
         log_string = '\n'.join([ls1, ls2])
         log_data['properties']['run_details'] = log_string
         fname = self.task_start_time.strftime('%H-%M-%S')
-        fname += '.json'
         folder_name = make_folder_for_today(self.main_log_dir)
-        fname = os.path.join(folder_name, fname)
+        base_name = os.path.join(folder_name, fname)
+        fname = base_name + '.json'
         with open(fname, 'w') as f:
             json.dump(log_data, f)
         # make the logged file read only
         os.chmod(fname, stat.S_IREAD)
+        if self.log_compiled_shots:
+            shot_name = base_name + '.shot'
+            save_shot(self.running_out, shot_name)
+            os.chmod(shot_name, stat.S_IREAD)
+
+    def log_underruns(self):
+        """Logs if the digital task of the last shot ran out of samples while
+        streaming, see daq.ChunkedWriter."""
+        writer = getattr(self.digital_task, 'writer', None)
+        if writer is not None and (writer.underrun or
+                                   not writer.is_complete()):
+            logging.error('Digital task ran out of samples, the shot was not '
+                          'output correctly')
 
     def clear_tasks(self):
         logging.info('Clearing tasks')
-        if self.digital_task is not None:
-            self.dev1_task.ClearTask()
-            self.dev2_task.ClearTask()
-            self.dev3_task.ClearTask()
-            self.dev4_task.ClearTask()
-            self.digital_task.ClearTask()
+        if self.task_manager is not None:
+            self.task_manager.close()
+            self.task_manager = None
             # print('Reseting clock to high')
             # daq.reset_analog_sample_clock(False)
 
     def upload_and_start_tasks(self):
-        daq.reset_analog_sample_clock()
+        # the tasks are kept between shots, see daq.TaskManager
+        if self.task_manager is None:
+            self.task_manager = daq.TaskManager(get_upload_threads())
         out = self.ramp_out
-        dev1_task, dev2_task, dev3_task, dev4_task, digital_task = daq.create_all_tasks(*out)
-        dev1_task.StartTask()
-        dev2_task.StartTask()
-        dev3_task.StartTask()
-        dev4_task.StartTask()
-        digital_task.StartTask()
+        self.running_out = out
+        start_time = time.time()
+        dev1_task, dev2_task, dev3_task, dev4_task, digital_task = \
+            self.task_manager.load_shot(*out, shot_hash=self.ramp_hash)
+        logging.info('Uploaded in {0:.3f} s, {1} tasks reused, {2} created, '
+                     '{3} unchanged buffers not written'
+                     .format(time.time() - start_time,
+                             self.task_manager.n_reused,
+                             self.task_manager.n_created,
+                             self.task_manager.n_skipped))
+        upload_times = self.task_manager.upload_times
+        logging.info('Upload time per task: ' + ', '.join(
+            '{0} {1:.3f} s'.format(name, upload_times[name])
+            for name in self.task_manager.get_task_names()))
+        self.task_manager.start()
         self.dev1_task = dev1_task
         self.dev2_task = dev2_task
         self.dev3_task = dev3_task
@@ -538,6 +776,7 @@ class BECServer(RequestProcessor):
     def __init__(self, bind_port):
         RequestProcessor.__init__(self, bind_port)
         self.ramps_queue = Queue.Queue()
+        self.shot_limits = get_shot_limits()
         self.daq_thread = DaqThread(self.ramps_queue)
         self.daq_thread.start()
 
@@ -553,8 +792,28 @@ class BECServer(RequestProcessor):
 
     def queue_ramp(self, mesg):
         # print('Queueing ramp')
+        try:
+            _, errors, warnings = check_shot_size(mesg, self.shot_limits)
+        except Exception:
+            # the compiler reports broken ramps when it gets to them
+            logging.exception('Could not estimate the size of the shot')
+            errors, warnings = [], []
+        for warning in warnings:
+            logging.warning(warning)
+        if errors:
+            for error in errors:
+                logging.error('Shot rejected: ' + error)
+            return {'status': 'error', 'errors': errors, 'warnings': warnings}
         self.ramps_queue.put(mesg)
-        reply = {'status': 'ok'}
+        reply = {'status': 'ok', 'warnings': warnings}
+        return reply
+
+    def estimate_shot_size(self, mesg):
+        """Returns the estimated size of the shot mesg and the limits it
+        breaks, without compiling it, see check_shot_size."""
+        estimate, errors, warnings = check_shot_size(mesg, self.shot_limits)
+        reply = {'status': 'ok', 'estimate': estimate, 'errors': errors,
+                 'warnings': warnings}
         return reply
 
     def clear_queue(self, mesg):
@@ -566,6 +825,8 @@ class BECServer(RequestProcessor):
                 self.current_data = self.ramps_queue.get(False)
             except Queue.Empty:
                 done = True
+        # shots taken from the queue for look ahead compilation
+        self.daq_thread.clear_request.set()
         reply = {'status': 'ok'}
         return reply
 
@@ -576,29 +837,24 @@ class BECServer(RequestProcessor):
         reply = {'comment_list': ['bla']}
         return reply
 
+    def get_state(self, mesg):
+        """Returns the state of the DAQ thread and the time spent in it, see
+        DaqThread.get_state."""
+        reply = self.daq_thread.get_state()
+        reply['status'] = 'ok'
+        return reply
+
+    def get_cache_stats(self, mesg):
+        reply = self.daq_thread.shot_cache.get_stats()
+        reply['status'] = 'ok'
+        return reply
+
     def abort_current_run(self, mesg):
         print(mesg)
         reply = {'status': 'ok'}
         return reply
 
 
-def digital_channel_ids():
-    """Returns list of digital channels used in the experiment."""
-    line_fmt = 'Dev1/port0/line{0:02d}'
-    line_ids = [line_fmt.format(n) for n in range(5, 31)]
-    return line_ids
-
-
-def get_analog_ids(dev_name="Dev2"):
-    if dev_name == "Dev1":
-        n_channels = 4
-    else:
-        n_channels = 8
-    line_fmt = dev_name + "/ao{0:1d}"
-    line_ids = [line_fmt.format(n) for n in range(n_channels)]
-    return line_ids
-
-
 def dev1_analog_ids():
     return get_analog_ids("Dev1")
 
@@ -637,13 +893,27 @@ def get_analog_channels(channel_list, dev_name="Dev2"):
     return analog_channels
 
 
+def log_sample_counts(sample_counts):
+    """Logs how many samples of every analog device were dropped, see
+    RampCompiler.make_analog_devices."""
+    for dev_name in analog_device_names:
+        if dev_name not in sample_counts:
+            continue
+        n_grid, n_out = sample_counts[dev_name]
+        logging.info('{0}: {1} of {2} samples, compression {3:.1f}x'.format(
+            dev_name, n_out, n_grid, float(n_grid)/max(n_out, 1)))
+
+
 def make_callback_list(ramp_data):
-    keyframe_list = ramps.KeyFrameList(ramp_data['keyframes'])
+    return resolve_hooks(RampCompiler(ramp_data).make_hooks_list())
+
+
+def resolve_hooks(hooks_list):
+    """Replaces hook names in hooks_list with functions from Hooks."""
     callback_list = []
-    for hook_item in keyframe_list.get_hooks_list():
-        time = hook_item[0]*1e-3  # ramps have time in ms, convert to s
+    for time, hook_items in hooks_list:
         funcs_list = []
-        for func_name, func_dict in hook_item[1]:
+        for func_name, func_dict in hook_items:
             func = global_hooks_object.function_dict[func_name]
             # print('adding func:', func_name, func_dict)
             funcs_list.append((func, func_dict))
@@ -652,87 +922,37 @@ def make_callback_list(ramp_data):
 
 
 def make_analog_ramps(ramp_data, dev_name="Dev2"):
-    keyframe_list = ramps.KeyFrameList(ramp_data['keyframes'])
-    sorted_key_list = keyframe_list.sorted_key_list()
-    channel_list = [ramps.Channel(ch_name, ramp_data['channels'][ch_name],
-                                  keyframe_list)
-                    for ch_name in ramp_data['channels']]
-
-    ramp_properties = ramp_data['properties']
-    jump_resolution = ramp_properties['jump_resolution']
-    ramp_resolution = ramp_properties['ramp_resolution']
-    an_channels = get_analog_channels(channel_list, dev_name)
-
-    ramp_regions = np.zeros(len(sorted_key_list) - 1)
-    voltage_array = []
-    for an_ch in an_channels:
-        ramp_regions += an_ch.get_ramp_regions()
-    for an_ch in an_channels:
-        time_array, voltages = an_ch.get_analog_ramp_data(ramp_regions,
-                                                          jump_resolution,
-                                                          ramp_resolution)
-        voltage_array.append(voltages)
-    voltage_array = np.array(voltage_array)
-
-
-    trigger_line = make_trigger_line(time_array, jump_resolution)
-
-    return trigger_line, voltage_array
-
-
-def make_trigger_line(time_array, jump_resolution):
-    positions = np.rint(time_array/jump_resolution).astype(int)
-
-    trigger_line = np.zeros(np.max(positions) + 1, dtype='uint32')
-    trigger_line[positions] = True
-    return trigger_line
+    return RampCompiler(ramp_data).make_analog_ramps(dev_name)
 
 
 def make_digital_ramps(ramp_data):
-    keyframe_list = ramps.KeyFrameList(ramp_data['keyframes'])
-    channel_list = [ramps.Channel(ch_name, ramp_data['channels'][ch_name],
-                                  keyframe_list)
-                    for ch_name in ramp_data['channels']]
-
-    ramp_properties = ramp_data['properties']
-    jump_resolution = ramp_properties['jump_resolution']
-
-    # The channels used are Dev1/port0/line5:31
-    dig_channels = get_digital_channels(channel_list)
-
-    for line_number, dig_ch in zip(range(5, 31), dig_channels):
-        time, ramp_uint = dig_ch.generate_ramp(time_div=jump_resolution)
-        if line_number == 5:
-            steps = len(ramp_uint)
-            digital_data = np.zeros(steps, dtype='uint32')
-        digital_data += ramp_uint*(2**line_number)
-
-    return digital_data
+    return RampCompiler(ramp_data).make_digital_ramps()
 
 
 def check_ramp_for_errors(ramp_data):
     """Checks ramp for errors. This is experiment specific checklist."""
     error_list = []
-    keyframe_list = ramps.KeyFrameList(ramp_data['keyframes'])
-    sorted_key_list = keyframe_list.sorted_key_list()
-    channel_list = [ramps.Channel(ch_name, ramp_data['channels'][ch_name],
-                                  keyframe_list)
-                    for ch_name in ramp_data['channels']]
+    compiler = RampCompiler(ramp_data)
+    keyframe_list = compiler.key_frame_list
+    sorted_key_list = compiler.sorted_key_list
+    channel_list = compiler.channel_list
     sorted_absolute_times = [keyframe_list.get_absolute_time(sk) for sk
                              in sorted_key_list]
     ramp_properties = ramp_data['properties']
     jump_resolution = ramp_properties['jump_resolution']
-    for key_name, abs_time in zip(sorted_key_list, sorted_absolute_times):
+    for key_name, abs_time, key_tick in zip(sorted_key_list,
+                                            sorted_absolute_times,
+                                            compiler.key_ticks):
         # check if all times are +ve
         if abs_time < 0.0:
             error_fmt = "keyframe \'{0}\' has negative absolute time {1}"
             error_str = error_fmt.format(key_name, abs_time)
             error_list.append(error_str)
 
-        # check if all times are a multiple of minimum resolution
-        steps_float = abs_time / jump_resolution
-        steps_residue = steps_float - round(steps_float)
-        if steps_residue > 0.0001:
+        # check if all times are a multiple of minimum resolution. The
+        # compiler places keyframes at the nearest tick.
+        steps_residue = abs_time/jump_resolution - key_tick
+        if abs(steps_residue) > 0.0001:
             error_fmt = ("keyframe \'{0}\' has absolute time {1} which is not"
                          " a multiple of jump_resolution {2}")
             error_str = error_fmt.format(key_name, abs_time, jump_resolution)
@@ -752,6 +972,25 @@ def check_ramp_for_errors(ramp_data):
             error_str = error_fmt.format(n_found, ch_id)
             error_list.append(error_str)
 
+    # check if all conversions are valid
+    for ch in channel_list:
+        if ch.dct['type'] == 'analog':
+            error_str = check_conversion(ch.dct['conversion'])
+            if error_str is not None:
+                error_fmt = 'channel \'{0}\': {1}'
+                error_list.append(error_fmt.format(ch.ch_name, error_str))
+            # check if all formulas of expr ramps are valid
+            for key_name, key_dict in ch.dct['keys'].items():
+                if key_dict['ramp_type'] != 'expr':
+                    continue
+                ramp_data = key_dict['ramp_data']
+                error_str = check_ramp_expression(
+                    ramp_data['expr'], get_expr_parameters(ramp_data).keys())
+                if error_str is not None:
+                    error_fmt = 'channel \'{0}\', keyframe \'{1}\': {2}'
+                    error_list.append(error_fmt.format(ch.ch_name, key_name,
+                                                       error_str))
+
     # check for timing overlap in keyframelist
     error_keyname = keyframe_list.do_keyframes_overlap()
     if error_keyname is not None:
@@ -764,15 +1003,9 @@ def check_ramp_for_errors(ramp_data):
 
 
 def make_ramps(data):
-    digital_data = make_digital_ramps(data)
-    dev1_trigger_line, dev1_voltages = make_analog_ramps(data, dev_name="Dev1")
-    dev2_trigger_line, dev2_voltages = make_analog_ramps(data, dev_name="Dev2")
-    dev3_trigger_line, dev3_voltages = make_analog_ramps(data, dev_name="Dev3")
-    dev4_trigger_line, dev4_voltages = make_analog_ramps(data, dev_name="Dev4")
-    callback_list = make_callback_list(data)
-    return (digital_data, dev1_trigger_line, dev1_voltages,
-            dev2_trigger_line, dev2_voltages, dev3_trigger_line,
-            dev3_voltages, dev4_trigger_line, dev4_voltages, callback_list)
+    out = RampCompiler(data).make_ramps()
+    callback_list = resolve_hooks(out[-1])
+    return out[:-1] + (callback_list,)
 
 
 def get_log_dir():
@@ -783,6 +1016,119 @@ def get_log_dir():
     return log_dir
 
 
+def get_server_option(option, default):
+    """Returns option from section server of settings.ini converted to the
+    type of default, or default if it is not set."""
+    settings_file = os.path.join(main_package_dir, 'settings.ini')
+    config = ConfigParser.RawConfigParser()
+    config.read(settings_file)
+    if not config.has_option('server', option):
+        return default
+    return type(default)(config.get('server', option))
+
+
+def get_shot_cache_size():
+    """Returns the maximum size of the shot cache in bytes.
+
+    Set in settings.ini as shot_cache_mb in section server.
+    """
+    shot_cache_mb = get_server_option('shot_cache_mb',
+                                      float(default_shot_cache_mb))
+    return int(shot_cache_mb*2**20)
+
+
+def get_render_threads():
+    """Returns the number of threads used to render a shot.
+
+    Set in settings.ini as render_threads in section server.
+    """
+    return get_server_option('render_threads', default_render_threads)
+
+
+def get_upload_threads():
+    """Returns the number of cards a shot is uploaded to at the same time.
+
+    Set in settings.ini as upload_threads in section server.
+    """
+    return get_server_option('upload_threads', default_upload_threads)
+
+
+def get_look_ahead_depth():
+    """Returns the number of shots to compile ahead.
+
+    Set in settings.ini as look_ahead in section server.
+    """
+    return get_server_option('look_ahead', default_look_ahead)
+
+
+def get_shot_limits():
+    """Returns the limits of the shots accepted by the server.
+
+    Each limit in default_shot_limits can be set in settings.ini in section
+    server.
+    """
+    return dict((name, get_server_option(name, default))
+                for name, default in default_shot_limits.items())
+
+
+def check_shot_size(ramp_data, limits=None):
+    """Estimates the size of ramp_data without compiling it.
+
+    Returns a tuple (estimate, errors, warnings), where estimate is the dict
+    of compiler.estimate_shot_size, errors lists the limits (see
+    get_shot_limits) the shot is above, and warnings those it is close to.
+    """
+    if limits is None:
+        limits = default_shot_limits
+    # the compiler bakes the keyframes of the ramp data it is given and drops
+    # unused keys, so give it a copy of the shot to queue
+    estimate = estimate_shot_size(copy.deepcopy(ramp_data))
+    checks = [('sample rate', estimate['sample_rate'], 'Hz',
+               limits['max_sample_rate']),
+              ('digital samples', estimate['n_digital_samples'], '',
+               limits['max_digital_samples']),
+              ('estimated memory', estimate['peak_bytes']/2.0**20, 'MB',
+               limits['max_shot_mb'])]
+    for dev_name, device in sorted(estimate['devices'].items()):
+        checks.append(('{0} samples'.format(dev_name), device['n_samples'],
+                       '', limits['max_analog_samples']))
+    errors = []
+    warnings = []
+    for name, value, unit, limit in checks:
+        message = '{0} {1:.6g}{2} for a limit of {3:.6g}{2}'.format(
+            name, value, unit, limit)
+        if value > limit:
+            errors.append(message)
+        elif value > shot_limit_warning*limit:
+            warnings.append(message)
+    return estimate, errors, warnings
+
+
+def get_log_compiled_shots():
+    """Returns True if compiled shots are saved with the logs, see
+    artifact.load_shot to read them back.
+
+    Set in settings.ini as log_compiled_shots (0 or 1) in section server.
+    """
+    return bool(get_server_option('log_compiled_shots',
+                                  default_log_compiled_shots))
+
+
+def _make_monotonic_time():
+    """Returns a function which returns the time in seconds from a clock that
+    does not jump when the system time is changed."""
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    if os.name == 'nt':
+        # Python 2 has no time.monotonic
+        get_tick_count = ctypes.windll.kernel32.GetTickCount64
+        get_tick_count.restype = ctypes.c_ulonglong
+        return lambda: get_tick_count()/1000.0
+    return time.time
+
+monotonic_time = _make_monotonic_time()
+
+
 def make_folder_for_today(log_dir):
     """Creates the folder log_dir/yyyy/mm/dd in log_dir if it doesn't exist
     and returns the full path of the folder."""
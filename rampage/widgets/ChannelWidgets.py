@@ -1,7 +1,8 @@
 """All widgets related to editing channels are here."""
 
 from PyQt4 import QtGui, QtCore
-from ..ramps import Channel
+from ..ramps import Channel, get_expr_parameters, ramp_type_defaults
+from ..conversion import check_ramp_expression, ramp_variable_names
 from CommonWidgets import QMultipleSpinBoxEdit, QNamedPushButton
 import rampage.format as fmt
 
@@ -170,13 +171,50 @@ class QChannelSegment(QtGui.QWidget):
         self.ramp_type_combo.currentIndexChanged.connect(self.handleRampTypeChanged)
 
         ramp_parm_names = self.ramp_types[self.dct['ramp_type']]
-        ramp_parm_values = [self.dct['ramp_data'][k] for k in ramp_parm_names]
+        ramp_parm_values = [self.dct['ramp_data'].get(k, 0.0)
+                            for k in ramp_parm_names]
         self.spin_boxes = QMultipleSpinBoxEdit(ramp_parm_names, self,
                                                ramp_parm_values)
         self.spin_boxes.valueChanged.connect(self.handleValueChanged)
         self.vbox.addWidget(self.ramp_type_combo)
         self.vbox.addWidget(self.spin_boxes)
 
+        # formula of expr ramps
+        self.expr_edit = QtGui.QLineEdit(self)
+        self.expr_edit.editingFinished.connect(self.handleExprChanged)
+        self.vbox.addWidget(self.expr_edit)
+        self.updateExprEdit()
+
+    def getExprParameterNames(self):
+        """Returns the names of the parameters of an expr formula: the
+        numbers of the expr ramp type and any other number in ramp_data."""
+        parameter_names = set(self.ramp_types['expr'])
+        parameter_names.update(get_expr_parameters(self.dct['ramp_data']))
+        return sorted(parameter_names)
+
+    def updateExprEdit(self):
+        if self.dct['ramp_type'] == 'expr':
+            self.expr_edit.setText(self.dct['ramp_data']['expr'])
+            self.expr_edit.setToolTip('Formula of {0} and {1}'.format(
+                ', '.join(ramp_variable_names),
+                ', '.join(self.getExprParameterNames())))
+            self.expr_edit.show()
+        else:
+            self.expr_edit.hide()
+
+    def handleExprChanged(self):
+        new_expr = str(self.expr_edit.text())
+        if new_expr == self.dct['ramp_data']['expr']:
+            return
+        error_str = check_ramp_expression(new_expr,
+                                          self.getExprParameterNames())
+        if error_str is not None:
+            QtGui.QMessageBox.critical(self, 'Invalid Expression', error_str)
+            self.expr_edit.setText(self.dct['ramp_data']['expr'])
+            return
+        self.dct['ramp_data']['expr'] = new_expr
+        self.edit_segment.emit()
+
     def handleRampTypeChanged(self, new_ramp_type_index):
         item_text = str(self.ramp_type_combo.itemText(new_ramp_type_index))
         if item_text == 'delete':
@@ -188,7 +226,9 @@ class QChannelSegment(QtGui.QWidget):
             ramp_data_dct = {}
             for rpn in ramp_parm_names:
                 ramp_data_dct[rpn] = 0.0
+            ramp_data_dct.update(ramp_type_defaults.get(item_text, {}))
             self.dct['ramp_data'] = ramp_data_dct
+            self.updateExprEdit()
             self.edit_segment.emit()
 
     def handleValueChanged(self, new_values):
@@ -301,11 +341,8 @@ class QChannel(Channel):
             add_button = QNamedPushButton('+', keyname, self.parent)
             add_button.clicked_name.connect(self.handleAddSegment)
 
-            keyindex = -1
             # find where to place our new channel segment
-            for i, key in enumerate(self.key_frame_list.sorted_key_list()):
-                if keyname == key:
-                    keyindex = i
+            keyindex = self.key_frame_list.get_key_position(keyname)
 
             self.grid.addWidget(add_button, self.start_pos[0],
                                 self.start_pos[1] + keyindex + 1)
@@ -331,6 +368,8 @@ class QChannel(Channel):
                 segment_dct['state'] = False
             for rpn in self.ramp_types[ramp_type]:
                 segment_dct['ramp_data'][rpn] = 0.0
+            segment_dct['ramp_data'].update(
+                ramp_type_defaults.get(ramp_type, {}))
             self.dct['keys'][keyname] = segment_dct
 
             if self.channel_type == 'analog':
@@ -344,12 +383,8 @@ class QChannel(Channel):
             ch_seg.delete_segment.connect(self.handleDeleteSegment)
             # evil hack
             ch_seg.edit_segment.connect(self.parent.ramp_changed)
-            keyindex = -1
-
             # find where to place our new channel segment
-            for i, key in enumerate(self.key_frame_list.sorted_key_list()):
-                if keyname == key:
-                    keyindex = i
+            keyindex = self.key_frame_list.get_key_position(keyname)
 
             self.grid.addWidget(ch_seg, self.start_pos[0],
                                 self.start_pos[1] + keyindex + 1)
@@ -360,7 +360,7 @@ class QKeyFrameList(KeyFrameList):
                                          start_pos=arrow_start,
                                          parent=self.parent_widget)
         if self.set_focus_on is not None:
-            index = skl.index(self.set_focus_on)
+            index = self.get_key_position(self.set_focus_on)
             self.kf_list[index].setFocus()
 
     def getArrowList(self):
@@ -371,7 +371,7 @@ class QKeyFrameList(KeyFrameList):
             if self.dct[key]['parent'] is None:
                 continue
             else:
-                left_index = skl.index(self.dct[key]['parent'])
+                left_index = self.get_key_position(self.dct[key]['parent'])
             arrow = (left_index, right_index)
             arrow_list.append(arrow)
         return arrow_list
@@ -432,8 +432,13 @@ class QKeyFrameList(KeyFrameList):
                 new_parent = None
             self.set_parent(key_name, new_parent)
             if key_name != new_key_name:
-                self.set_name(key_name, new_key_name)
-                self.parent_widget.handleKeyNameChanged(key_name, new_key_name)
+                try:
+                    self.set_name(key_name, new_key_name)
+                except KeyError as e:
+                    self.showKeyNameError(e)
+                else:
+                    self.parent_widget.handleKeyNameChanged(key_name,
+                                                            new_key_name)
             for kf in self.kf_list:
                 self.disconnectKeyFrame(kf)
             self.parent_widget.reDoUi()
@@ -445,8 +450,12 @@ class QKeyFrameList(KeyFrameList):
         if ok:
             parent_key = self.dct[key_name]['parent']
             kf = {'time': 1.0, 'parent': parent_key, "comment": "comment"}
-            self.dct[key_name]['parent'] = str(new_key_name)
-            self.add_keyframe(str(new_key_name), kf)
+            try:
+                self.add_keyframe(str(new_key_name), kf)
+            except KeyError as e:
+                self.showKeyNameError(e)
+                return
+            self.set_parent(key_name, str(new_key_name))
 
             for kf in self.kf_list:
                 self.disconnectKeyFrame(kf)
@@ -458,11 +467,20 @@ class QKeyFrameList(KeyFrameList):
                                                       'Enter key name:')
         if ok:
             kf = {'time': 1.0, 'parent': key_name, "comment": "comment"}
-            self.add_keyframe(str(new_key_name), kf)
+            try:
+                self.add_keyframe(str(new_key_name), kf)
+            except KeyError as e:
+                self.showKeyNameError(e)
+                return
             for kf in self.kf_list:
                 self.disconnectKeyFrame(kf)
             self.parent_widget.reDoUi()
 
+    def showKeyNameError(self, error):
+        # KeyError quotes its message
+        QtGui.QMessageBox.critical(self.parent_widget, 'Invalid key name',
+                                   error.args[0])
+
     def handleDelete(self, key_name):
         self.del_keyframe(key_name)
         for kf in self.kf_list:
@@ -7,6 +7,7 @@ from ChannelWidgets import QEditChannelInfoDialog
 from RampViewer import RampViewer
 from DictEditor import DictEditor
 from rampage import ramps
+from rampage import conversion
 
 
 def clearLayout(layout):
@@ -115,6 +116,13 @@ class RampEditor(QtGui.QWidget):
                     reply = QtGui.QMessageBox.critical(self, 'Duplicate Channel Id',
                                           msg_str)
 
+            if new_conversion is not None:
+                error_str = conversion.check_conversion(new_conversion)
+                if error_str is not None:
+                    reply = QtGui.QMessageBox.critical(self, 'Invalid Conversion',
+                                          error_str)
+                    return
+
             self.data['channels'][ch_name]['comment'] = new_comment
             self.data['channels'][ch_name]['id'] = new_id
             if self.data['channels'][ch_name]['type'] == 'analog':
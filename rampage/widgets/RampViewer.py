@@ -85,6 +85,9 @@ class RampViewer(QtGui.QDialog):
     def getChannelData(self, ch_name):
         ch_dict = self.data_dict['channels'][ch_name]
         channel = ramps.Channel(self.current_channel, ch_dict, self.kfl)
+        if ch_dict['type'] == 'digital':
+            # plot only the points where the line toggles
+            return channel.get_digital_change_points().get_step_data()
         return channel.generate_ramp()
 
 
@@ -18,5 +18,6 @@ setup(name='rampage',
       license='MIT',
       packages=['rampage'],
       install_requires=['pyqtgraph', 'numpy', 'pyzmq'],
+      extras_require={'numexpr': ['numexpr']},
       include_package_data=True,
       zip_safe=False)
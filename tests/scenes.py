@@ -0,0 +1,54 @@
+"""Small ramps for the tests."""
+
+import random
+
+from rampage.compiler import (analog_device_names, digital_channel_ids,
+                              get_analog_ids)
+
+
+def make_scene(n_keys=20, seed=0):
+    """Returns ramp data with n_keys keyframes, 1 ms apart, which uses every
+    analog output and digital line, and a hook at the second keyframe."""
+    rng = random.Random(seed)
+    keyframes = {'key0000': {'comment': '', 'parent': None, 'time': 0.0}}
+    for i in range(1, n_keys):
+        keyframes['key{0:04d}'.format(i)] = {
+            'comment': '', 'parent': 'key{0:04d}'.format(i - 1), 'time': 1.0}
+    key_names = sorted(keyframes)
+    keyframes[key_names[1]]['hooks'] = {
+        'agilent_set_output': {'state': True}}
+
+    channels = {}
+    analog_ids = []
+    for dev_name in analog_device_names:
+        analog_ids.extend(get_analog_ids(dev_name))
+    for ch_id in analog_ids:
+        keys = {}
+        for kn in key_names:
+            if kn != key_names[0] and rng.random() > 0.3:
+                continue
+            ramp_type = rng.choice(['jump', 'linear', 'sine'])
+            ramp_data = {'value': rng.uniform(-5.0, 5.0)}
+            if ramp_type == 'sine':
+                ramp_data.update({'amp': 1.0, 'freq': 1.0, 'phase': 0.0})
+            keys[kn] = {'ramp_type': ramp_type, 'ramp_data': ramp_data}
+        channels[ch_id] = {'comment': '', 'id': ch_id, 'keys': keys,
+                           'type': 'analog', 'conversion': 'x'}
+    for ch_id in digital_channel_ids():
+        keys = {}
+        for kn in key_names:
+            if kn != key_names[0] and rng.random() > 0.3:
+                continue
+            keys[kn] = {'ramp_type': 'jump', 'ramp_data': {},
+                        'state': rng.random() > 0.5}
+        channels[ch_id] = {'comment': '', 'id': ch_id, 'keys': keys,
+                           'type': 'digital'}
+    properties = {'jump_resolution': 0.004, 'ramp_resolution': 0.02}
+    return {'keyframes': keyframes, 'channels': channels,
+            'properties': properties}
+
+
+def set_analog_value(ramp_data, ch_id, value):
+    """Sets the value of analog channel ch_id at its first keyframe."""
+    keys = ramp_data['channels'][ch_id]['keys']
+    keys[sorted(keys)[0]]['ramp_data']['value'] = value
@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from rampage import artifact, ramps
+from rampage.compiler import RampCompiler
+
+from tests.scenes import make_scene
+
+
+class TestArtifact(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.temp_dir, 'shot.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def assert_same_shot(self, out, loaded):
+        self.assertEqual(len(out), len(loaded))
+        for item, loaded_item in zip(out[:-1], loaded[:-1]):
+            if isinstance(item, ramps.ChangePoints):
+                self.assertIsInstance(loaded_item, ramps.ChangePoints)
+                self.assertEqual(len(item), len(loaded_item))
+                self.assertTrue(np.array_equal(item.positions,
+                                               loaded_item.positions))
+                self.assertTrue(np.array_equal(item.values,
+                                               loaded_item.values))
+            else:
+                self.assertEqual(item.dtype, loaded_item.dtype)
+                self.assertTrue(np.array_equal(item, loaded_item))
+        self.assertEqual(out[-1], loaded[-1])
+
+    def round_trip(self, ramp_data, mmap):
+        out = RampCompiler(ramp_data).make_ramps()
+        artifact.save_shot(out, self.file_name)
+        loaded = artifact.load_shot(self.file_name, mmap=mmap)
+        self.assert_same_shot(out, loaded)
+        return loaded
+
+    def test_round_trip(self):
+        loaded = self.round_trip(make_scene(), mmap=False)
+        self.assertEqual(len(loaded[-1]), 1)
+
+    def test_round_trip_mmap(self):
+        loaded = self.round_trip(make_scene(), mmap=True)
+        for item in loaded[2:-1:2]:
+            self.assertFalse(item.flags.writeable)
+        del loaded
+
+    def test_round_trip_int16(self):
+        ramp_data = make_scene()
+        ramp_data['properties']['output_format'] = 'int16'
+        loaded = self.round_trip(ramp_data, mmap=False)
+        self.assertEqual(loaded[2].dtype, np.int16)
+
+    def test_not_a_shot(self):
+        with open(self.file_name, 'wb') as f:
+            f.write(b'not a shot')
+        self.assertRaises(artifact.ArtifactError, artifact.load_shot,
+                          self.file_name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+
+from rampage.cache import ShotCache, hash_ramp_data
+from rampage.compiler import RampCompiler
+
+from tests.scenes import make_scene, set_analog_value
+
+
+class TestShotCache(unittest.TestCase):
+
+    def test_compile_hits(self):
+        shot_cache = ShotCache(2**30)
+        outs = [shot_cache.compile(make_scene()) for _ in range(3)]
+        self.assertEqual(shot_cache.get_stats()['hits'], 2)
+        self.assertEqual(len(shot_cache), 1)
+        for out in outs[1:]:
+            self.assertIs(out, outs[0])
+        self.assertFalse(outs[0][2].flags.writeable)
+
+    def test_compiling_changes_ramp_data(self):
+        # why put takes the key of get
+        ramp_data = make_scene()
+        key = hash_ramp_data(ramp_data)
+        RampCompiler(ramp_data).make_ramps()
+        self.assertNotEqual(hash_ramp_data(ramp_data), key)
+
+    def test_other_shot_misses(self):
+        shot_cache = ShotCache(2**30)
+        shot_cache.compile(make_scene())
+        ramp_data = make_scene()
+        set_analog_value(ramp_data, 'Dev2/ao3', 1.0)
+        self.assertIsNone(shot_cache.get(ramp_data))
+        stats = shot_cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (0, 2))
+
+    def test_evicts_least_recently_used(self):
+        out = RampCompiler(make_scene()).make_ramps()
+        n_bytes = sum(item.nbytes for item in out[:-1])
+        shot_cache = ShotCache(2*n_bytes)
+        scenes = []
+        for value in (1.0, 2.0, 3.0):
+            ramp_data = make_scene()
+            set_analog_value(ramp_data, 'Dev2/ao3', value)
+            scenes.append((hash_ramp_data(ramp_data), ramp_data))
+            shot_cache.compile(ramp_data)
+        self.assertEqual(len(shot_cache), 2)
+        self.assertLessEqual(shot_cache.total_bytes, shot_cache.max_bytes)
+        self.assertIsNone(shot_cache.get(None, scenes[0][0]))
+        self.assertIsNotNone(shot_cache.get(None, scenes[2][0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+import copy
+import unittest
+
+import numpy as np
+
+from rampage import ramps
+from rampage.compiler import RampCompiler, analog_device_names
+from rampage.daq.settings import expt_settings
+
+from tests.scenes import make_scene, set_analog_value
+
+
+class TestDacCalibration(unittest.TestCase):
+
+    def test_dac_bits_per_device(self):
+        compiler = RampCompiler(make_scene())
+        for dev_name in analog_device_names:
+            calibration = compiler.get_dac_calibration(dev_name)
+            self.assertEqual(calibration['dac_bits'],
+                             expt_settings.dac_bits[dev_name])
+        self.assertEqual(compiler.get_dac_calibration('Dev1')['dac_bits'],
+                         16)
+        self.assertEqual(compiler.get_dac_calibration('Dev2')['dac_bits'],
+                         12)
+
+    def test_dac_calibration_overrides(self):
+        ramp_data = make_scene()
+        ramp_data['properties']['dac_calibration'] = {
+            'Dev3': {'dac_bits': 16, 'coefficients': [0.0, 3276.8]}}
+        compiler = RampCompiler(ramp_data)
+        self.assertEqual(compiler.get_dac_calibration('Dev2')['dac_bits'],
+                         12)
+        calibration = compiler.get_dac_calibration('Dev3')
+        self.assertEqual(calibration['dac_bits'], 16)
+        self.assertEqual(calibration['coefficients'], [0.0, 3276.8])
+
+    def test_int16_codes_per_device(self):
+        float_out = RampCompiler(make_scene()).make_ramps()
+        ramp_data = make_scene()
+        ramp_data['properties']['output_format'] = 'int16'
+        int16_out = RampCompiler(ramp_data).make_ramps()
+        for i, dev_name in enumerate(analog_device_names):
+            codes = int16_out[2 + 2*i]
+            voltages = float_out[2 + 2*i]
+            dac_bits = expt_settings.dac_bits[dev_name]
+            self.assertLess(np.abs(codes).max(), 2**(dac_bits - 1) + 1)
+            # the same samples are kept for both formats
+            self.assertEqual(codes.shape, voltages.shape)
+            expected = ramps.voltages_to_codes(voltages, dac_bits=dac_bits)
+            self.assertTrue(np.array_equal(codes, expected))
+
+
+def move_keyframe(ramp_data):
+    # the end of the shot stays where it was
+    ramp_data['keyframes']['key0005']['time'] = 1.5
+    ramp_data['keyframes']['key0006']['time'] = 0.5
+
+
+def move_keyframe_and_end(ramp_data):
+    ramp_data['keyframes']['key0010']['time'] = 2.0
+
+
+def rename_key(ramp_data):
+    keyframes = ramp_data['keyframes']
+    keyframes['renamed'] = keyframes.pop('key0007')
+    keyframes['key0008']['parent'] = 'renamed'
+    for ch_dct in ramp_data['channels'].values():
+        if 'key0007' in ch_dct['keys']:
+            ch_dct['keys']['renamed'] = ch_dct['keys'].pop('key0007')
+
+
+def change_value(ramp_data):
+    set_analog_value(ramp_data, 'Dev2/ao3', 1.25)
+
+
+def change_conversion(ramp_data):
+    ramp_data['channels']['Dev3/ao1']['conversion'] = '2*x + 0.5'
+
+
+def change_digital_line(ramp_data):
+    keys = ramp_data['channels']['Dev1/port0/line09']['keys']
+    first_key = keys[sorted(keys)[0]]
+    first_key['state'] = not first_key['state']
+
+
+class TestPartialRecompile(unittest.TestCase):
+
+    mutations = [move_keyframe, move_keyframe_and_end, rename_key,
+                 change_value, change_conversion, change_digital_line]
+
+    def assert_same_output(self, out, fresh_out):
+        self.assertEqual(len(out), len(fresh_out))
+        for item, fresh_item in zip(out[:-1], fresh_out[:-1]):
+            if isinstance(item, ramps.ChangePoints):
+                self.assertEqual(len(item), len(fresh_item))
+                self.assertTrue(np.array_equal(item.positions,
+                                               fresh_item.positions))
+                self.assertTrue(np.array_equal(item.values,
+                                               fresh_item.values))
+            else:
+                self.assertEqual(item.dtype, fresh_item.dtype)
+                self.assertTrue(np.array_equal(item, fresh_item))
+        self.assertEqual(out[-1], fresh_out[-1])
+
+    def check_mutations(self, properties=None):
+        ramp_data = make_scene()
+        if properties is not None:
+            ramp_data['properties'].update(properties)
+        for mutate in self.mutations:
+            # compiling modifies the ramp data, so every compile gets a copy
+            previous = RampCompiler(copy.deepcopy(ramp_data))
+            previous.make_ramps()
+            mutated = copy.deepcopy(ramp_data)
+            mutate(mutated)
+            compiler = RampCompiler(copy.deepcopy(mutated),
+                                    previous=previous)
+            out = compiler.make_ramps()
+            # something was reused
+            self.assertLess(len(compiler.changed_channels),
+                            len(compiler.channel_list), mutate.__name__)
+            fresh_out = RampCompiler(copy.deepcopy(mutated)).make_ramps()
+            self.assert_same_output(out, fresh_out)
+
+    def test_same_as_fresh_compile(self):
+        self.check_mutations()
+
+    def test_same_as_fresh_compile_with_tolerance(self):
+        self.check_mutations({'ramp_tolerance': 0.05})
+
+    def test_same_as_fresh_compile_int16(self):
+        self.check_mutations({'output_format': 'int16'})
+
+    def test_same_as_fresh_compile_without_deduplication(self):
+        self.check_mutations({'deduplicate_samples': False})
+
+    def test_reuses_unchanged_outputs(self):
+        ramp_data = make_scene()
+        previous = RampCompiler(copy.deepcopy(ramp_data))
+        previous_out = previous.make_ramps()
+        change_value(ramp_data)
+        compiler = RampCompiler(ramp_data, previous=previous)
+        out = compiler.make_ramps()
+        self.assertEqual(compiler.changed_channels, set(['Dev2/ao3']))
+        # only Dev2 is rendered again
+        for i, dev_name in enumerate(analog_device_names):
+            if dev_name == 'Dev2':
+                self.assertIsNot(out[2 + 2*i], previous_out[2 + 2*i])
+            else:
+                self.assertIs(out[2 + 2*i], previous_out[2 + 2*i])
+
+    def test_other_properties_reuse_nothing(self):
+        ramp_data = make_scene()
+        previous = RampCompiler(copy.deepcopy(ramp_data))
+        previous.make_ramps()
+        ramp_data['properties']['output_format'] = 'int16'
+        compiler = RampCompiler(ramp_data, previous=previous)
+        self.assertIsNone(compiler.changed_channels)
+
+
+class TestEstimateShotSize(unittest.TestCase):
+
+    def check_estimate(self, properties=None):
+        ramp_data = make_scene()
+        if properties is not None:
+            ramp_data['properties'].update(properties)
+        estimate = RampCompiler(copy.deepcopy(ramp_data)).estimate_shot_size()
+        compiler = RampCompiler(copy.deepcopy(ramp_data))
+        out = compiler.make_ramps()
+
+        n_digital_samples = len(out[0])
+        self.assertEqual(estimate['n_digital_samples'], n_digital_samples)
+        self.assertEqual(estimate['n_hooks'],
+                         sum(len(hooks) for _, hooks in out[-1]))
+        peak_bytes = 4*n_digital_samples
+        for i, dev_name in enumerate(analog_device_names):
+            device = estimate['devices'][dev_name]
+            voltages = out[2 + 2*i]
+            n_samples = compiler.sample_counts[dev_name][0]
+            self.assertEqual(device['n_samples'], n_samples, dev_name)
+            self.assertEqual(device['n_channels'], voltages.shape[1])
+            # samples are only ever dropped from the grid
+            self.assertLessEqual(len(voltages), n_samples)
+            peak_bytes += n_samples*(16 + voltages.shape[1]*(
+                8 + 2 + voltages.dtype.itemsize))
+        self.assertEqual(estimate['peak_bytes'], peak_bytes)
+        return estimate, compiler
+
+    def test_matches_compile(self):
+        self.check_estimate()
+
+    def test_matches_compile_int16(self):
+        self.check_estimate({'output_format': 'int16'})
+
+    def test_matches_compile_without_deduplication(self):
+        estimate, compiler = self.check_estimate(
+            {'deduplicate_samples': False})
+        for dev_name in analog_device_names:
+            self.assertEqual(estimate['devices'][dev_name]['n_samples'],
+                             compiler.sample_counts[dev_name][1])
+
+    def test_upper_bound_with_tolerance(self):
+        estimate, compiler = self.check_estimate({'ramp_tolerance': 0.05})
+        for dev_name in analog_device_names:
+            self.assertLessEqual(compiler.sample_counts[dev_name][1],
+                                 estimate['devices'][dev_name]['n_samples'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import time
+import unittest
+
+import numpy as np
+
+from rampage import conversion, ramps
+from rampage.conversion import ConversionError
+
+
+class TestConversion(unittest.TestCase):
+
+    def test_evaluates_expression(self):
+        x = np.array([0.0, 1.0, 4.0])
+        t = np.array([0.0, 1.0, 2.0])
+        out = conversion.convert('sqrt(x)*2.0 + t**2', x, t)
+        self.assertTrue(np.allclose(out, [0.0, 3.0, 8.0]))
+
+    def test_convert_in_place(self):
+        t = np.array([0.0, 1.0, 2.0])
+        # a column of an interleaved buffer
+        buf = np.array([[0.0, 5.0], [1.0, 5.0], [4.0, 5.0]])
+        x = buf[:, 0]
+        out = conversion.convert('sqrt(x)*2.0 + t**2', x, t, out=x)
+        self.assertIs(out, x)
+        self.assertTrue(np.allclose(buf, [[0.0, 5.0], [3.0, 5.0],
+                                          [8.0, 5.0]]))
+        self.assertIs(conversion.convert(' x ', x, t, out=x), x)
+        self.assertTrue(np.allclose(x, [0.0, 3.0, 8.0]))
+        conversion.convert('0.5', x, t, out=x)
+        self.assertTrue(np.array_equal(buf[:, 0], [0.5, 0.5, 0.5]))
+
+    def test_constant_powers(self):
+        x = np.array([1.0, 4.0])
+        for expr in ('x**(1/2.)', 'x**2**3', '2**10*x', 'x**-1.5'):
+            conversion.compile_conversion(expr)
+        out = conversion.convert('x**(1/2.)', x, 0.0)
+        self.assertTrue(np.allclose(out, [1.0, 2.0]))
+
+    def test_rejects_large_exponents(self):
+        for expr in ('9**9**9', 'x**9**9', 'x**1000', '2**(10**400)',
+                     '(9**99)**99', '1e300**2'):
+            start = time.time()
+            self.assertRaises(ConversionError, conversion.compile_conversion,
+                              expr)
+            self.assertLess(time.time() - start, 1.0)
+
+    def test_rejects_attribute_access(self):
+        for expr in ('x.real', 'x.__class__', '(1).__class__.__bases__',
+                     'np.linalg.norm(x)', 'x.dump("file")'):
+            self.assertRaises(ConversionError, conversion.compile_conversion,
+                              expr)
+
+    def test_rejects_import(self):
+        for expr in ('__import__("os")', '__import__("os").system("ls")',
+                     'eval("1")'):
+            self.assertRaises(ConversionError, conversion.compile_conversion,
+                              expr)
+
+    def test_rejects_unknown_names(self):
+        for expr in ('y', 'x + open', 'np', '__builtins__', 'x if t else 0',
+                     'lambda: 0', '[x for x in t]'):
+            self.assertRaises(ConversionError, conversion.compile_conversion,
+                              expr)
+        self.assertIsNotNone(conversion.check_conversion('x*y'))
+        self.assertIsNone(conversion.check_conversion('x*pi'))
+
+    def test_ramp_expression_names(self):
+        self.assertIsNone(conversion.check_ramp_expression(
+            'v0 + (v1 - v0)*(t - t0)/(t1 - t0)*a', ('a',)))
+        self.assertIsNotNone(conversion.check_ramp_expression('x*a', ('a',)))
+        self.assertIsNotNone(conversion.check_ramp_expression('t**v0**9**9'))
+
+
+# expressions of expr ramps, with the functions numexpr knows, and the same
+# in numpy
+ramp_expressions = [
+    ('v0 + (v1 - v0)*(t - t0)/(t1 - t0)',
+     lambda t, v: v['v0'] + (v['v1'] - v['v0'])*(t - v['t0'])/(v['t1'] -
+                                                               v['t0'])),
+    ('v0 + a*sin(2*pi*b*(t - t0)) + c',
+     lambda t, v: v['v0'] + v['a']*np.sin(2*np.pi*v['b']*(t - v['t0'])) +
+     v['c']),
+    ('v1 + (v0 - v1)*exp(-(t - t0)/b)',
+     lambda t, v: v['v1'] + (v['v0'] - v['v1'])*np.exp(-(t - v['t0'])/v['b'])),
+    ('sqrt(abs(t - t0))*a', lambda t, v: np.sqrt(np.abs(t - v['t0']))*v['a']),
+    # does not depend on t
+    ('v0*a + 1', lambda t, v: v['v0']*v['a'] + 1 + 0*t),
+]
+
+
+class TestRampExpression(unittest.TestCase):
+
+    def setUp(self):
+        self.numexpr = conversion.numexpr
+        self.t = np.linspace(10.0, 20.0, 1001)
+        self.ramp_data = {'value': 1.5, 'a': 0.5, 'b': 3.0, 'c': -0.25}
+        self.variables = {'t0': 10.0, 't1': 20.0, 'v0': 1.5, 'v1': -2.0,
+                          'a': 0.5, 'b': 3.0, 'c': -0.25}
+
+    def tearDown(self):
+        self.set_numexpr(self.numexpr)
+
+    def set_numexpr(self, module):
+        # compiled expressions remember whether they use numexpr
+        conversion.numexpr = module
+        conversion._ramp_expression_cache.clear()
+        conversion._conversion_cache.clear()
+
+    def evaluate(self, expr):
+        """Returns analog_expr_ramp of expr in a column of a buffer."""
+        ramp_data = dict(self.ramp_data, expr=expr)
+        buf = np.zeros((len(self.t), 2))
+        ramps.analog_expr_ramp(ramp_data, 10.0, 20.0, -2.0, self.t,
+                               out=buf[:, 1])
+        self.assertTrue(np.all(buf[:, 0] == 0.0))
+        return buf[:, 1].copy()
+
+    def test_numpy_fallback(self):
+        self.set_numexpr(None)
+        for expr, reference in ramp_expressions:
+            self.assertTrue(np.allclose(self.evaluate(expr),
+                                        reference(self.t, self.variables)),
+                            expr)
+
+    @unittest.skipIf(conversion.numexpr is None, 'numexpr is not installed')
+    def test_numexpr_matches_numpy(self):
+        for expr, _ in ramp_expressions:
+            self.set_numexpr(None)
+            numpy_out = self.evaluate(expr)
+            self.set_numexpr(self.numexpr)
+            numexpr_out = self.evaluate(expr)
+            self.assertTrue(np.allclose(numexpr_out, numpy_out), expr)
+        x = np.linspace(-1.0, 1.0, 101)
+        for expr in ('5.1913 - x*0.12931', 'sqrt(abs(x))*2.0 + t/1000.0'):
+            self.set_numexpr(None)
+            numpy_out = conversion.convert(expr, x, self.t[:101])
+            self.set_numexpr(self.numexpr)
+            numexpr_out = conversion.convert(expr, x.copy(), self.t[:101],
+                                             out=np.empty(101))
+            self.assertTrue(np.allclose(numexpr_out, numpy_out), expr)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,249 @@
+import itertools
+import logging
+import os
+import unittest
+
+import numpy as np
+
+# the tests run without NI hardware
+os.environ['RAMPAGE_DAQ_BACKEND'] = 'simulated'
+
+from rampage.cache import ShotCache, hash_ramp_data
+from rampage import ramps
+from rampage.compiler import RampCompiler
+from rampage.daq import daq, simulated
+
+from tests.scenes import make_scene, set_analog_value
+
+
+def compile_scan(values, ch_id='Dev2/ao3'):
+    """Returns the compiled shots of a scan of the value of ch_id, as the
+    server gets them from its ShotCache."""
+    shot_cache = ShotCache(2**30)
+    compiler = None
+    outs = []
+    for value in values:
+        ramp_data = make_scene()
+        if value is not None:
+            set_analog_value(ramp_data, ch_id, value)
+        key = hash_ramp_data(ramp_data)
+        out = shot_cache.get(ramp_data, key)
+        if out is None:
+            compiler = RampCompiler(ramp_data, previous=compiler)
+            out = compiler.make_ramps()
+            shot_cache.put(ramp_data, out, key)
+        outs.append(out[:-1] + ([],))
+    return outs
+
+
+class TestTaskManager(unittest.TestCase):
+
+    def setUp(self):
+        self.speed_up = simulated.speed_up
+        simulated.speed_up = 1000.0
+        simulated.record_writes = True
+        simulated.call_counts.clear()
+        self.task_manager = daq.TaskManager()
+
+    def tearDown(self):
+        self.task_manager.close()
+        simulated.speed_up = self.speed_up
+
+    def run_shot(self, out, shot_hash=None):
+        """Loads out, runs it and checks the samples the tasks output."""
+        tasks = self.task_manager.load_shot(*out, shot_hash=shot_hash)
+        self.task_manager.start()
+        digital_task = tasks[-1]
+        self.assertTrue(digital_task.done_event.wait(10.0))
+        for task in tasks[:-1]:
+            self.assertTrue(task.done.wait(10.0))
+        self.assertTrue(np.array_equal(digital_task.get_written_samples(),
+                                       digital_task.digital_data.expand()))
+        for task, voltages in zip(tasks[:-1], out[2:-1:2]):
+            _, data = daq.get_analog_task_data(voltages)
+            self.assertTrue(np.array_equal(task.get_written_samples(), data))
+        return tasks
+
+    def test_tasks_created_once(self):
+        outs = compile_scan([None, 1.0, 2.0])
+        tasks = self.run_shot(outs[0])
+        self.assertEqual(self.task_manager.n_created, 5)
+        self.assertEqual(simulated.call_counts['CreateAOVoltageChan'], 4)
+        for out in outs[1:]:
+            simulated.call_counts.clear()
+            new_tasks = self.run_shot(out)
+            self.assertEqual(self.task_manager.n_created, 0)
+            self.assertEqual(self.task_manager.n_reused, 5)
+            for task, new_task in zip(tasks, new_tasks):
+                self.assertIs(task, new_task)
+            for name in ('Task', 'CreateAOVoltageChan', 'CreateDOChan',
+                         'ClearTask'):
+                self.assertEqual(simulated.call_counts[name], 0)
+
+    def test_skips_unchanged_buffers(self):
+        outs = compile_scan([None, None, 1.0])
+        self.run_shot(outs[0])
+        self.assertEqual(self.task_manager.n_skipped, 0)
+
+        # the same shot again, from the cache. The digital task and the
+        # clock reset task released their buffers when they were
+        # unreserved, so they are written again.
+        self.assertIs(outs[1][2], outs[0][2])
+        simulated.call_counts.clear()
+        self.run_shot(outs[1])
+        self.assertEqual(self.task_manager.n_skipped, 4)
+        self.assertEqual(simulated.call_counts['WriteAnalogF64'], 0)
+        self.assertEqual(simulated.call_counts['WriteDigitalU32'], 2)
+
+        # only the voltages of Dev2 change, the other cards keep their
+        # buffers
+        simulated.call_counts.clear()
+        self.run_shot(outs[2])
+        self.assertEqual(self.task_manager.n_skipped, 3)
+        self.assertEqual(simulated.call_counts['WriteAnalogF64'], 1)
+        self.assertEqual(simulated.call_counts['WriteDigitalU32'], 2)
+
+    def test_same_shot_hash_skips_writes(self):
+        # compiled twice without a cache, so the arrays are neither shared
+        # nor read only
+        ramp_data = make_scene()
+        shot_hash = hash_ramp_data(ramp_data)
+        outs = [RampCompiler(make_scene()).make_ramps()[:-1] + ([],)
+                for _ in range(3)]
+        self.assertIsNot(outs[1][2], outs[0][2])
+        self.run_shot(outs[0], shot_hash)
+
+        simulated.call_counts.clear()
+        self.run_shot(outs[1], shot_hash)
+        self.assertEqual(self.task_manager.n_skipped, 4)
+        self.assertEqual(simulated.call_counts['WriteAnalogF64'], 0)
+
+        # without the hash, the arrays are written again
+        simulated.call_counts.clear()
+        self.run_shot(outs[2])
+        self.assertEqual(self.task_manager.n_skipped, 0)
+        self.assertEqual(simulated.call_counts['WriteAnalogF64'], 4)
+
+    def test_other_shot_hash_writes(self):
+        outs = compile_scan([None, 1.0])
+        self.run_shot(outs[0], 'first')
+        simulated.call_counts.clear()
+        self.run_shot(outs[1], 'second')
+        self.assertEqual(self.task_manager.n_skipped, 3)
+        self.assertEqual(simulated.call_counts['WriteAnalogF64'], 1)
+        # a shot with a known hash is written again after another one
+        simulated.call_counts.clear()
+        self.run_shot(outs[0], 'first')
+        self.assertEqual(simulated.call_counts['WriteAnalogF64'], 1)
+
+    def test_digital_buffer_rewritten_after_unreserve(self):
+        out = compile_scan([None])[0]
+        self.run_shot(out)
+        digital_task = self.task_manager.digital_task
+        words = digital_task.loaded_data
+        self.task_manager.stop()
+        self.assertIsNone(digital_task.loaded_data)
+        self.assertEqual(digital_task.n_written, 0)
+        self.assertRaises(simulated.DAQError, digital_task.StartTask)
+        # the same words and shot, still written again
+        self.assertEqual(self.task_manager.load_digital_task(
+            words, [], same_shot=True), 'reused')
+        self.assertEqual(digital_task.n_written,
+                         len(digital_task.digital_data))
+
+    def test_skips_digital_buffer_kept(self):
+        # a digital task which was stopped but not unreserved keeps its
+        # buffer, so the same words are not written again
+        out = compile_scan([None])[0]
+        self.run_shot(out)
+        digital_task = self.task_manager.digital_task
+        words = digital_task.loaded_data
+        digital_task.StopTask()
+        simulated.call_counts.clear()
+        self.assertEqual(self.task_manager.load_digital_task(
+            ramps.ChangePoints(words.positions.copy(), words.values.copy(),
+                               words.n_samples), []), 'skipped')
+        self.assertEqual(simulated.call_counts['WriteDigitalU32'], 0)
+        digital_task.StartTask()
+        self.assertTrue(digital_task.done_event.wait(10.0))
+        self.assertTrue(np.array_equal(digital_task.get_written_samples(),
+                                       digital_task.digital_data.expand()))
+
+    def test_digital_task_started_last(self):
+        self.task_manager.load_shot(*compile_scan([None])[0])
+        started = []
+        tasks = self.task_manager.get_tasks()
+        for name, task in zip(self.task_manager.get_task_names(), tasks):
+            start_task = task.StartTask
+
+            def record_start(name=name, start_task=start_task):
+                started.append(name)
+                return start_task()
+            task.StartTask = record_start
+        self.task_manager.start()
+        self.assertEqual(started, ['Dev1', 'Dev2', 'Dev3', 'Dev4',
+                                   'Digital'])
+        self.assertTrue(tasks[-1].done_event.wait(10.0))
+
+
+class TestStreaming(unittest.TestCase):
+
+    n_samples = 100000
+
+    def setUp(self):
+        settings = daq.expt_settings
+        self.settings = (simulated.speed_up, settings.stream_chunk_samples,
+                         settings.stream_buffer_samples)
+        simulated.speed_up = 1000.0
+        simulated.record_writes = True
+        # 2 chunks of 2 callbacks fit in the buffer
+        settings.stream_chunk_samples = 5000
+        settings.stream_buffer_samples = 10000
+        simulated.call_counts.clear()
+        rng = np.random.RandomState(0)
+        positions = np.sort(rng.randint(1, self.n_samples, 200))
+        self.digital_data = ramps.ChangePoints.from_changes(
+            np.append(0, positions), rng.randint(0, 2**16, 201),
+            self.n_samples)
+        self.task = daq.DigitalOutputTaskWithCallbacks(
+            daq.digital_task_lines, self.digital_data)
+
+    def tearDown(self):
+        self.task.ClearTask()
+        (simulated.speed_up, daq.expt_settings.stream_chunk_samples,
+         daq.expt_settings.stream_buffer_samples) = self.settings
+
+    def test_refills_while_running(self):
+        task = self.task
+        self.assertTrue(task.streamed)
+        # only the buffer is written before the start
+        self.assertEqual(simulated.call_counts['WriteDigitalU32'], 2)
+        task.StartTask()
+        self.assertTrue(task.done_event.wait(10.0))
+        task.WaitUntilTaskDone(-1)
+        self.assertEqual(simulated.call_counts['WriteDigitalU32'], 20)
+        self.assertTrue(task.writer.is_complete())
+        self.assertFalse(task.writer.underrun)
+        self.assertTrue(np.array_equal(task.get_written_samples(),
+                                       self.digital_data.expand()))
+
+    def test_detects_underrun(self):
+        task = self.task
+        # the chunks run out after the first refills, like a writer which
+        # cannot keep up
+        task.writer.chunks = itertools.islice(task.writer.chunks, 3)
+        # the underrun is logged as an error
+        logging.disable(logging.ERROR)
+        try:
+            task.StartTask()
+            self.assertTrue(task.done_event.wait(10.0))
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertTrue(task.writer.underrun)
+        self.assertFalse(task.writer.is_complete())
+        self.assertEqual(task.error, simulated.error_underrun)
+        self.assertRaises(simulated.DAQError, task.WaitUntilTaskDone, -1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import copy
+import os
+import time
+import unittest
+
+import numpy as np
+
+from rampage.compiler import RampCompiler
+from rampage.pipeline import LookAheadCompiler
+
+from tests.scenes import make_scene, set_analog_value
+
+
+def make_scan(values):
+    scenes = []
+    for value in values:
+        ramp_data = make_scene()
+        set_analog_value(ramp_data, 'Dev2/ao3', value)
+        scenes.append(ramp_data)
+    return scenes
+
+
+class TestLookAheadCompiler(unittest.TestCase):
+
+    def setUp(self):
+        self.look_ahead = LookAheadCompiler()
+
+    def tearDown(self):
+        self.look_ahead.close()
+
+    def get_all(self, n_shots, timeout=30.0):
+        """Returns the next n_shots shots, waiting for each of them."""
+        shots = []
+        deadline = time.time() + timeout
+        while len(shots) < n_shots and time.time() < deadline:
+            shot = self.look_ahead.get_next(0.1)
+            if shot is not None:
+                shots.append(shot)
+        self.assertEqual(len(shots), n_shots)
+        return shots
+
+    def test_results_in_order(self):
+        scenes = make_scan([1.0, 2.0, 3.0])
+        precompiled = RampCompiler(copy.deepcopy(scenes[1])).make_ramps()
+        self.look_ahead.submit(scenes[0])
+        self.look_ahead.submit(scenes[1], precompiled)
+        self.look_ahead.submit(scenes[2])
+        self.assertEqual(len(self.look_ahead), 3)
+        shots = self.get_all(3)
+        self.assertEqual(len(self.look_ahead), 0)
+        for scene, (ramp_data, out, info, error) in zip(scenes, shots):
+            self.assertIs(ramp_data, scene)
+            self.assertIsNone(error)
+            expected = RampCompiler(copy.deepcopy(scene)).make_ramps()
+            self.assertTrue(np.array_equal(out[4], expected[4]))
+        self.assertIs(shots[1][1], precompiled)
+        self.assertIsNone(shots[1][2])
+        self.assertIn('compile_time', shots[0][2])
+
+    def test_clear_drops_stale_results(self):
+        stale_scenes = make_scan([1.0, 2.0])
+        for scene in stale_scenes:
+            self.look_ahead.submit(scene)
+        # wait until the worker has compiled them, so that their results are
+        # in the result queue when they are cleared
+        result_dir = self.look_ahead.result_dir
+        deadline = time.time() + 30.0
+        while len(os.listdir(result_dir)) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.look_ahead.clear()
+        self.assertEqual(len(self.look_ahead), 0)
+        self.assertIsNone(self.look_ahead.get_next(0.0))
+        scene = make_scan([3.0])[0]
+        self.look_ahead.submit(scene)
+        shots = self.get_all(1)
+        self.assertIs(shots[0][0], scene)
+        self.assertIsNone(self.look_ahead.get_next(0.5))
+        # the files of shots compiled before clear are removed
+        self.assertLessEqual(len(os.listdir(result_dir)), 1)
+
+    def test_failed_compile(self):
+        ramp_data = make_scene()
+        ramp_data['properties']['output_format'] = 'unknown'
+        self.look_ahead.submit(ramp_data)
+        self.look_ahead.submit(make_scene())
+        shots = self.get_all(2)
+        _, out, info, error = shots[0]
+        self.assertIsNone(out)
+        self.assertIn('output_format', error)
+        self.assertIsNone(shots[1][3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,352 @@
+import copy
+import unittest
+
+import numpy as np
+
+from rampage import ramps
+
+
+def make_key_frame_list(times):
+    """Returns a KeyFrameList with a keyframe at each absolute time in
+    times, all relative to the start of the ramp."""
+    dct = {}
+    for i, time in enumerate(times):
+        dct['key{0}'.format(i)] = {'comment': '', 'parent': None,
+                                   'time': time}
+    return ramps.KeyFrameList(dct)
+
+
+class TestKeyTicks(unittest.TestCase):
+
+    # 0.7/0.004 is 174.99999999999997 in floating point
+    tick = 0.004
+
+    def test_key_ticks_round_to_nearest(self):
+        kfl = make_key_frame_list([0.0, 0.7, 1.0])
+        key_ticks = kfl.get_key_ticks(self.tick)
+        self.assertEqual(key_ticks.tolist(), [0, 175, 250])
+
+    def test_digital_change_at_nearest_tick(self):
+        kfl = make_key_frame_list([0.0, 0.7, 1.0])
+        dct = {'comment': '', 'id': 'Dev1/port0/line5', 'type': 'digital',
+               'keys': {'key0': {'ramp_type': 'jump', 'ramp_data': {},
+                                 'state': False},
+                        'key1': {'ramp_type': 'jump', 'ramp_data': {},
+                                 'state': True},
+                        'key2': {'ramp_type': 'jump', 'ramp_data': {},
+                                 'state': False}}}
+        channel = ramps.Channel('line5', dct, kfl)
+        cp = channel.get_digital_change_points(self.tick)
+        self.assertEqual(cp.positions.tolist(), [0, 175, 250])
+        self.assertEqual(cp.values.tolist(), [0, 1, 0])
+        self.assertEqual(len(cp), 251)
+        _, dense = channel.generate_ramp(self.tick)
+        self.assertTrue(np.array_equal(cp.expand(), dense))
+
+
+def make_key_tree():
+    """Returns the dict of a KeyFrameList with two branches.
+
+    root - a - b - c
+         \ d - e
+    """
+    parents = [('root', None, 0.0), ('a', 'root', 1.0), ('b', 'a', 2.0),
+               ('c', 'b', 3.0), ('d', 'root', 0.5), ('e', 'd', 4.0)]
+    return dict((key, {'comment': '', 'parent': parent, 'time': time})
+                for key, parent, time in parents)
+
+
+class TestKeyFrameList(unittest.TestCase):
+
+    def assert_baked(self, kfl):
+        """Checks the times, order and child index of kfl against a
+        KeyFrameList baked from scratch."""
+        dct = copy.deepcopy(kfl.dct)
+        for kf in dct.values():
+            kf.pop('__abs_time__', None)
+        fresh = ramps.KeyFrameList(dct)
+        for key in fresh.dct:
+            self.assertEqual(kfl.dct[key]['__abs_time__'],
+                             fresh.dct[key]['__abs_time__'], key)
+        self.assertEqual(kfl.sorted_key_list(), fresh.sorted_key_list())
+        self.assertEqual(sorted(kfl.child_index), sorted(fresh.child_index))
+        for key, children in fresh.child_index.items():
+            self.assertEqual(sorted(kfl.child_index[key]), sorted(children))
+
+    def test_set_time(self):
+        kfl = ramps.KeyFrameList(make_key_tree())
+        kfl.set_time('a', 5.0)
+        self.assertEqual(kfl.get_absolute_time('c'), 10.0)
+        self.assertEqual(kfl.get_absolute_time('e'), 4.5)
+        self.assertEqual(kfl.sorted_key_list()[-1], 'c')
+        self.assert_baked(kfl)
+
+    def test_set_parent(self):
+        kfl = ramps.KeyFrameList(make_key_tree())
+        kfl.set_parent('b', 'e')
+        self.assertEqual(kfl.get_absolute_time('c'), 9.5)
+        self.assert_baked(kfl)
+        kfl.set_parent('d', None)
+        self.assertEqual(kfl.get_absolute_time('e'), 4.5)
+        self.assert_baked(kfl)
+
+    def test_set_parent_rejects_cycles(self):
+        kfl = ramps.KeyFrameList(make_key_tree())
+        self.assertRaises(ValueError, kfl.set_parent, 'a', 'c')
+        self.assertRaises(ValueError, kfl.set_parent, 'a', 'a')
+        self.assertRaises(KeyError, kfl.set_parent, 'a', 'unknown')
+        self.assertEqual(kfl.dct['a']['parent'], 'root')
+        self.assert_baked(kfl)
+
+    def test_cycle_in_dict(self):
+        dct = make_key_tree()
+        dct['a']['parent'] = 'c'
+        self.assertRaises(ValueError, ramps.KeyFrameList, dct)
+
+    def test_del_keyframe(self):
+        kfl = ramps.KeyFrameList(make_key_tree())
+        kfl.del_keyframe('b')
+        # c now follows a
+        self.assertEqual(kfl.dct['c']['parent'], 'a')
+        self.assertEqual(kfl.get_absolute_time('c'), 4.0)
+        self.assertNotIn('b', kfl.sorted_key_list())
+        self.assert_baked(kfl)
+
+    def test_add_keyframe(self):
+        kfl = ramps.KeyFrameList(make_key_tree())
+        kfl.add_keyframe('f', {'comment': '', 'parent': 'e', 'time': 1.0})
+        self.assertEqual(kfl.get_absolute_time('f'), 5.5)
+        self.assert_baked(kfl)
+        self.assertRaises(KeyError, kfl.add_keyframe, 'g',
+                          {'comment': '', 'parent': 'unknown', 'time': 1.0})
+        self.assertNotIn('g', kfl.dct)
+
+    def test_add_keyframe_rejects_duplicates(self):
+        kfl = ramps.KeyFrameList(make_key_tree())
+        self.assertRaises(KeyError, kfl.add_keyframe, 'b',
+                          {'comment': '', 'parent': 'e', 'time': 1.0})
+        self.assertEqual(kfl.dct['b']['parent'], 'a')
+        self.assert_baked(kfl)
+        # re-baking after the rejected duplicate still works
+        kfl.set_time('a', 2.0)
+        self.assert_baked(kfl)
+
+    def test_set_name(self):
+        kfl = ramps.KeyFrameList(make_key_tree())
+        kfl.set_name('b', 'b2')
+        self.assertEqual(kfl.dct['c']['parent'], 'b2')
+        kfl.set_time('a', 2.0)
+        self.assertEqual(kfl.get_absolute_time('c'), 7.0)
+        self.assert_baked(kfl)
+        self.assertRaises(KeyError, kfl.set_name, 'b2', 'e')
+        self.assert_baked(kfl)
+
+    def test_deep_chain(self):
+        # deeper than the recursion limit
+        n_keys = 5000
+        dct = {'k0': {'comment': '', 'parent': None, 'time': 0.0}}
+        for i in range(1, n_keys):
+            dct['k{0}'.format(i)] = {'comment': '',
+                                     'parent': 'k{0}'.format(i - 1),
+                                     'time': 1.0}
+        kfl = ramps.KeyFrameList(dct)
+        last_key = 'k{0}'.format(n_keys - 1)
+        self.assertEqual(kfl.get_absolute_time(last_key), n_keys - 1.0)
+        kfl.set_time('k1', 3.0)
+        self.assertEqual(kfl.get_absolute_time(last_key), n_keys + 1.0)
+        self.assertEqual(len(kfl.get_descendants('k0')), n_keys - 1)
+        self.assertTrue(kfl.is_ancestor(last_key, 'k0'))
+        self.assertRaises(ValueError, kfl.set_parent, 'k0', last_key)
+        kfl.unbake()
+        self.assertEqual(kfl.get_absolute_time(last_key), n_keys + 1.0)
+
+
+def make_change_points(n_samples=200, n_changes=20, seed=0):
+    rng = np.random.RandomState(seed)
+    positions = rng.randint(0, n_samples, n_changes)
+    values = rng.randint(0, 4, n_changes)
+    return ramps.ChangePoints.from_changes(np.append(0, positions),
+                                           np.append(1, values), n_samples)
+
+
+def held_samples_reference(voltages, tolerances):
+    """select_held_samples, one sample at a time."""
+    tolerances = np.asarray(tolerances)
+    n_samples = voltages.shape[1]
+    keep = [0]
+    for i in range(1, n_samples):
+        if (np.abs(voltages[:, i] - voltages[:, keep[-1]]) >
+                tolerances).any():
+            keep.append(i)
+    if keep[-1] != n_samples - 1:
+        keep.append(n_samples - 1)
+    return keep
+
+
+class TestChangePoints(unittest.TestCase):
+
+    def test_expand_range(self):
+        cp = make_change_points()
+        dense = cp.expand()
+        for start, stop in [(0, 200), (0, 1), (17, 18), (5, 123),
+                            (150, 200), (199, 200)]:
+            self.assertTrue(np.array_equal(cp.expand_range(start, stop),
+                                           dense[start:stop]))
+
+    def test_expand_range_empty(self):
+        cp = make_change_points()
+        for start in (0, 50, 200):
+            self.assertEqual(len(cp.expand_range(start, start)), 0)
+        self.assertEqual(len(cp.expand_range(60, 50)), 0)
+        out = np.ones(10, dtype='uint32')
+        self.assertEqual(len(cp.expand_range(3, 3, out)), 0)
+
+    def test_expand_range_into_out(self):
+        cp = make_change_points()
+        out = np.zeros(64, dtype='uint32')
+        result = cp.expand_range(10, 50, out)
+        self.assertTrue(np.array_equal(result, cp.expand()[10:50]))
+        self.assertTrue(np.array_equal(out[:40], result))
+
+    def test_iter_chunks(self):
+        cp = make_change_points()
+        chunks = list(cp.iter_chunks(64))
+        self.assertEqual([len(chunk) for chunk in chunks], [64, 64, 64, 8])
+        self.assertTrue(np.array_equal(np.concatenate(chunks), cp.expand()))
+
+    def test_from_runs(self):
+        runs = [(0, 5, 1), (5, 10, np.array([0, 1, 1, 0, 0], 'uint32')),
+                (12, 15, 1)]
+        cp = ramps.ChangePoints.from_runs(runs, 16)
+        expected = [1]*5 + [0, 1, 1, 0, 0] + [0, 0] + [1]*3 + [0]
+        self.assertEqual(cp.expand().tolist(), expected)
+
+    def test_merge_change_points(self):
+        parts = [(make_change_points(200, seed=1), 0),
+                 (make_change_points(200, seed=2), 2),
+                 (make_change_points(150, seed=3), 4)]
+        merged = ramps.merge_change_points(parts)
+        self.assertEqual(len(merged), 200)
+        expected = np.zeros(200, dtype='uint32')
+        for cp, bit_shift in parts:
+            expected[:len(cp)] |= cp.expand() << bit_shift
+            # shorter parts hold their last value
+            expected[len(cp):] |= cp.values[-1] << bit_shift
+        self.assertTrue(np.array_equal(merged.expand(), expected))
+        # no position where the word does not change
+        self.assertTrue(np.all(merged.values[1:] != merged.values[:-1]))
+
+
+class TestSelectSamples(unittest.TestCase):
+
+    def test_select_held_samples(self):
+        rng = np.random.RandomState(0)
+        voltages = np.cumsum(rng.normal(0.0, 0.01, (3, 2000)), axis=1)
+        # a flat stretch, which the walk searches in growing windows
+        voltages[:, 500:1500] = voltages[:, 499:500]
+        tolerances = [0.02, 0.05, 0.1]
+        expected = held_samples_reference(voltages, tolerances)
+        for max_step in (1, 4, 16):
+            keep = ramps.select_held_samples(voltages, tolerances, max_step)
+            self.assertEqual(keep.tolist(), expected)
+
+    def test_select_held_samples_tolerance(self):
+        voltages = np.array([[0.0, 0.05, 0.09, 0.2, 0.2, 0.2]])
+        keep = ramps.select_held_samples(voltages, [0.1])
+        self.assertEqual(keep.tolist(), [0, 3, 5])
+        keep = ramps.select_held_samples(voltages, [0.0])
+        self.assertEqual(keep.tolist(), [0, 1, 2, 3, 5])
+
+    def test_select_changed_samples(self):
+        codes = np.array([[0, 0, 1, 1, 1], [2, 2, 2, 3, 3]])
+        keep = ramps.select_changed_samples(codes)
+        self.assertEqual(keep.tolist(), [0, 2, 3, 4])
+
+
+def make_segments(time_array, seed=0):
+    """Returns segments of evaluate_analog_segments which cover time_array,
+    with every analog ramp type a few times, in random order."""
+    rng = np.random.RandomState(seed)
+    ramp_types = sorted(ramps.analog_ramp_types)*4
+    rng.shuffle(ramp_types)
+    bounds = np.sort(rng.choice(np.arange(1, len(time_array) - 1),
+                                len(ramp_types) - 1, replace=False))
+    bounds = np.concatenate(([0], bounds, [len(time_array) - 1]))
+    segments = []
+    for i, ramp_type in enumerate(ramp_types):
+        ramp_data = dict((name, rng.uniform(0.5, 2.0))
+                         for name in ramps.analog_ramp_types[ramp_type])
+        ramp_data.update(ramps.ramp_type_defaults.get(ramp_type, {}))
+        segments.append((bounds[i], bounds[i + 1],
+                         {'ramp_type': ramp_type, 'ramp_data': ramp_data},
+                         rng.uniform(-5.0, 5.0)))
+    # an exponential which jumps, and an empty segment
+    segments[0][2]['ramp_type'] = 'exp'
+    segments[0][2]['ramp_data'] = {'value': 1.0, 'tau': 0}
+    segments.append((bounds[3], bounds[3], segments[3][2], 0.0))
+    return segments
+
+
+class TestAnalogSegments(unittest.TestCase):
+
+    def test_vectorized_matches_per_segment(self):
+        time_array = np.cumsum(np.random.RandomState(1).uniform(
+            0.004, 0.1, 2000))
+        for seed in range(3):
+            segments = make_segments(time_array, seed)
+            voltages = np.full(len(time_array), np.nan)
+            ramps.evaluate_analog_segments(segments, time_array, voltages)
+
+            expected = np.full(len(time_array), np.nan)
+            for start_pos, end_pos, key_dict, next_value in segments:
+                if end_pos <= start_pos:
+                    continue
+                ramp_type = key_dict['ramp_type']
+                if (ramp_type == 'exp' and
+                        key_dict['ramp_data']['tau'] == 0):
+                    ramp_type = 'jump'
+                expected[start_pos:end_pos] = \
+                    ramps.analog_ramp_functions[ramp_type](
+                        key_dict['ramp_data'], time_array[start_pos],
+                        time_array[end_pos], next_value,
+                        time_array[start_pos:end_pos])
+            # the last sample is not in any segment
+            self.assertTrue(np.isnan(voltages[-1]))
+            self.assertTrue(np.allclose(voltages[:-1], expected[:-1],
+                                        rtol=1e-12, atol=1e-12))
+
+
+class TestRegionTicks(unittest.TestCase):
+
+    tick = 0.004
+
+    def test_count_region_ticks(self):
+        cases = [(0, 1000, (0.02,)), (7, 1003, (0.02, 0.012)),
+                 (0, 997, (0.008, 0.012, 0.02)), (5, 6, (0.02,)),
+                 (0, 250, (0.004,)), (0, 100, (1.0,))]
+        for start, end, resolutions in cases:
+            ticks = ramps.region_ticks(start, end, resolutions, self.tick)
+            self.assertEqual(ramps.count_region_ticks(start, end, resolutions,
+                                                      self.tick),
+                             len(ticks))
+            self.assertTrue(np.all(np.diff(ticks) > 0))
+            self.assertTrue(np.all((ticks >= start) & (ticks < end)))
+
+    def test_count_region_ticks_bound(self):
+        # resolutions which are not whole numbers of ticks
+        for resolutions in [(0.006,), (0.0101, 0.02), (0.001,)]:
+            ticks = ramps.region_ticks(0, 1000, resolutions, self.tick)
+            self.assertGreaterEqual(
+                ramps.count_region_ticks(0, 1000, resolutions, self.tick),
+                len(ticks))
+
+    def test_make_sample_ticks(self):
+        key_ticks = np.array([0, 10, 20, 40])
+        sample_ticks, kf_positions = ramps.make_sample_ticks(
+            key_ticks, [0, (0.02,), 0], self.tick, 0.02)
+        self.assertEqual(sample_ticks.tolist(), [0, 10, 15, 20, 40])
+        self.assertEqual(kf_positions.tolist(), [0, 1, 3, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import copy
+import os
+import Queue
+import shutil
+import tempfile
+import time
+import unittest
+
+# the tests run without NI hardware
+os.environ['RAMPAGE_DAQ_BACKEND'] = 'simulated'
+
+from rampage import server
+from rampage.daq import daq, simulated
+from rampage.daq.settings import expt_settings
+
+from tests.scenes import make_scene
+
+
+class TestCheckShotSize(unittest.TestCase):
+
+    def test_does_not_modify_shot(self):
+        ramp_data = make_scene()
+        original = copy.deepcopy(ramp_data)
+        _, errors, warnings = server.check_shot_size(ramp_data)
+        self.assertEqual(errors, [])
+        self.assertEqual(ramp_data, original)
+
+    def test_sample_rate_limit(self):
+        self.assertEqual(server.default_shot_limits['max_sample_rate'],
+                         expt_settings.max_expected_rate)
+        ramp_data = make_scene()
+        # a tick of 1 us is a sample rate of 1 MHz
+        ramp_data['properties']['jump_resolution'] = 0.001
+        _, errors, _ = server.check_shot_size(ramp_data)
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('sample rate'))
+
+
+class TestDaqThreadCache(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.get_log_dir = server.get_log_dir
+        server.get_log_dir = lambda: self.log_dir
+        self.daq_thread = server.DaqThread(None)
+
+    def tearDown(self):
+        server.get_log_dir = self.get_log_dir
+        shutil.rmtree(self.log_dir)
+
+    def test_repeated_shots_hit_the_cache(self):
+        outs = [self.daq_thread.make_ramps(make_scene()) for _ in range(3)]
+        stats = self.daq_thread.shot_cache.get_stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+        for out in outs[1:]:
+            for item, first_item in zip(out[:-1], outs[0][:-1]):
+                self.assertIs(item, first_item)
+
+
+def make_logged_scene(wait_after_running):
+    """Returns make_scene() without hooks and logging."""
+    ramp_data = make_scene()
+    for kf in ramp_data['keyframes'].values():
+        kf.pop('hooks', None)
+    ramp_data['properties']['log_ramp_file'] = False
+    ramp_data['properties']['wait_after_running'] = wait_after_running
+    return ramp_data
+
+
+class TestDaqThreadStates(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.get_log_dir = server.get_log_dir
+        server.get_log_dir = lambda: self.log_dir
+        # the server imports daq only when it runs as a script
+        server.daq = daq
+        self.speed_up = simulated.speed_up
+        simulated.speed_up = 10.0
+        self.data_q = Queue.Queue()
+        self.daq_thread = server.DaqThread(self.data_q)
+        self.daq_thread.start()
+
+    def tearDown(self):
+        self.daq_thread.stoprequest.set()
+        self.daq_thread.join(10.0)
+        simulated.speed_up = self.speed_up
+        del server.daq
+        server.get_log_dir = self.get_log_dir
+        shutil.rmtree(self.log_dir)
+
+    def wait_for_state(self, state, timeout=10.0):
+        """Returns the states seen until state is entered."""
+        seen = []
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            current = self.daq_thread.get_state()['state']
+            if not seen or seen[-1] != current:
+                seen.append(current)
+            if current == state:
+                return seen
+            time.sleep(0.001)
+        self.fail('state {0} not entered, seen {1}'.format(state, seen))
+
+    def test_shot_goes_through_states(self):
+        self.daq_thread.running.set()
+        self.data_q.put(make_logged_scene(100.0))
+        seen = self.wait_for_state('settling')
+        seen += self.wait_for_state('idle')[1:]
+        # compiling and logging may be too short to be seen
+        seen = [state for state in seen
+                if state not in ('compiling', 'logging')]
+        self.assertEqual(seen, ['idle', 'uploading', 'running', 'settling',
+                                'idle'])
+        self.assertEqual(self.daq_thread.prev_data_list, [])
+
+    def test_paused_is_idle(self):
+        self.daq_thread.running.set()
+        self.data_q.put(make_logged_scene(300.0))
+        self.wait_for_state('settling')
+        self.daq_thread.running.clear()
+        self.wait_for_state('idle', 2.0)
+        # the next shot waits until the thread runs again
+        self.data_q.put(make_logged_scene(0.0))
+        time.sleep(0.3)
+        self.assertEqual(self.daq_thread.get_state()['state'], 'idle')
+        self.assertEqual(self.data_q.qsize(), 1)
+        self.daq_thread.running.set()
+        self.wait_for_state('running')
+        self.wait_for_state('idle')
+        self.assertEqual(self.data_q.qsize(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()